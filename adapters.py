@@ -0,0 +1,216 @@
+"""
+Sharding of workers and their devices over several Bluetooth adapters.
+
+With an ``adapters`` section in the manager config, every adapter gets its own worker process
+(see ``isolation``) whose bluepy connects and scans all go through that adapter, so adapters
+poll in parallel. Workers with a ``devices`` list run on every adapter with the part of their
+devices assigned to it, other workers run on a single adapter.
+
+Devices are assigned in the worker config with ``adapter``, either one adapter for the whole
+worker or a mapping of device names, and the rest automatically: spread by load at first, and
+every ``rebalance_interval`` moved to the adapters that hear them best, by RSSI from a short
+scan on every adapter, and that have the least to do, by the time their polls took or, until
+they were timed, by the poll cost the workers declare. Devices of workers that declare an
+``ExclusiveAdapter`` don't share their adapters with other workers (see ``capabilities``).
+"""
+import copy
+
+import capabilities
+import logger
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_REBALANCE_INTERVAL = 3600  # In seconds
+DEFAULT_SURVEY_DURATION = 5  # In seconds
+DEFAULT_RSSI_MARGIN = 10  # In dB
+
+
+def interface(adapter):
+    """The bluepy interface number of an adapter given as 1 or 'hci1'"""
+    if isinstance(adapter, str) and adapter.startswith("hci"):
+        adapter = adapter[3:]
+    return int(adapter)
+
+
+def device_mac(device):
+    mac = device.get("mac") if isinstance(device, dict) else device
+    return mac.upper() if isinstance(mac, str) else None
+
+
+def assign(
+    units, interfaces, fixed=None, rssi=None, costs=None, current=None, margin=DEFAULT_RSSI_MARGIN, exclusive=()
+):
+    """
+    Maps every unit, a ``(worker, device, mac)`` tuple with device None for a whole worker, to an
+    interface. Fixed units keep their interface. The others may use the interfaces that hear them
+    within ``margin`` dB of the best RSSI, or any interface when none heard them. New units go to
+    the least loaded of those, then units move from busier interfaces as long as that lowers the
+    load of the busier one, so a balanced assignment stays as it is. Workers in ``exclusive`` get
+    interfaces of their own first, as long as one is left for the other workers.
+    """
+    fixed = fixed or {}
+    rssi = rssi or {}
+    costs = costs or {}
+    current = current or {}
+    load = {iface: 0.0 for iface in interfaces}
+    result = {}
+
+    def cost(unit):
+        return costs.get(unit[0], 1.0)
+
+    def heard(unit):
+        return {iface: rssi[iface][unit[2]] for iface in interfaces if unit[2] in rssi.get(iface, {})}
+
+    reserved = _reserve(units, interfaces, fixed, current, exclusive)
+
+    def allowed(unit):
+        own = [iface for iface in interfaces if reserved.get(iface) == unit[0]]
+        return own or [iface for iface in interfaces if iface not in reserved] or interfaces
+
+    def candidates(unit):
+        pool = allowed(unit)
+        levels = {iface: level for iface, level in heard(unit).items() if iface in pool}
+        if not levels:
+            return pool
+        best = max(levels.values())
+        return [iface for iface, level in levels.items() if level >= best - margin]
+
+    def least_loaded(unit):
+        levels = heard(unit)
+        return min(candidates(unit), key=lambda iface: (load[iface], -levels.get(iface, 0), interfaces.index(iface)))
+
+    free = []
+    for unit in units:
+        key = unit[:2]
+        if key in fixed:
+            result[key] = fixed[key]
+        elif current.get(key) in candidates(unit):
+            result[key] = current[key]
+        else:
+            free.append(unit)
+            continue
+        load[result[key]] = load.get(result[key], 0.0) + cost(unit)
+
+    movable = sorted(
+        (unit for unit in units if unit[:2] not in fixed), key=lambda unit: (-cost(unit), str(unit[0]), str(unit[1]))
+    )
+    for unit in movable:
+        if unit in free:
+            result[unit[:2]] = least_loaded(unit)
+            load[result[unit[:2]]] += cost(unit)
+
+    moved = True
+    while moved:
+        moved = False
+        for unit in movable:
+            key = unit[:2]
+            target = least_loaded(unit)
+            if load[target] + cost(unit) < load[result[key]]:
+                load[result[key]] -= cost(unit)
+                load[target] += cost(unit)
+                result[key] = target
+                moved = True
+    return result
+
+
+def _reserve(units, interfaces, fixed, current, exclusive):
+    """The interfaces kept for exclusive workers, mapped to the worker"""
+    reserved = {}
+    shared = {fixed[unit[:2]] for unit in units if unit[0] not in exclusive and unit[:2] in fixed}
+    for unit in units:
+        if unit[0] in exclusive and unit[:2] in fixed and fixed[unit[:2]] not in shared:
+            reserved.setdefault(fixed[unit[:2]], unit[0])
+    has_shared = any(unit[0] not in exclusive for unit in units)
+    for worker in sorted({unit[0] for unit in units if unit[0] in exclusive} - set(reserved.values())):
+        free = [iface for iface in interfaces if iface not in reserved and iface not in shared]
+        if not free or (has_shared and len(interfaces) - len(reserved) < 2):
+            _LOGGER.warning("Not enough adapters for %s to have one of its own", worker)
+            continue
+        previous = [current.get(unit[:2]) for unit in units if unit[0] == worker]
+        reserved[min(free, key=lambda iface: (iface not in previous, interfaces.index(iface)))] = worker
+    return reserved
+
+
+class Sharding:
+    def __init__(self, config, workers_config, declared=None):
+        self.interfaces = [interface(adapter) for adapter in config.get("interfaces", [0])]
+        self.rebalance_interval = config.get("rebalance_interval", DEFAULT_REBALANCE_INTERVAL)
+        self.survey_duration = config.get("survey_duration", DEFAULT_SURVEY_DURATION)
+        self.margin = config.get("rssi_margin", DEFAULT_RSSI_MARGIN)
+        self._workers_config = workers_config
+        self._units = []
+        self._fixed = {}
+        self._costs = {}
+        self._exclusive = set()
+        for worker_name, worker_capabilities in (declared or {}).items():
+            poll = capabilities.find(worker_capabilities, capabilities.Poll)
+            if poll is not None and poll.cost is not None:
+                self._costs[worker_name] = poll.cost
+            if capabilities.find(worker_capabilities, capabilities.ExclusiveAdapter):
+                self._exclusive.add(worker_name)
+        for worker_name, worker_config in workers_config.items():
+            adapter = worker_config.get("adapter")
+            devices = worker_config["args"].get("devices")
+            if isinstance(devices, dict):
+                for device_name, device in devices.items():
+                    self._units.append((worker_name, device_name, device_mac(device)))
+                    if isinstance(adapter, dict) and device_name in adapter:
+                        self._fixed[(worker_name, device_name)] = interface(adapter[device_name])
+                    elif adapter is not None and not isinstance(adapter, dict):
+                        self._fixed[(worker_name, device_name)] = interface(adapter)
+            else:
+                self._units.append((worker_name, None, device_mac(worker_config["args"].get("mac"))))
+                if adapter is not None and not isinstance(adapter, dict):
+                    self._fixed[(worker_name, None)] = interface(adapter)
+        self.assignment = assign(
+            self._units, self.interfaces, self._fixed, costs=self._costs, margin=self.margin, exclusive=self._exclusive
+        )
+        # Whole workers can't move without their process changing what it runs
+        for unit in self._units:
+            if unit[1] is None:
+                self._fixed[unit[:2]] = self.assignment[unit[:2]]
+
+    @staticmethod
+    def name(iface):
+        return "hci{}".format(iface)
+
+    def processes(self):
+        """The worker configs every adapter's process runs, by process name"""
+        return {self.name(iface): {"workers": self.workers(iface), "adapter": iface} for iface in self.interfaces}
+
+    def workers(self, iface):
+        workers = {}
+        for worker_name, worker_config in self._workers_config.items():
+            devices = worker_config["args"].get("devices")
+            if not isinstance(devices, dict):
+                if self.assignment[(worker_name, None)] == iface:
+                    workers[worker_name] = worker_config
+                continue
+            shard = copy.deepcopy(worker_config)
+            shard["args"]["devices"] = {
+                name: device for name, device in devices.items() if self.assignment[(worker_name, name)] == iface
+            }
+            workers[worker_name] = shard
+        return workers
+
+    def rebalance(self, rssi, costs):
+        """Reassigns the devices, returns the names of the processes whose devices changed"""
+        assignment = assign(
+            self._units,
+            self.interfaces,
+            self._fixed,
+            rssi,
+            dict(self._costs, **costs),
+            current=self.assignment,
+            margin=self.margin,
+            exclusive=self._exclusive,
+        )
+        moved = [key for key, iface in assignment.items() if self.assignment[key] != iface]
+        changed = set()
+        for key in moved:
+            _LOGGER.info(
+                "Moving %s device '%s' from hci%d to hci%d", key[0], key[1], self.assignment[key], assignment[key]
+            )
+            changed.update((self.name(self.assignment[key]), self.name(assignment[key])))
+        self.assignment = assignment
+        return changed
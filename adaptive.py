@@ -0,0 +1,79 @@
+"""
+Adaptive poll intervals per device.
+
+With ``adaptive`` in a worker's config, every device of a worker polling its devices one by one
+(see ``capabilities.Poll``) gets an interval of its own. It starts at the worker's
+``update_interval`` and grows by ``factor`` with every poll whose values stayed within
+``deadband`` of the previous poll, up to ``max_interval``. A poll with values that moved, or a
+command to the device, brings it back to ``min_interval``.
+
+``deadband`` is one number for all values or numbers by value name, the last level of the
+message topic or the key in a JSON payload. Values that are not numbers have moved when they
+differ at all.
+"""
+import numbers
+
+import logger
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_FACTOR = 2
+DEFAULT_MAX_INTERVALS = 10  # The longest interval in update intervals, without max_interval
+
+
+def readings(messages):
+    """The values of a poll's messages by (topic, key), key None for a payload that is the value"""
+    values = {}
+    for message in messages:
+        payload = message.raw_payload
+        if isinstance(payload, dict):
+            for key, value in payload.items():
+                values[(message.topic, key)] = value
+        else:
+            values[(message.topic, None)] = payload
+    return values
+
+
+class AdaptiveIntervals:
+    def __init__(self, config, update_interval):
+        self.min_interval = config.get("min_interval", update_interval)
+        self.max_interval = config.get("max_interval", update_interval * DEFAULT_MAX_INTERVALS)
+        self.factor = config.get("factor", DEFAULT_FACTOR)
+        self.deadband = config.get("deadband", 0)
+        self._start = min(max(update_interval, self.min_interval), self.max_interval)
+        self._intervals = {}
+        self._readings = {}
+
+    def interval(self, device):
+        return self._intervals.get(device, self._start)
+
+    def polled(self, device, messages):
+        """The device's new interval after a poll, None when it stays the same"""
+        current = readings(messages)
+        if not current:
+            return None
+        previous = self._readings.get(device)
+        self._readings[device] = current
+        if previous is None:
+            return None
+        if any(self._moved(key, previous.get(key), value) for key, value in current.items()):
+            return self._set(device, self.min_interval)
+        return self._set(device, min(self.interval(device) * self.factor, self.max_interval))
+
+    def touched(self, device):
+        """The device's new interval after a command to it, None when it stays the same"""
+        return self._set(device, self.min_interval)
+
+    def _moved(self, key, previous, value):
+        name = key[1] if key[1] is not None else key[0].split("/")[-1]
+        deadband = self.deadband.get(name, 0) if isinstance(self.deadband, dict) else self.deadband
+        if isinstance(previous, numbers.Number) and isinstance(value, numbers.Number):
+            return abs(value - previous) > deadband
+        return previous != value
+
+    def _set(self, device, interval):
+        if interval == self.interval(device):
+            return None
+        _LOGGER.debug("Polling device '%s' every %d seconds", device, interval)
+        self._intervals[device] = interval
+        return interval
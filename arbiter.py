@@ -0,0 +1,121 @@
+"""
+Arbitration of scans and connects on a Bluetooth adapter.
+
+Most controllers can't create a connection while they scan, so a connect racing a scan fails
+with a BTLEException and its poll is wasted. Through the bluepy hooks every scan holds its
+adapter in short slices, and a connect waiting for the adapter makes the scan stop after the
+current slice and resume once the connect is through. The locks are files in ``lock_dir``,
+so worker processes sharing an adapter (see ``isolation``) take turns as well.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not on Linux, nothing to arbitrate
+    fcntl = None
+
+import clock
+import logger
+import metrics
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_SCAN_SLICE = 1.0  # In seconds, the longest a connect waits for a scan
+DEFAULT_LOCK_DIR = os.path.join(tempfile.gettempdir(), "bt-mqtt-gateway")
+IDLE_POLL_INTERVAL = 0.05  # In seconds
+
+ADAPTER = "adapter"
+PENDING = "pending"
+
+_settings = {"enabled": True, "scan_slice": DEFAULT_SCAN_SLICE, "lock_dir": DEFAULT_LOCK_DIR}
+
+
+def setup(config):
+    _settings.update(
+        enabled=config.get("enabled", True) and fcntl is not None,
+        scan_slice=float(config.get("scan_slice", DEFAULT_SCAN_SLICE)),
+        lock_dir=config.get("lock_dir", DEFAULT_LOCK_DIR),
+    )
+    if _settings["enabled"]:
+        try:
+            os.makedirs(_settings["lock_dir"], exist_ok=True)
+        except OSError as e:
+            _LOGGER.warning("Can't create %s, scans and connects are not arbitrated: %s", _settings["lock_dir"], e)
+            _settings["enabled"] = False
+
+
+def settings():
+    """The settings to set up a worker process with"""
+    return dict(_settings)
+
+
+@contextmanager
+def _lock(iface, name, operation):
+    """A lock shared by every thread and process of the gateway, even on the same file"""
+    fd = os.open(os.path.join(_settings["lock_dir"], "hci{}.{}".format(iface, name)), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, operation)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _pending(iface):
+    """Whether a connect is waiting for the adapter"""
+    fd = os.open(os.path.join(_settings["lock_dir"], "hci{}.{}".format(iface, PENDING)), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def connecting(iface):
+    """Holds the adapter while a connection is created, pausing scans on it"""
+    if not _settings["enabled"]:
+        yield
+        return
+    started = clock.monotonic()
+    # Connects only share the pending lock, so every waiting connect keeps scans paused
+    with _lock(iface, PENDING, fcntl.LOCK_SH), _lock(iface, ADAPTER, fcntl.LOCK_EX):
+        metrics.BLE_ADAPTER_WAIT.observe(clock.monotonic() - started, "hci{}".format(iface), "connect")
+        yield
+
+
+def process(scanner, original, timeout, iface):
+    """
+    Scanner.process in slices holding the adapter. When a connect is waiting, the scanner is
+    stopped until no connect is waiting anymore, the scan still ends after ``timeout``.
+    """
+    if not _settings["enabled"] or timeout is None:
+        return original(scanner, timeout)
+
+    end = clock.monotonic() + timeout
+    paused = False
+    while True:
+        started = clock.monotonic()
+        with _lock(iface, ADAPTER, fcntl.LOCK_EX):
+            metrics.BLE_ADAPTER_WAIT.observe(clock.monotonic() - started, "hci{}".format(iface), "scan")
+            if paused:
+                scanner.start(passive=getattr(scanner, "_arbiter_passive", False))
+            while clock.monotonic() < end:
+                slice_end = min(clock.monotonic() + _settings["scan_slice"], end)
+                original(scanner, slice_end - clock.monotonic())
+                # A scanner returning early would spin on the locks, the rest of the slice is waited out
+                while clock.monotonic() < slice_end and not _pending(iface):
+                    clock.sleep(min(IDLE_POLL_INTERVAL, slice_end - clock.monotonic()))
+                if _pending(iface):
+                    break
+            else:
+                return
+            scanner.stop()
+            paused = True
+        metrics.BLE_SCAN_PAUSES.inc("hci{}".format(iface))
+        _LOGGER.debug("Paused scan on hci%d for a connect", iface)
+        while _pending(iface) and clock.monotonic() < end:
+            clock.sleep(IDLE_POLL_INTERVAL)
@@ -0,0 +1,7 @@
+"""
+Reproducible throughput and latency benchmarks for the gateway pipeline.
+
+Run from the repository root with ``python -m benchmarks``. Every scenario runs in its own
+process against the simulated device farm and the local MQTT stand-in, and the results
+are written as JSON so runs of different commits can be compared with ``--compare``.
+"""
@@ -0,0 +1,145 @@
+import argparse
+import json
+import logging
+import subprocess
+import sys
+
+import logger
+
+from benchmarks.measure import environment
+from benchmarks.scenarios import SCENARIOS
+
+# Options handed down to the per scenario processes
+FORWARDED = ["seed", "iterations", "batch", "devices", "rounds", "time_scale", "command_timeout"]
+
+parser = argparse.ArgumentParser(prog="python -m benchmarks")
+parser.add_argument(
+    "scenarios",
+    nargs="*",
+    choices=[[]] + list(SCENARIOS),
+    help="Scenarios to run, all of them by default",
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    default="benchmark-results.json",
+    help="Where to write the JSON results (default: %(default)s)",
+)
+parser.add_argument("--compare", metavar="BASELINE", help="Compare with the results of an earlier run")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument(
+    "--iterations",
+    type=int,
+    default=20000,
+    help="Operations measured by the micro benchmarks (default: %(default)s)",
+)
+parser.add_argument(
+    "--batch",
+    type=int,
+    default=10,
+    help="Messages per published batch (default: %(default)s)",
+)
+parser.add_argument(
+    "--devices",
+    type=int,
+    default=50,
+    help="Simulated devices in the pipeline benchmark (default: %(default)s)",
+)
+parser.add_argument(
+    "--rounds",
+    type=int,
+    default=20,
+    help="Updates of all workers measured by the pipeline benchmark (default: %(default)s)",
+)
+parser.add_argument(
+    "--time-scale",
+    type=float,
+    default=0.0,
+    help="Scale of the simulated BLE latencies, 0 measures the gateway overhead only "
+    "(default: %(default)s)",
+)
+parser.add_argument("--command-timeout", type=int, default=35)
+parser.add_argument(
+    "--in-process",
+    action="store_true",
+    help="Run all scenarios in this process, peak RSS is then cumulative",
+)
+parser.add_argument("--child", choices=list(SCENARIOS), help=argparse.SUPPRESS)
+
+
+def run_child(name, args):
+    command = [sys.executable, "-m", "benchmarks", "--child", name]
+    for option in FORWARDED:
+        command += ["--" + option.replace("_", "-"), str(getattr(args, option))]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def compare(baseline, results):
+    print()
+    print("Compared with {} ({})".format(baseline.get("commit"), baseline.get("created")))
+    for name, result in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        print(
+            "{:<24} messages/s {}  p50 {}  p99 {}  cpu/msg {}".format(
+                name,
+                _change(previous["messages_per_second"], result["messages_per_second"]),
+                _change(previous["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+                _change(previous["latency_ms"]["p99"], result["latency_ms"]["p99"]),
+                _change(previous["cpu_per_message_us"], result["cpu_per_message_us"]),
+            )
+        )
+
+
+def _change(previous, current):
+    if not previous or current is None:
+        return "n/a"
+    return "{:+.1f}%".format((current - previous) / previous * 100)
+
+
+def _number(value, format_spec="{:.3f}"):
+    """A measured value, n/a for one of a scenario that measured nothing"""
+    return "n/a" if value is None else format_spec.format(value)
+
+
+def main():
+    args = parser.parse_args()
+    logger.setup()
+    logger.get().setLevel(logging.WARNING)
+
+    if args.child:
+        print(json.dumps(SCENARIOS[args.child](args)))
+        return
+
+    results = dict(environment(), options={option: getattr(args, option) for option in FORWARDED})
+    results["scenarios"] = {}
+    for name in args.scenarios or SCENARIOS:
+        print("Running {}...".format(name), file=sys.stderr)
+        result = SCENARIOS[name](args) if args.in_process else run_child(name, args)
+        results["scenarios"][name] = result
+        print(
+            "{:<24} {:>12} messages/s  p50 {} ms  p99 {} ms  "
+            "{:.1f} us CPU/message  {} MB peak RSS".format(
+                name,
+                _number(result["messages_per_second"], "{}"),
+                _number(result["latency_ms"]["p50"]),
+                _number(result["latency_ms"]["p99"]),
+                result["cpu_per_message_us"],
+                result["peak_rss_mb"],
+            )
+        )
+        if not result["operations"]:
+            print("{:<24} measured no operations".format(name), file=sys.stderr)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(args.output), file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+main()
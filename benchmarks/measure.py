@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+
+
+class Measurement:
+    """Collects per operation latencies, message counts, wall and CPU time of a scenario"""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.latencies = []
+        self.messages = 0
+        self._wall = 0.0
+        self._cpu = 0.0
+        self._started = None
+
+    def __enter__(self):
+        self._started = (time.perf_counter(), time.process_time())
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall, cpu = self._started
+        self._wall += time.perf_counter() - wall
+        self._cpu += time.process_time() - cpu
+        self._started = None
+
+    def record(self, latency, messages):
+        self.latencies.append(latency)
+        self.messages += messages
+
+    def result(self):
+        messages = max(self.messages, 1)
+        ordered = sorted(self.latencies)
+        return {
+            "operation": self.operation,
+            "operations": len(ordered),
+            "messages": self.messages,
+            "duration_s": round(self._wall, 4),
+            "messages_per_second": round(self.messages / self._wall, 1) if self._wall else None,
+            "latency_ms": {
+                "mean": _ms(sum(ordered) / len(ordered)) if ordered else None,
+                "p50": _ms(percentile(ordered, 50)),
+                "p90": _ms(percentile(ordered, 90)),
+                "p99": _ms(percentile(ordered, 99)),
+                "max": _ms(ordered[-1]) if ordered else None,
+            },
+            "cpu_per_message_us": round(self._cpu / messages * 1e6, 2),
+            "peak_rss_mb": round(peak_rss_bytes() / 1024 / 1024, 1),
+        }
+
+
+def percentile(ordered, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    rank = max(int(round(percent / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def peak_rss_bytes():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 4) if seconds is not None else None
+
+
+def environment():
+    return {
+        "commit": _git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "machine": os.uname().machine if hasattr(os, "uname") else None,
+        "cpus": os.cpu_count(),
+    }
+
+
+def _git_commit():
+    import subprocess
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+        dirty = subprocess.call(
+            ["git", "diff", "--quiet", "HEAD"], stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + "-dirty" if dirty else commit
@@ -0,0 +1,213 @@
+"""
+Benchmark scenarios, each one measures a single operation of the gateway pipeline.
+"""
+import random
+import time
+
+from benchmarks.measure import Measurement
+
+WARMUP = 0.1  # Share of the iterations run before measuring
+
+
+def _messages(rng, count):
+    from mqtt import MqttMessage
+
+    # The mix of plain and JSON payloads the workers publish
+    ret = []
+    for index in range(count):
+        if index % 2:
+            payload = str(round(rng.uniform(-10, 40), 1))
+        else:
+            payload = {
+                "temperature": round(rng.uniform(-10, 40), 1),
+                "humidity": round(rng.uniform(0, 100), 1),
+                "battery": rng.randint(0, 100),
+            }
+        ret.append(MqttMessage(topic="bench/device_{}/state".format(index), payload=payload))
+    return ret
+
+
+def _local_mqtt():
+    from simulator import LocalMqttClient
+
+    mqtt = LocalMqttClient({"host": "localhost", "topic_prefix": "bench"})
+    mqtt.callbacks_subscription([])
+    return mqtt
+
+
+def message_serialization(options):
+    rng = random.Random(options.seed)
+    batches = [_messages(rng, options.batch) for _ in range(64)]
+    measurement = Measurement("serialize {} messages".format(options.batch))
+
+    def run(iterations, record):
+        for index in range(iterations):
+            started = time.perf_counter()
+            for message in batches[index % len(batches)]:
+                message.topic, message.payload, message.retain
+            record(time.perf_counter() - started, options.batch)
+
+    run(int(options.iterations * WARMUP), lambda *_: None)
+    with measurement:
+        run(options.iterations, measurement.record)
+    return measurement.result()
+
+
+def publish(options):
+    rng = random.Random(options.seed)
+    mqtt = _local_mqtt()
+    batches = [_messages(rng, options.batch) for _ in range(64)]
+    measurement = Measurement("publish {} messages".format(options.batch))
+
+    def run(iterations, record):
+        for index in range(iterations):
+            started = time.perf_counter()
+            mqtt.publish(batches[index % len(batches)])
+            record(time.perf_counter() - started, options.batch)
+
+    run(int(options.iterations * WARMUP), lambda *_: None)
+    with measurement:
+        run(options.iterations, measurement.record)
+    return measurement.result()
+
+
+def command_execute(options):
+    from workers_manager import WorkersManager
+
+    rng = random.Random(options.seed)
+    batch = _messages(rng, options.batch)
+
+    def status_update():
+        return batch
+
+    template = WorkersManager.Command(status_update, options.command_timeout, [])
+    measurement = Measurement("enqueue and execute a command")
+
+    def run(iterations, record):
+        for _ in range(iterations):
+            started = time.perf_counter()
+            command = template.enqueued()
+            with command.traced():
+                messages = command.execute()
+            record(time.perf_counter() - started, len(messages))
+
+    run(int(options.iterations * WARMUP), lambda *_: None)
+    with measurement:
+        run(options.iterations, measurement.record)
+    return measurement.result()
+
+
+def pipeline(options):
+    """The gateway main loop with simulated devices, from enqueueing a worker update to publishing"""
+    import queue
+
+    import simulator
+
+    half = options.devices // 2
+    lywsd02 = {"lywsd02_{}".format(index): _mac("a4:c1:38", index) for index in range(half)}
+    lywsd03mmc = {
+        "lywsd03mmc_{}".format(index): _mac("a4:c1:39", index)
+        for index in range(options.devices - half)
+    }
+    workers = {
+        "lywsd02": {"args": {"devices": lywsd02, "topic_prefix": "lywsd02"}},
+        "lywsd03mmc": {"args": {"devices": lywsd03mmc, "topic_prefix": "lywsd03mmc"}},
+        "blescanmulti": {
+            "args": {
+                "devices": dict(lywsd02, **lywsd03mmc),
+                "topic_prefix": "blescan",
+                "scan_timeout": 1,
+            }
+        },
+    }
+    for worker_config in workers.values():
+        # Updates are queued by the benchmark, the scheduler must not interfere
+        worker_config["update_interval"] = 24 * 60 * 60
+    simulator.install({"seed": options.seed, "time_scale": options.time_scale}, workers)
+
+    from workers_manager import WorkersManager
+    from workers_queue import _WORKERS_QUEUE
+    import profiling
+
+    manager = WorkersManager(
+        {
+            "workers": workers,
+            "command_timeout": options.command_timeout,
+            # Simulated scans take no time at time scale 0, there is nothing to arbitrate
+            "arbitration": {"enabled": options.time_scale > 0},
+            # Every round polls all devices instead of republishing their cached values
+            "topic_subscription": {
+                "update_all": {"topic": "homeassistant/status", "payload": "online", "max_age": 0, "debounce": 0}
+            },
+        }
+    )
+    manager.register_workers("bench")
+    mqtt = _local_mqtt()
+    manager.start(mqtt)
+    measurement = Measurement("worker update from enqueue to publish")
+
+    def drain(record):
+        while True:
+            try:
+                command = _WORKERS_QUEUE.get_nowait()
+            except queue.Empty:
+                return
+            published = mqtt.mqttc.published_count
+            # Same as the gateway main loop
+            with command.traced(), profiling.profile(command.source):
+                mqtt.publish(command.execute())
+            record(
+                time.monotonic() - command._enqueued_at,
+                mqtt.mqttc.published_count - published,
+            )
+
+    try:
+        # The initial update queued by start() doubles as warm up
+        drain(lambda *_: None)
+        with measurement:
+            for _ in range(options.rounds):
+                manager.update_all()
+                drain(measurement.record)
+    finally:
+        manager._scheduler.shutdown(wait=False)
+    result = measurement.result()
+    result["devices"] = options.devices
+    return result
+
+
+def scheduler(options):
+    """Starting the scheduler with a job per device and running the jobs that fall due"""
+    import clock
+
+    virtual_clock = clock.VirtualClock(start=0)
+    measurement = Measurement("start and run {} interval jobs".format(options.devices))
+    runs = []
+
+    with measurement:
+        started = time.perf_counter()
+        jobs = virtual_clock.scheduler()
+        for index in range(options.devices):
+            jobs.add_job(lambda: runs.append(None), 60, id="device_{}".format(index), first_run=index % 60, jitter=1)
+        jobs.start()
+        measurement.record(time.perf_counter() - started, 0)
+        for _ in range(options.rounds * 60):
+            started = time.perf_counter()
+            count = len(runs)
+            virtual_clock.advance(1)
+            measurement.record(time.perf_counter() - started, len(runs) - count)
+    return measurement.result()
+
+
+def _mac(prefix, index):
+    from simulator.devices import generate_mac
+
+    return generate_mac(prefix, index).upper()
+
+
+SCENARIOS = {
+    "message_serialization": message_serialization,
+    "publish": publish,
+    "command_execute": command_execute,
+    "pipeline": pipeline,
+    "scheduler": scheduler,
+}
@@ -0,0 +1,210 @@
+"""
+Hooks around bluepy's Peripheral and Scanner, so gateway-wide concerns (metrics, tracing, capture,
+arbitration, the helper watchdog) apply to every worker without changes to the workers or the libraries they use.
+"""
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from exceptions import DeviceTimeoutError, WorkerTimeoutError
+import arbiter
+import capture
+import helper_watchdog
+import logger
+import metrics
+import tracing
+
+_LOGGER = logger.get(__name__)
+
+_installed = False
+_adapter = None
+
+
+def install():
+    """Patch bluepy once per process. Does nothing when bluepy is not installed."""
+    global _installed
+    if _installed:
+        return
+    try:
+        from bluepy import btle
+    except ImportError:
+        return
+
+    peripheral = btle.Peripheral
+    connect_name = "_connect" if hasattr(peripheral, "_connect") else "connect"
+    _patch(peripheral, connect_name, _connect_wrapper)
+    for name in ("readCharacteristic", "writeCharacteristic", "waitForNotifications"):
+        _patch(peripheral, name, _operation_wrapper(name))
+    _patch(peripheral, "disconnect", _disconnect_wrapper)
+    _patch(btle.BluepyHelper, "_startHelper", _start_helper_wrapper)
+    _patch(btle.BluepyHelper, "_stopHelper", _stop_helper_wrapper)
+    _patch(btle.Scanner, "start", _start_wrapper)
+    _patch(btle.Scanner, "scan", _scan_wrapper)
+    _patch(btle.Scanner, "process", _process_wrapper)
+
+    _installed = True
+    _LOGGER.debug("Installed bluepy hooks")
+
+
+def use_adapter(iface):
+    """Run every bluepy-helper of this process on hci<iface> unless it asks for another adapter"""
+    global _adapter
+    _adapter = iface
+
+
+def _iface(requested):
+    # Libraries pass hci0 when they are not told otherwise
+    if _adapter is not None and not requested:
+        return _adapter
+    return requested or 0
+
+
+def _patch(klass, name, wrapper_factory):
+    original = getattr(klass, name)
+    setattr(klass, name, wraps(original)(wrapper_factory(original)))
+
+
+@contextmanager
+def operation(name, device):
+    from bluepy import btle
+
+    result = "success"
+    try:
+        if name == "connect":
+            span = tracing.span("connect", device=device)
+        else:
+            span = tracing.span("io", device=device, operation=name)
+        with span:
+            yield
+    except (DeviceTimeoutError, WorkerTimeoutError):
+        result = "timeout"
+        raise
+    except btle.BTLEException:
+        result = "btle_error"
+        raise
+    except Exception:
+        result = "error"
+        raise
+    finally:
+        metrics.DEVICE_RESULTS.inc(device, name, result)
+
+
+def _connect_wrapper(original):
+    def connect(self, addr, *args, **kwargs):
+        device = getattr(addr, "addr", addr)
+        # Peripheral._connect(addr, addrType, iface, timeout), bluepy passes them positionally
+        iface = _iface(getattr(addr, "iface", args[1] if len(args) > 1 else kwargs.get("iface")))
+        timeout = args[2] if len(args) > 2 else kwargs.get("timeout")
+        started = time.monotonic()
+        try:
+            with operation("connect", device), arbiter.connecting(iface), helper_watchdog.request(
+                self, "connect", device, iface, timeout
+            ):
+                return original(self, addr, *args, **kwargs)
+        finally:
+            metrics.BLE_CONNECT_DURATION.observe(time.monotonic() - started, device)
+
+    return connect
+
+
+def _operation_wrapper(name):
+    def wrapper_factory(original):
+        def wrapper(self, *args, **kwargs):
+            address = getattr(self, "addr", None)
+            recorder = capture.recorder()
+            timeout = None
+            if name == "waitForNotifications":
+                timeout = args[0] if args else kwargs.get("timeout")
+            iface = getattr(self, "_watchdog_iface", _iface(None))
+            with operation(name, address), helper_watchdog.request(self, name, address, iface, timeout):
+                if recorder is None or self.delegate is None:
+                    return original(self, *args, **kwargs)
+
+                # Notifications can arrive during any request, not just while waiting for them
+                delegate = self.delegate
+                self.delegate = capture.RecordingDelegate(delegate, recorder, address)
+                try:
+                    ret = original(self, *args, **kwargs)
+                finally:
+                    self.delegate = delegate
+                if name == "readCharacteristic" and recorder.wants(capture.READ, address):
+                    handle = args[0] if args else kwargs.get("handle")
+                    recorder.record(capture.gatt(capture.READ, address, handle, ret))
+                return ret
+
+        return wrapper
+
+    return wrapper_factory
+
+
+def _start_helper_wrapper(original):
+    def start_helper(self, iface=None):
+        if _adapter is not None and not iface:
+            iface = _adapter
+        self._arbiter_iface = iface or 0
+        ret = original(self, iface)
+        helper_watchdog.started(self, iface or 0)
+        return ret
+
+    return start_helper
+
+
+def _stop_helper_wrapper(original):
+    def stop_helper(self):
+        # A killed helper can't be asked to quit
+        helper_watchdog.reap(self)
+        return original(self)
+
+    return stop_helper
+
+
+def _disconnect_wrapper(original):
+    def disconnect(self):
+        helper_watchdog.reap(self)
+        return original(self)
+
+    return disconnect
+
+
+def _start_wrapper(original):
+    def start(self, passive=False):
+        # Restarted with the same mode after a pause for a connect
+        self._arbiter_passive = passive
+        return original(self, passive=passive)
+
+    return start
+
+
+def _scan_wrapper(original):
+    def scan(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            with tracing.span("scan"):
+                return original(self, *args, **kwargs)
+        finally:
+            metrics.BLE_SCAN_DURATION.observe(time.monotonic() - started)
+
+    return scan
+
+
+def _process_wrapper(original):
+    def watched(self, timeout):
+        if timeout is None:
+            return original(self, timeout)
+        with helper_watchdog.request(self, "scan", None, self._arbiter_iface, timeout):
+            return original(self, timeout)
+
+    def process(self, timeout=10.0):
+        iface = getattr(self, "_arbiter_iface", _iface(None))
+        recorder = capture.recorder()
+        if recorder is None or self.delegate is None:
+            return arbiter.process(self, watched, timeout, iface)
+
+        delegate = self.delegate
+        self.delegate = capture.RecordingDelegate(delegate, recorder)
+        try:
+            return arbiter.process(self, watched, timeout, iface)
+        finally:
+            self.delegate = delegate
+
+    return process
@@ -0,0 +1,76 @@
+"""
+What a worker does, declared for the manager to schedule it.
+
+A worker class lists its capabilities in ``capabilities``, workers that don't declare them get
+the ones their methods imply. The manager polls, configures, runs and sends commands to a
+worker according to them, instead of checking which methods it has:
+
+- ``Poll``: ``status_update`` is queued every update interval. ``cost`` is about the seconds a
+  poll takes per device, the default cost for deadlines (see ``BaseWorker.poll_devices``) and
+  for spreading devices over adapters until polls were timed. With ``per_device`` every device
+  is queued as a command of its own, calling ``status_update(devices)`` with the device name,
+  so devices are shed, time out and are limited one by one.
+- ``Command``: ``on_command`` takes the messages of the worker's ``topic_subscription``.
+- ``Config``: ``config`` returns the Home Assistant discovery messages.
+- ``Stream``: ``run(mqtt)`` runs as a daemon serving notifications or a serial port.
+- ``Advertisements``: the worker consumes advertisements, of ``service_uuid`` if given, from
+  scans it runs in its polls.
+- ``ExclusiveAdapter``: with several adapters, no other worker's devices share its adapters.
+"""
+
+
+class Capability:
+    method = None  # The worker method the capability needs
+
+    def __repr__(self):
+        return "{}({})".format(
+            type(self).__name__, ", ".join("{}={!r}".format(key, value) for key, value in sorted(vars(self).items()))
+        )
+
+
+class Poll(Capability):
+    method = "status_update"
+
+    def __init__(self, cost=None, per_device=False):
+        self.cost = cost
+        self.per_device = per_device
+
+
+class Command(Capability):
+    method = "on_command"
+
+
+class Config(Capability):
+    method = "config"
+
+
+class Stream(Capability):
+    method = "run"
+
+
+class Advertisements(Capability):
+    def __init__(self, service_uuid=None):
+        self.service_uuid = service_uuid
+
+
+class ExclusiveAdapter(Capability):
+    pass
+
+
+_IMPLIED = (Poll, Command, Config, Stream)
+
+
+def of(worker):
+    """The capabilities of a worker or worker class, the declared ones or those its methods imply"""
+    declared = getattr(worker, "capabilities", None)
+    if declared is None:
+        return [kind() for kind in _IMPLIED if hasattr(worker, kind.method)]
+    for capability in declared:
+        if capability.method is not None and not hasattr(worker, capability.method):
+            raise ValueError("{!r} declares {!r} without a {} method".format(worker, capability, capability.method))
+    return list(declared)
+
+
+def find(capabilities, kind):
+    """The first capability of a kind, None when there is none"""
+    return next((capability for capability in capabilities if isinstance(capability, kind)), None)
@@ -0,0 +1,328 @@
+"""
+Capture of the raw advertisements and GATT traffic the workers see, and deterministic replay.
+
+Captures are written in a compact binary format, or as btsnoop for Wireshark. ``replay`` feeds
+a compact capture to a bluepy delegate as fast as possible, so parsers can be benchmarked and
+regression tested against real captures, and the simulator can replay one through whole workers.
+"""
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import logger
+
+_LOGGER = logger.get(__name__)
+
+MAGIC = b"BTGWCAP\x01"
+
+ADVERTISEMENT = 1
+NOTIFICATION = 2
+READ = 3
+KINDS = {"advertisement": ADVERTISEMENT, "notification": NOTIFICATION, "read": READ}
+
+_RECORD = struct.Struct("<Bd6s")  # kind, timestamp, address
+_ADVERTISEMENT = struct.Struct("<BbBH")  # address type, rssi, connectable, data length
+_GATT = struct.Struct("<HH")  # handle, data length
+
+_BTSNOOP_MAGIC = b"btsnoop\x00"
+_BTSNOOP_DATALINK_H4 = 1002
+_BTSNOOP_EPOCH_DELTA = 0x00DCDDB30F2F8000  # Microseconds from 0000-01-01 to 1970-01-01
+_BTSNOOP_RECORD = struct.Struct(">IIIIq")
+
+_recorder = None
+
+
+class Record(
+    namedtuple(
+        "Record", "kind timestamp address addr_type rssi connectable handle data"
+    )
+):
+    def scan_response(self):
+        """The scan response dict bluepy's ScanEntry is updated from"""
+        return {
+            "type": [2 if self.addr_type == "random" else 1],
+            "rssi": [-self.rssi],
+            "flag": [0 if self.connectable else 0x4],
+            "d": [self.data],
+        }
+
+    def scan_data(self):
+        ret = {}
+        data = self.data
+        while len(data) >= 2:
+            length, sdid = struct.unpack("<BB", data[:2])
+            ret[sdid] = data[2:length + 1]
+            data = data[length + 1:]
+        return ret
+
+
+def advertisement(address, addr_type, rssi, connectable, data, timestamp=None):
+    return Record(
+        ADVERTISEMENT, time.time() if timestamp is None else timestamp,
+        address.lower(), addr_type, rssi, connectable, None, bytes(data),
+    )
+
+
+def gatt(kind, address, handle, data, timestamp=None):
+    return Record(
+        kind, time.time() if timestamp is None else timestamp,
+        address.lower(), None, None, None, handle, bytes(data),
+    )
+
+
+class CompactWriter:
+    def __init__(self, f):
+        self._file = f
+        self._file.write(MAGIC)
+
+    def write(self, record):
+        header = _RECORD.pack(record.kind, record.timestamp, _pack_address(record.address))
+        if record.kind == ADVERTISEMENT:
+            body = _ADVERTISEMENT.pack(
+                2 if record.addr_type == "random" else 1,
+                max(min(record.rssi, 127), -128),
+                1 if record.connectable else 0,
+                len(record.data),
+            )
+        else:
+            body = _GATT.pack(record.handle, len(record.data))
+        self._file.write(header + body + record.data)
+
+
+class BtsnoopWriter:
+    """
+    HCI H4 packets as the controller would have sent them: LE advertising reports, a
+    connection complete event per device and ATT notifications and reads over ACL.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self._file.write(_BTSNOOP_MAGIC + struct.pack(">II", 1, _BTSNOOP_DATALINK_H4))
+        self._connections = {}
+
+    def write(self, record):
+        address = _pack_address(record.address)[::-1]
+        if record.kind == ADVERTISEMENT:
+            report = (
+                struct.pack("<BBBB", 0x02, 1, 0x00 if record.connectable else 0x03,
+                            1 if record.addr_type == "random" else 0)
+                + address
+                + struct.pack("<B", len(record.data))
+                + record.data
+                + struct.pack("<b", max(min(record.rssi, 127), -128))
+            )
+            self._packet(record.timestamp, 0x03, b"\x04\x3e" + struct.pack("<B", len(report)) + report)
+            return
+
+        connection = self._connections.get(record.address)
+        if connection is None:
+            connection = self._connections[record.address] = len(self._connections) + 0x40
+            complete = (
+                struct.pack("<BBHBB", 0x01, 0, connection, 0, 0)
+                + address
+                + struct.pack("<HHHB", 0x18, 0, 0x48, 0)
+            )
+            self._packet(record.timestamp, 0x03, b"\x04\x3e" + struct.pack("<B", len(complete)) + complete)
+
+        if record.kind == NOTIFICATION:
+            self._att(record.timestamp, 0x01, connection, struct.pack("<BH", 0x1B, record.handle) + record.data)
+        else:
+            self._att(record.timestamp, 0x00, connection, struct.pack("<BH", 0x0A, record.handle))
+            self._att(record.timestamp, 0x01, connection, b"\x0b" + record.data)
+
+    def _att(self, timestamp, flags, connection, pdu):
+        l2cap = struct.pack("<HH", len(pdu), 0x0004) + pdu
+        self._packet(
+            timestamp, flags,
+            b"\x02" + struct.pack("<HH", connection | 0x2000, len(l2cap)) + l2cap,
+        )
+
+    def _packet(self, timestamp, flags, packet):
+        self._file.write(
+            _BTSNOOP_RECORD.pack(
+                len(packet), len(packet), flags, 0,
+                int(timestamp * 1000000) + _BTSNOOP_EPOCH_DELTA,
+            )
+            + packet
+        )
+
+
+WRITERS = {"compact": CompactWriter, "btsnoop": BtsnoopWriter}
+
+
+class Recorder:
+    def __init__(self, path, format="compact", kinds=None, devices=None):
+        if format not in WRITERS:
+            raise ValueError("Unknown capture format: {}".format(format))
+        self.path = path
+        self.kinds = {KINDS[kind] for kind in kinds} if kinds else set(KINDS.values())
+        self.devices = {device.lower() for device in devices} if devices else None
+        self.count = 0
+        self._file = open(path, "wb")
+        self._writer = WRITERS[format](self._file)
+        self._lock = threading.Lock()
+
+    def wants(self, kind, address):
+        return kind in self.kinds and (
+            self.devices is None or (address is not None and address.lower() in self.devices)
+        )
+
+    def record(self, record):
+        if not self.wants(record.kind, record.address):
+            return
+        with self._lock:
+            if self._file.closed:
+                return
+            self._writer.write(record)
+            self.count += 1
+
+    def advertisement(self, entry):
+        if self.wants(ADVERTISEMENT, entry.addr) and entry.rawData is not None:
+            self.record(
+                advertisement(entry.addr, entry.addrType, entry.rssi, entry.connectable, entry.rawData)
+            )
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        _LOGGER.info("Captured %d records to %s", self.count, self.path)
+
+
+class RecordingDelegate:
+    """Records what passes through to the wrapped bluepy delegate"""
+
+    def __init__(self, delegate, recorder, address=None):
+        self._delegate = delegate
+        self._recorder = recorder
+        self._address = address
+
+    def handleDiscovery(self, entry, isNewDev, isNewData):
+        self._recorder.advertisement(entry)
+        return self._delegate.handleDiscovery(entry, isNewDev, isNewData)
+
+    def handleNotification(self, cHandle, data):
+        if self._address is not None:
+            self._recorder.record(gatt(NOTIFICATION, self._address, cHandle, data))
+        return self._delegate.handleNotification(cHandle, data)
+
+    def __getattr__(self, name):
+        return getattr(self._delegate, name)
+
+
+def setup(config):
+    global _recorder
+    stop()
+    _recorder = Recorder(
+        config.get("file", "capture.btcap"),
+        format=config.get("format", "compact"),
+        kinds=config.get("kinds"),
+        devices=config.get("devices"),
+    )
+    _LOGGER.info("Capturing BLE traffic to %s", _recorder.path)
+    return _recorder
+
+
+def stop():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+
+
+def recorder():
+    return _recorder
+
+
+def read(path):
+    """Yields the records of a compact capture in the order they were captured"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a compact capture".format(path))
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            kind, timestamp, address = _RECORD.unpack(header)
+            address = _unpack_address(address)
+            if kind == ADVERTISEMENT:
+                addr_type, rssi, connectable, length = _ADVERTISEMENT.unpack(f.read(_ADVERTISEMENT.size))
+                yield advertisement(
+                    address, "random" if addr_type == 2 else "public", rssi,
+                    bool(connectable), f.read(length), timestamp,
+                )
+            else:
+                handle, length = _GATT.unpack(f.read(_GATT.size))
+                yield gatt(kind, address, handle, f.read(length), timestamp)
+
+
+def replay(path, delegate, kinds=None, devices=None):
+    """
+    Feed the advertisements and notifications of a capture to a bluepy delegate without
+    delays, the same way Scanner and Peripheral call it. Returns the number of records fed.
+    """
+    from bluepy import btle
+
+    kinds = {KINDS[kind] for kind in kinds} if kinds else {ADVERTISEMENT, NOTIFICATION}
+    devices = {device.lower() for device in devices} if devices else None
+    entries = {}
+    count = 0
+    for record in read(path):
+        if record.kind not in kinds or (devices is not None and record.address not in devices):
+            continue
+        if record.kind == ADVERTISEMENT:
+            entry = entries.get(record.address)
+            if entry is None:
+                entry = entries[record.address] = btle.ScanEntry(record.address, 0)
+            is_new_data = entry._update(record.scan_response())
+            delegate.handleDiscovery(entry, entry.updateCount <= 1, is_new_data)
+        elif record.kind == NOTIFICATION:
+            delegate.handleNotification(record.handle, record.data)
+        else:
+            continue
+        count += 1
+    return count
+
+
+def convert(source, destination, format="btsnoop"):
+    """Convert a compact capture, e.g. to btsnoop for Wireshark"""
+    with open(destination, "wb") as f:
+        writer = WRITERS[format](f)
+        for record in read(source):
+            writer.write(record)
+
+
+def _pack_address(address):
+    return bytes(int(part, 16) for part in address.split(":"))
+
+
+def _unpack_address(data):
+    return ":".join("{:02x}".format(part) for part in data)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect and convert BLE captures")
+    subparsers = parser.add_subparsers(dest="command")
+    dump_parser = subparsers.add_parser("dump", help="Print the records of a compact capture")
+    dump_parser.add_argument("file")
+    convert_parser = subparsers.add_parser("btsnoop", help="Convert a compact capture to btsnoop")
+    convert_parser.add_argument("file")
+    convert_parser.add_argument("output")
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        names = {kind: name for name, kind in KINDS.items()}
+        for record in read(args.file):
+            if record.kind == ADVERTISEMENT:
+                details = "{} rssi={} connectable={}".format(record.addr_type, record.rssi, record.connectable)
+            else:
+                details = "handle=0x{:04x}".format(record.handle)
+            print("{:.6f} {} {} {} {}".format(
+                record.timestamp, names.get(record.kind, record.kind), record.address, details, record.data.hex()
+            ))
+    elif args.command == "btsnoop":
+        convert(args.file, args.output)
+    else:
+        parser.print_help()
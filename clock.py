@@ -0,0 +1,207 @@
+"""
+Injectable clock for everything timing related in the gateway: reading the time, sleeping,
+timeouts and the scheduler.
+
+The manager, the scheduler and the workers go through the installed clock, by default the
+system clock. A VirtualClock installed with ``install`` makes time pass only when something
+sleeps or the clock is advanced, so a day of polls, timeouts and presence expiries can be
+simulated in seconds.
+"""
+import threading
+import time as _time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+import logger
+
+_LOGGER = logger.get(__name__)
+
+
+class SystemClock:
+    virtual = False
+
+    def time(self):
+        return _time.time()
+
+    def monotonic(self):
+        return _time.monotonic()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+    def now(self):
+        return datetime.now(timezone.utc)
+
+    def timeout(self, seconds, exception):
+        from interruptingcow import timeout
+
+        return timeout(seconds, exception=exception)
+
+    def scheduler(self):
+        from scheduler import Scheduler
+
+        return Scheduler(self)
+
+
+class VirtualClock:
+    """
+    Time only moves on ``sleep`` and ``advance``. Timeouts expire when a sleep inside them
+    reaches their deadline, the way interruptingcow would interrupt a blocking call.
+    """
+
+    virtual = True
+
+    def __init__(self, start=None):
+        self._started = _time.time() if start is None else start
+        self._elapsed = 0.0
+        self._lock = threading.RLock()
+        self._deadlines = threading.local()
+        self._schedulers = []
+
+    def time(self):
+        return self._started + self._elapsed
+
+    def monotonic(self):
+        return self._elapsed
+
+    def now(self):
+        return datetime.fromtimestamp(self.time(), timezone.utc)
+
+    def sleep(self, seconds):
+        with self._lock:
+            target = self._elapsed + max(seconds, 0)
+            deadlines = getattr(self._deadlines, "stack", [])
+            expired = min(deadlines, key=lambda deadline: deadline[0], default=None)
+            if expired is not None and expired[0] <= target:
+                self._elapsed = max(self._elapsed, expired[0])
+                raise expired[1]
+            self._elapsed = target
+
+    @contextmanager
+    def timeout(self, seconds, exception):
+        stack = getattr(self._deadlines, "stack", None)
+        if stack is None:
+            stack = self._deadlines.stack = []
+        deadline = (self._elapsed + seconds, exception)
+        stack.append(deadline)
+        try:
+            yield
+        finally:
+            stack.remove(deadline)
+
+    def scheduler(self):
+        from scheduler import Scheduler
+
+        # Driven by advance and run_next instead of a thread
+        scheduler = Scheduler(self, threaded=False)
+        self._schedulers.append(scheduler)
+        return scheduler
+
+    def next_run(self):
+        """Virtual time of the earliest scheduled job, None when nothing is scheduled"""
+        runs = [s.next_run() for s in self._schedulers if s.running]
+        runs = [run for run in runs if run is not None]
+        return min(runs) if runs else None
+
+    def advance(self, seconds):
+        """Move time forward, running every scheduled job that falls due on the way"""
+        self.run_until(self._elapsed + seconds)
+
+    def run_until(self, elapsed):
+        while True:
+            next_run = self.next_run()
+            if next_run is None or next_run > elapsed:
+                break
+            self.run_next()
+        with self._lock:
+            self._elapsed = max(self._elapsed, elapsed)
+
+    def run_next(self):
+        """Jump to the earliest scheduled job and run everything due at that time"""
+        next_run = self.next_run()
+        if next_run is None:
+            return False
+        with self._lock:
+            self._elapsed = max(self._elapsed, next_run)
+        for scheduler in list(self._schedulers):
+            scheduler.run_pending()
+        return True
+
+
+_clock = SystemClock()
+if contextvars is not None:
+    # Per thread and per coroutine on the event loop, each task runs in a context of its own
+    _deadlines = contextvars.ContextVar("deadlines", default=())
+else:  # Before Python 3.7 coroutines share the deadlines of the event loop thread
+    _deadlines = None
+    _timeouts = threading.local()
+
+
+def install(clock):
+    global _clock
+    _clock = clock
+    _LOGGER.debug("Using %s", type(clock).__name__)
+    return clock
+
+
+def get():
+    return _clock
+
+
+def time():
+    return _clock.time()
+
+
+def monotonic():
+    return _clock.monotonic()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+
+def now():
+    return _clock.now()
+
+
+def _stack():
+    if _deadlines is not None:
+        return _deadlines.get()
+    return getattr(_timeouts, "stack", ())
+
+
+def _set_stack(stack):
+    if _deadlines is not None:
+        _deadlines.set(stack)
+    else:
+        _timeouts.stack = stack
+
+
+@contextmanager
+def deadline(seconds):
+    """A deadline ``remaining`` counts down to, the caller enforces it like the event loop does"""
+    previous = _stack()
+    _set_stack(previous + (_clock.monotonic() + seconds,))
+    try:
+        yield
+    finally:
+        _set_stack(previous)
+
+
+@contextmanager
+def timeout(seconds, exception=RuntimeError):
+    with deadline(seconds), _clock.timeout(seconds, exception):
+        yield
+
+
+def remaining():
+    """Seconds until the first of the current timeouts or deadlines expires, None outside of them"""
+    stack = _stack()
+    if not stack:
+        return None
+    return min(stack) - _clock.monotonic()
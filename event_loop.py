@@ -0,0 +1,117 @@
+"""
+The asyncio event loop for workers written as coroutines.
+
+Worker methods may be ``async def``: ``status_update`` and ``config`` as coroutines returning
+their messages or as async generators yielding them, ``on_command`` as a coroutine and
+``run(mqtt)`` as a coroutine serving a daemon. They all run on one event loop in a background
+thread, so hundreds of mostly idle notification or serial streams take a single thread instead
+of one each. Blocking calls, like bluepy's, go through ``BaseWorker.blocking`` to a thread pool
+so they don't hold up the other coroutines. Synchronous workers run as before.
+"""
+import asyncio
+import concurrent.futures
+import inspect
+import sys
+import threading
+from functools import partial
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+import clock
+import logger
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_THREADS = 8  # Blocking calls of coroutine workers running at once
+STALL_GRACE = 5  # In seconds, after the timeout for a coroutine that blocks the loop
+
+_settings = {"threads": DEFAULT_THREADS}
+_loop = None
+_lock = threading.Lock()
+
+
+def setup(config):
+    _settings.update(threads=config.get("threads", DEFAULT_THREADS))
+
+
+def settings():
+    """The settings to set up a worker process with"""
+    return dict(_settings)
+
+
+def is_async(callback):
+    """Whether a worker method is a coroutine or async generator function"""
+    return inspect.iscoroutinefunction(callback) or _is_async_generator(callback)
+
+
+def _is_async_generator(callback):
+    # Async generators came with Python 3.6
+    return getattr(inspect, "isasyncgenfunction", lambda func: False)(callback)
+
+
+def get():
+    """The event loop, started in its own thread on first use"""
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            # Python 3.5 doesn't name the threads of a pool
+            names = {"thread_name_prefix": "blocking"} if sys.version_info >= (3, 6) else {}
+            loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(_settings["threads"], **names))
+            threading.Thread(target=loop.run_forever, daemon=True, name="event-loop").start()
+            _loop = loop
+        return _loop
+
+
+def execute(callback, args, timeout, messages, exception):
+    """
+    Runs ``callback(*args)`` on the loop and returns its messages. The messages of an async
+    generator are added to ``messages`` as they come, so they are kept when ``exception`` is
+    raised after ``timeout`` seconds.
+    """
+
+    async def collect():
+        # Enforced by wait_for, the deadline lets poll_devices and retry see the time left
+        with clock.deadline(timeout):
+            if _is_async_generator(callback):
+                async for message in callback(*args):
+                    messages.extend(message)
+                return messages
+            return await callback(*args)
+
+    future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(collect(), timeout), get())
+    try:
+        # The loop enforces the timeout, unless a coroutine blocks it
+        return future.result(timeout + STALL_GRACE)
+    except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+        future.cancel()
+        raise exception
+
+
+def spawn(name, coroutine):
+    """Runs a daemon coroutine on the loop, logging how it ended"""
+    future = asyncio.run_coroutine_threadsafe(coroutine, get())
+    future.add_done_callback(partial(_ended, name))
+    return future
+
+
+def _ended(name, future):
+    if future.cancelled():
+        return
+    exception = future.exception()
+    if exception is not None:
+        logger.log_exception(_LOGGER, "Daemon %s stopped: %s", name, type(exception).__name__, exc_info=exception)
+    else:
+        _LOGGER.debug("Daemon %s finished", name)
+
+
+def blocking(func, *args, **kwargs):
+    """Awaitable running a blocking ``func(*args, **kwargs)`` in the loop's thread pool"""
+    call = partial(func, *args, **kwargs)
+    if contextvars is not None:
+        # Keeps the deadline of the calling coroutine, see clock.remaining
+        call = partial(contextvars.copy_context().run, call)
+    return get().run_in_executor(None, call)
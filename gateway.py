@@ -16,6 +16,8 @@ import logging
 import argparse
 import queue
 
+import capture
+import profiling
 from workers_queue import _WORKERS_QUEUE
 from mqtt import MqttClient
 from workers_manager import WorkersManager
@@ -48,6 +50,29 @@ parser.add_argument(
 )
 parser.add_argument("-r", "--requirements", type=str, choices=['all', 'configured'],
                     help="Print all or configured only required python libs")
+parser.add_argument(
+    "--profile",
+    type=float,
+    metavar="SECONDS",
+    help="Profile all commands and threads for the given number of seconds after start",
+)
+parser.add_argument(
+    "--profile-commands",
+    nargs="+",
+    metavar="PATTERN",
+    help="Profile only commands matching these patterns, e.g. 'MifloraWorker.*'",
+)
+parser.add_argument(
+    "--profile-count",
+    type=int,
+    metavar="N",
+    help="Stop profiling after N profiled command executions",
+)
+parser.add_argument(
+    "--profile-dir",
+    default=profiling.DEFAULT_OUTPUT_DIR,
+    help="Directory for pstats and collapsed stack files (default: %(default)s)",
+)
 parsed = parser.parse_args()
 
 if parsed.requirements:
@@ -71,21 +96,52 @@ elif parsed.debug:
 else:
     _LOGGER.setLevel(logging.INFO)
 logger.suppress_update_failures(parsed.suppress)
+logger.summarize_repeated_failures(
+    settings["manager"].get("repeated_failures_interval", logger.DEFAULT_REPEATED_FAILURES_INTERVAL)
+)
 
 _LOGGER.info("Starting")
 
 global_topic_prefix = settings["mqtt"].get("topic_prefix")
 
-mqtt = MqttClient(settings["mqtt"])
+if parsed.profile or parsed.profile_commands:
+    profiling.start(
+        parsed.profile_dir,
+        duration=parsed.profile,
+        commands=parsed.profile_commands,
+        count=parsed.profile_count,
+    )
+
+if "simulation" in settings:
+    import simulator
+
+    if settings["simulation"].get("virtual_clock", False):
+        import clock
+
+        clock.install(clock.VirtualClock())
+    simulator.install(settings["simulation"], settings["manager"]["workers"])
+    if settings["simulation"].get("local_mqtt", True):
+        mqtt = simulator.LocalMqttClient(settings["mqtt"])
+    else:
+        mqtt = MqttClient(settings["mqtt"])
+else:
+    mqtt = MqttClient(settings["mqtt"])
 manager = WorkersManager(settings["manager"])
 manager.register_workers(global_topic_prefix)
 manager.start(mqtt)
 
+if "simulation" in settings and settings["simulation"].get("virtual_clock", False):
+    simulator.run_virtual(mqtt, settings["simulation"].get("duration", simulator.DEFAULT_DURATION))
+    capture.stop()
+    sys.exit(0)
+
 running = True
 
 while running:
     try:
-        mqtt.publish(_WORKERS_QUEUE.get(timeout=10).execute())
+        command = _WORKERS_QUEUE.get(timeout=10)
+        with command.traced(), profiling.profile(command.source):
+            mqtt.publish(command.execute())
     except queue.Empty:  # Allow for SIGINT processing
         pass
     except (WorkerTimeoutError, DeviceTimeoutError) as e:
@@ -96,6 +152,8 @@ while running:
         )
     except (KeyboardInterrupt, SystemExit):
         running = False
+        profiling.stop()
+        capture.stop()
         _LOGGER.info(
             "Finish current jobs and shut down. If you need force exit use kill"
         )
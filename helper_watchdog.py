@@ -0,0 +1,243 @@
+"""
+Watchdog for bluepy-helper processes.
+
+A bluepy-helper that stops answering blocks a connect or read until the command timeout, and
+may keep its adapter in a bad state after that. Through the bluepy hooks every request to a
+helper is registered here with a deadline: its own timeout, or ``request_timeout`` when it has
+none, plus ``grace``. A helper still busy past its deadline, or interrupted by a command
+timeout, is killed, which fails the blocked request right away. So is the helper of a bluepy
+object dropped without stopping it, like a scanner after a failed scan. With a ``reset``
+section, when most requests on an adapter failed within ``reset.window`` seconds, the adapter
+is reset with ``reset.command`` and its helpers are killed, so the workers reconnect through a
+fresh controller. The watchdog runs with a ``watchdog`` section in the manager config only.
+"""
+import collections
+import shlex
+import subprocess
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from exceptions import DeviceTimeoutError, WorkerTimeoutError
+import clock
+import logger
+import metrics
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_GRACE = 5  # In seconds
+DEFAULT_REQUEST_TIMEOUT = 20  # In seconds
+DEFAULT_RESET_WINDOW = 600  # In seconds
+DEFAULT_RESET_MIN_FAILURES = 20
+DEFAULT_RESET_FAILURE_RATE = 0.9
+DEFAULT_RESET_COMMAND = "hciconfig {adapter} reset"
+CHECK_INTERVAL = 1  # In seconds
+RESET_COMMAND_TIMEOUT = 30  # In seconds
+
+_settings = {
+    "enabled": False,
+    "grace": DEFAULT_GRACE,
+    "request_timeout": DEFAULT_REQUEST_TIMEOUT,
+    "reset": {
+        "enabled": False,
+        "window": DEFAULT_RESET_WINDOW,
+        "min_failures": DEFAULT_RESET_MIN_FAILURES,
+        "failure_rate": DEFAULT_RESET_FAILURE_RATE,
+        "command": DEFAULT_RESET_COMMAND,
+    },
+}
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_thread = None
+_helpers = weakref.WeakSet()  # bluepy objects that started a helper
+_requests = {}  # Running requests by bluepy object id
+_results = collections.defaultdict(collections.deque)  # (time, failed) per adapter
+_last_reset = {}
+_pending_resets = set()
+
+
+class _Request:
+    def __init__(self, owner, operation, device, iface, deadline):
+        self.owner = owner
+        self.operation = operation
+        self.device = device
+        self.iface = iface
+        self.deadline = deadline
+        self.killed = False
+
+
+def setup(config):
+    global _thread
+    # Resetting the host's adapter is up to the user, a reset section turns it on
+    reset = dict(_settings["reset"], enabled="reset" in config)
+    reset.update(config.get("reset") or {})
+    _settings.update(
+        enabled=config.get("enabled", True),
+        grace=config.get("grace", DEFAULT_GRACE),
+        request_timeout=config.get("request_timeout", DEFAULT_REQUEST_TIMEOUT),
+        reset=reset,
+    )
+    if _settings["enabled"] and _thread is None:
+        _thread = threading.Thread(target=_run, name="watchdog", daemon=True)
+        _thread.start()
+
+
+def settings():
+    """The settings to set up a worker process with"""
+    return dict(_settings)
+
+
+def started(owner, iface):
+    """Tracks the helper a bluepy object started on hci<iface>"""
+    owner._watchdog_iface = iface
+    _helpers.add(owner)
+    # The helper current when the owner is dropped, a scanner dropped after a failed scan never stops it
+    current = getattr(owner, "_watchdog_helper", None)
+    if current is None:
+        current = owner._watchdog_helper = [None]
+        weakref.finalize(owner, _orphaned, current, iface, type(owner).__name__)
+    current[0] = getattr(owner, "_helper", None)
+
+
+def _orphaned(current, iface, owner):
+    helper = current[0]
+    if helper is not None and helper.poll() is None:
+        _LOGGER.debug("Killing bluepy-helper of a discarded %s on hci%d", owner, iface)
+        helper.kill()
+        helper.wait()
+        metrics.BLE_HELPER_KILLS.inc("hci{}".format(iface), "orphaned")
+
+
+@contextmanager
+def request(owner, operation, device, iface, timeout=None):
+    """Watches a request to the helper of ``owner``, killing it when it runs past its deadline"""
+    if not _settings["enabled"]:
+        yield
+        return
+    reap(owner)
+    if timeout is None:
+        timeout = _settings["request_timeout"]
+    entry = _Request(owner, operation, device, iface, time.monotonic() + timeout + _settings["grace"])
+    with _lock:
+        _requests[id(owner)] = entry
+    failed = True
+    try:
+        yield
+        failed = False
+    except (DeviceTimeoutError, WorkerTimeoutError):
+        # The helper is still busy with the request, its answer would confuse the next one
+        if not entry.killed:
+            _kill(owner, iface, "interrupted", device)
+        reap(owner)
+        raise
+    except Exception as e:
+        reap(owner)
+        if entry.killed:
+            raise DeviceTimeoutError(
+                "bluepy-helper hung during {} of {}".format(operation, device or "scan")
+            ) from e
+        raise
+    finally:
+        with _lock:
+            _requests.pop(id(owner), None)
+        _record(iface, failed)
+
+
+def reap(owner):
+    """Forgets a helper of ``owner`` that exited, so the next request starts a fresh one"""
+    helper = getattr(owner, "_helper", None)
+    if helper is None or helper.poll() is None:
+        return
+    owner._helper = None
+    for stream in (getattr(helper, "stdin", None), getattr(helper, "stdout", None)):
+        if stream is not None:
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+def _kill(owner, iface, reason, device=None):
+    helper = getattr(owner, "_helper", None)
+    if helper is None or helper.poll() is not None:
+        return False
+    _LOGGER.warning(
+        "Killing %s bluepy-helper of %s on hci%d", reason, device or type(owner).__name__, iface
+    )
+    helper.kill()
+    helper.wait()
+    metrics.BLE_HELPER_KILLS.inc("hci{}".format(iface), reason)
+    return True
+
+
+def _record(iface, failed):
+    reset = _settings["reset"]
+    if not reset["enabled"] or not reset["window"]:
+        return
+    # Gateway time, unlike the deadlines of requests that block the real one
+    now = clock.monotonic()
+    with _lock:
+        results = _results[iface]
+        results.append((now, failed))
+        while results[0][0] < now - reset["window"]:
+            results.popleft()
+        failures = sum(1 for _, result in results if result)
+        if (
+            failures >= reset["min_failures"]
+            and failures >= reset["failure_rate"] * len(results)
+            and now - _last_reset.get(iface, float("-inf")) >= reset["window"]
+        ):
+            _last_reset[iface] = now
+            results.clear()
+            _pending_resets.add(iface)
+            _wakeup.set()
+
+
+def _run():
+    while True:
+        _wakeup.wait(CHECK_INTERVAL)
+        _wakeup.clear()
+        try:
+            _check()
+        except Exception:
+            logger.log_exception(_LOGGER, "Watchdog check failed")
+
+
+def _check():
+    now = time.monotonic()
+    with _lock:
+        hung = [entry for entry in _requests.values() if not entry.killed and entry.deadline < now]
+        resets = set(_pending_resets)
+        _pending_resets.clear()
+    for entry in hung:
+        # Marked first, the request fails as soon as its helper is gone
+        entry.killed = True
+        entry.killed = _kill(entry.owner, entry.iface, "hung", entry.device)
+    for iface in resets:
+        _reset(iface)
+
+
+def _reset(iface):
+    from bluepy import btle
+
+    adapter = "hci{}".format(iface)
+    _LOGGER.warning("Resetting %s after most requests on it failed", adapter)
+    metrics.BLE_ADAPTER_RESETS.inc(adapter)
+    for owner in list(_helpers):
+        if getattr(owner, "_watchdog_iface", None) == iface:
+            with _lock:
+                entry = _requests.get(id(owner))
+            if entry is not None:
+                entry.killed = True
+            killed = _kill(owner, iface, "reset")
+            if entry is not None:
+                entry.killed = killed
+    if getattr(btle, "SIMULATED", False):
+        return
+    command = shlex.split(_settings["reset"]["command"].format(adapter=adapter, iface=iface))
+    try:
+        # Not capture_output, which needs Python 3.7
+        subprocess.run(command, timeout=RESET_COMMAND_TIMEOUT, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.SubprocessError) as e:
+        _LOGGER.error("Resetting %s failed: %s", adapter, e)
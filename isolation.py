@@ -0,0 +1,680 @@
+"""
+Optional process isolation for workers.
+
+With an ``isolation`` section in the manager config, every worker, or group of workers, runs
+in its own subprocess. The manager gets a stand-in for each isolated worker that forwards its
+commands over a pipe. Every process has its own command queue and thread in the gateway, so
+workers in different processes poll in parallel and can be pinned to separate CPU cores.
+
+A process that does not answer within the command timeout plus ``hang_grace`` is killed
+together with the bluepy-helpers it started, a process that died is restarted with an
+exponential backoff.
+"""
+import atexit
+import itertools
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection
+
+from exceptions import DeviceTimeoutError, WorkerProcessError, WorkerTimeoutError
+from workers_queue import CommandQueue
+import arbiter
+import capabilities
+import clock
+import event_loop
+import helper_watchdog
+import logger
+import metrics
+import profiling
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_HANG_GRACE = 10  # In seconds
+DEFAULT_RESTART_DELAY = 1  # In seconds
+DEFAULT_MAX_RESTART_DELAY = 300  # In seconds
+STARTUP_TIMEOUT = 120  # In seconds, importing worker libraries is slow on a Pi Zero
+
+WORKER_METHODS = ("status_update", "config", "on_command", "run")
+_REMOTE_EXCEPTIONS = {
+    "WorkerTimeoutError": WorkerTimeoutError,
+    "DeviceTimeoutError": DeviceTimeoutError,
+}
+
+
+def groups(config, workers_config):
+    """Maps every process name to the workers it runs, by default one process per worker"""
+    excluded = set(config.get("exclude", []))
+    result = {}
+    grouped = set()
+    for name, group in config.get("groups", {}).items():
+        members = [
+            worker
+            for worker in group.get("workers", [])
+            if worker in workers_config and worker not in excluded and worker not in grouped
+        ]
+        if members:
+            result[name] = dict(group, workers=members)
+            grouped.update(members)
+    for worker in workers_config:
+        if worker not in excluded and worker not in grouped:
+            result[worker] = {"workers": [worker]}
+    return result
+
+
+class Supervisor:
+    def __init__(
+        self, config, workers_config, command_timeout, global_topic_prefix, adapters_config=None, declared=None
+    ):
+        self._processes = {}
+        self._workers = {}
+        self._sharding = None
+        self._stopped = threading.Event()
+        settings = {
+            "command_timeout": command_timeout,
+            "global_topic_prefix": global_topic_prefix,
+            "simulation": _simulation_config(),
+            # Every process simulates all devices, so every adapter can hear all of them
+            "simulated_workers": workers_config,
+        }
+        if adapters_config is not None:
+            import adapters
+
+            excluded = set(config.get("exclude", []))
+            self._sharding = adapters.Sharding(
+                adapters_config,
+                {name: worker for name, worker in workers_config.items() if name not in excluded},
+                declared,
+            )
+            specs = self._sharding.processes()
+        else:
+            specs = {
+                name: dict(group, workers={worker: workers_config[worker] for worker in group["workers"]})
+                for name, group in groups(config, workers_config).items()
+            }
+        for name, spec in specs.items():
+            process = WorkerProcess(
+                name,
+                dict(settings, workers=spec["workers"], adapter=spec.get("adapter")),
+                hang_grace=config.get("hang_grace", DEFAULT_HANG_GRACE),
+                restart_delay=config.get("restart_delay", DEFAULT_RESTART_DELAY),
+                max_restart_delay=config.get("max_restart_delay", DEFAULT_MAX_RESTART_DELAY),
+                cpus=spec.get("cpus"),
+            )
+            self._processes[name] = process
+            for worker in spec["workers"]:
+                self._workers.setdefault(worker, []).append(process)
+        atexit.register(self.stop)
+
+    def queue_depths(self):
+        """The commands waiting in every process' lane, by process name"""
+        return {name: process.queue_depth() for name, process in self._processes.items()}
+
+    def isolates(self, worker_name):
+        return worker_name in self._workers
+
+    def workers(self, worker_name):
+        """The stand-ins for an isolated worker, one per process running it"""
+        stand_ins = []
+        for process in self._workers[worker_name]:
+            if process.capabilities is None:
+                process.start()
+            stand_ins.append(process.remote_worker(worker_name))
+        return stand_ins
+
+    def start(self, mqtt):
+        for process in self._processes.values():
+            process.start_lane(mqtt)
+        if self._sharding is not None and self._sharding.rebalance_interval:
+            threading.Thread(target=self._rebalance_loop, daemon=True, name="rebalance").start()
+
+    def stop(self):
+        self._stopped.set()
+        for process in self._processes.values():
+            process.stop()
+
+    def rebalance(self):
+        """Surveys every adapter and restarts the processes whose devices moved"""
+        surveys = {}
+        for process in self._processes.values():
+            surveys[process.settings["adapter"]] = process.submit_survey(self._sharding.survey_duration)
+        rssi = {}
+        for iface, survey in surveys.items():
+            try:
+                rssi[iface] = survey.get(timeout=self._sharding.survey_duration + 2 * DEFAULT_HANG_GRACE)
+            except queue.Empty:
+                rssi[iface] = {}
+        for name in self._sharding.rebalance(rssi, self.costs()):
+            process = self._processes[name]
+            process.reconfigure(self._sharding.workers(process.settings["adapter"]))
+
+    def costs(self):
+        """Seconds a poll took per device of every worker, over all processes"""
+        seconds, devices = {}, {}
+        for process in self._processes.values():
+            for worker, (worker_seconds, worker_devices) in process.load.items():
+                seconds[worker] = seconds.get(worker, 0.0) + worker_seconds
+                devices[worker] = devices.get(worker, 0) + worker_devices
+        return {worker: seconds[worker] / devices[worker] for worker in seconds if devices[worker]}
+
+    def _rebalance_loop(self):
+        # The first round runs after one interval of polls, so the costs are known
+        while not self._stopped.wait(self._sharding.rebalance_interval):
+            try:
+                self.rebalance()
+            except Exception as e:
+                logger.log_exception(_LOGGER, "Rebalancing adapters failed: %s", type(e).__name__)
+
+
+class RemoteWorker:
+    """Stands in for a worker running in a WorkerProcess, named after the worker's class"""
+
+    def __init__(self, name, process, capabilities):
+        self._name = name
+        self.process = process
+        self.command_timeout = capabilities["command_timeout"]
+        self.topic_prefix = capabilities["topic_prefix"]
+        self.capabilities = capabilities["declared"]
+        for method in capabilities["methods"]:
+            if method == "run":
+                self.run = self._run
+            else:
+                setattr(self, method, _RemoteMethod(self, method))
+
+    @property
+    def devices(self):
+        """The devices this stand-in polls, None for a worker without a devices list"""
+        return self.process.devices(self._name)
+
+    def format_topic(self, *topic_args):
+        return "/".join([self.topic_prefix, *topic_args])
+
+    def _run(self, mqtt):
+        self.process.run_daemon(self._name, mqtt)
+
+    def __repr__(self):
+        return self._name
+
+
+class _RemoteMethod:
+    def __init__(self, worker, name):
+        self.__self__ = worker
+        self.__name__ = name
+
+    @property
+    def lane(self):
+        return self.__self__.process
+
+    def __call__(self, *args):
+        return self.lane.execute(self, args, self.__self__.command_timeout)
+
+
+class WorkerProcess:
+    def __init__(
+        self,
+        name,
+        settings,
+        hang_grace=DEFAULT_HANG_GRACE,
+        restart_delay=DEFAULT_RESTART_DELAY,
+        max_restart_delay=DEFAULT_MAX_RESTART_DELAY,
+        cpus=None,
+    ):
+        self.name = name
+        self.capabilities = None
+        self.settings = settings
+        self.load = {}  # worker -> (seconds spent polling, devices polled)
+        self._hang_grace = hang_grace
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._cpus = cpus
+        self._lock = threading.RLock()
+        self._requests = itertools.count()
+        self._replies = {}
+        self._popen = None
+        self._conn = None
+        self._kill_reason = None
+        self._failures = 0
+        self._restart_timer = None
+        self._stopped = False
+        self._daemons = []
+        self._mqtt = None
+        self._commands = CommandQueue()
+        self._remote_workers = {}
+
+    @property
+    def pid(self):
+        popen = self._popen
+        return popen.pid if popen is not None else None
+
+    def start(self):
+        parent_conn, child_conn = Pipe()
+        settings = dict(
+            self.settings,
+            log_level=logger.get().getEffectiveLevel(),
+            suppress=logger.SUPPRESSION_ENABLED,
+            repeated_failures_interval=logger.repeated_failures_interval(),
+            arbitration=arbiter.settings(),
+            watchdog=helper_watchdog.settings(),
+            event_loop=event_loop.settings(),
+        )
+        popen = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(child_conn.fileno())],
+            pass_fds=[child_conn.fileno()],
+            # Its own process group, so a hung process is killed with its bluepy-helpers
+            start_new_session=True,
+        )
+        child_conn.close()
+        if self._cpus and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(popen.pid, self._cpus)
+
+        try:
+            parent_conn.send(("setup", settings))
+            if not parent_conn.poll(STARTUP_TIMEOUT):
+                raise WorkerProcessError("Worker process {} did not start within {} seconds".format(
+                    self.name, STARTUP_TIMEOUT
+                ))
+            kind, payload = parent_conn.recv()
+            if kind != "ready":
+                raise WorkerProcessError("Worker process {} failed to set up: {}".format(self.name, payload))
+        except (EOFError, OSError, WorkerProcessError) as e:
+            _kill_group(popen)
+            parent_conn.close()
+            if isinstance(e, WorkerProcessError):
+                raise
+            raise WorkerProcessError("Worker process {} exited during setup".format(self.name))
+
+        with self._lock:
+            self.capabilities = payload
+            self._popen = popen
+            self._conn = parent_conn
+            self._kill_reason = None
+            for worker in self._daemons:
+                parent_conn.send(("run", worker))
+        threading.Thread(
+            target=self._read, args=(popen, parent_conn), daemon=True, name="process-{}".format(self.name)
+        ).start()
+        _LOGGER.info("Started worker process %s (pid %d) for %s", self.name, popen.pid, ", ".join(payload))
+
+    def remote_worker(self, worker_name):
+        if worker_name not in self._remote_workers:
+            capabilities = self.capabilities[worker_name]
+            klass = type(capabilities["class"], (RemoteWorker,), {})
+            self._remote_workers[worker_name] = klass(worker_name, self, capabilities)
+        return self._remote_workers[worker_name]
+
+    def start_lane(self, mqtt):
+        self._mqtt = mqtt
+        threading.Thread(target=self._run_lane, daemon=True, name="lane-{}".format(self.name)).start()
+
+    def submit(self, command):
+        self._commands.put(command)
+
+    def queue_depth(self):
+        return self._commands.qsize()
+
+    def devices(self, worker_name):
+        devices = self.settings["workers"][worker_name]["args"].get("devices")
+        return list(devices) if isinstance(devices, dict) else None
+
+    def execute(self, method, args, timeout):
+        """Runs a worker method in the process, the process enforces the timeout itself"""
+        worker = repr(method.__self__)
+        description = "{}.{}".format(method.__self__.__class__.__name__, method.__name__)
+        if method.__name__ == "status_update" and self.devices(worker) == []:
+            # All devices of this shard moved to other adapters
+            return []
+        return self._request(("execute", worker, method.__name__, list(args), timeout), timeout, description)
+
+    def submit_survey(self, seconds):
+        """Queues a scan of the process' adapter, the returned queue gets the RSSI per MAC"""
+        result = queue.Queue(1)
+
+        def survey():
+            try:
+                result.put(self._request(("survey", seconds), seconds, "survey"))
+            except WorkerProcessError as e:
+                logger.log_exception(_LOGGER, "%s", e, suppress=True)
+                result.put({})
+
+        self.submit(survey)
+        return result
+
+    def reconfigure(self, workers):
+        """Restarts the process with new worker configs once the commands queued before are done"""
+
+        def replace():
+            with self._lock:
+                self.settings = dict(self.settings, workers=workers)
+                conn, popen = self._conn, self._popen
+                self._conn = self._popen = None
+                if self._restart_timer is not None:
+                    self._restart_timer.cancel()
+            if popen is not None:
+                _kill_group(popen)
+                conn.close()
+            try:
+                self.start()
+            except WorkerProcessError as e:
+                logger.log_exception(_LOGGER, "%s", e, suppress=True)
+                self._restart()
+
+        self.submit(replace)
+
+    def _request(self, message, timeout, description):
+        with self._lock:
+            conn = self._conn
+            if conn is None:
+                raise WorkerProcessError("Worker process {} is restarting, skipped {}".format(self.name, description))
+            request = next(self._requests)
+            reply = self._replies[request] = queue.Queue(1)
+            try:
+                conn.send((message[0], request) + message[1:])
+            except OSError:
+                self._replies.pop(request, None)
+                raise WorkerProcessError("Worker process {} exited, skipped {}".format(self.name, description))
+
+        deadline = timeout + self._hang_grace
+        try:
+            message = reply.get(timeout=deadline)
+        except queue.Empty:
+            self._replies.pop(request, None)
+            self._kill(conn, "did not finish {} within {} seconds".format(description, deadline))
+            raise WorkerProcessError("Aborted {}, worker process {} hung".format(description, self.name))
+
+        if message is None:
+            raise WorkerProcessError("Worker process {} exited while running {}".format(self.name, description))
+        _, _, succeeded, payload = message
+        if succeeded:
+            self._failures = 0
+            return payload
+        name, text, formatted = payload
+        if name in _REMOTE_EXCEPTIONS:
+            raise _REMOTE_EXCEPTIONS[name](text)
+        _LOGGER.debug("Worker process %s traceback:\n%s", self.name, formatted)
+        raise WorkerProcessError("{} raised {}: {}".format(description, name, text))
+
+    def run_daemon(self, worker_name, mqtt):
+        with self._lock:
+            self._mqtt = mqtt
+            self._daemons.append(worker_name)
+            if self._conn is not None:
+                self._conn.send(("run", worker_name))
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            if self._restart_timer is not None:
+                self._restart_timer.cancel()
+            conn, popen = self._conn, self._popen
+            self._conn = self._popen = None
+        if popen is not None and popen.poll() is None:
+            _kill_group(popen)
+        if conn is not None:
+            conn.close()
+
+    def _run_lane(self):
+        while True:
+            command = self._commands.get()
+            if callable(command):
+                # Surveys and restarts run between commands, so they never overlap one
+                command()
+                continue
+            started = time.monotonic()
+            try:
+                with command.traced(), profiling.profile(command.source):
+                    self._mqtt.publish(command.execute())
+            except (WorkerTimeoutError, DeviceTimeoutError, WorkerProcessError) as e:
+                logger.log_exception(
+                    _LOGGER,
+                    str(e) if str(e) else "Timeout while executing worker command",
+                    suppress=True,
+                )
+            except Exception as e:
+                logger.log_exception(
+                    _LOGGER, "Error while executing worker command %s: %s", command.source, type(e).__name__
+                )
+            finally:
+                self._record_load(command, time.monotonic() - started)
+
+    def _record_load(self, command, seconds):
+        method = command.callback
+        if command.shed is not None or getattr(method, "__name__", None) != "status_update":
+            return
+        worker = repr(method.__self__)
+        devices = command.devices if command.devices is not None else self.devices(worker)
+        polled = len(devices) if devices is not None else 1
+        if polled:
+            total, count = self.load.get(worker, (0.0, 0))
+            self.load[worker] = (total + seconds, count + polled)
+
+    def _read(self, popen, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == "reply":
+                reply = self._replies.pop(message[1], None)
+                if reply is not None:
+                    reply.put(message)
+            elif message[0] == "device_results":
+                # Sent ahead of the reply, so the stats count a poll's results once it returned
+                for key, amount in message[1].items():
+                    metrics.DEVICE_RESULTS.inc(*key, amount=amount)
+            elif message[0] == "publish" and self._mqtt is not None:
+                try:
+                    self._mqtt.publish(message[1])
+                except Exception as e:
+                    logger.log_exception(_LOGGER, "Failed to publish for worker process %s: %s", self.name, e)
+        self._exited(popen, conn)
+
+    def _kill(self, conn, reason):
+        with self._lock:
+            if conn is not self._conn:
+                return
+            # Nothing more is sent to it, the reader thread schedules the restart
+            self._conn = None
+            self._kill_reason = reason
+            popen = self._popen
+        _kill_group(popen)
+
+    def _exited(self, popen, conn):
+        popen.wait()
+        with self._lock:
+            if popen is not self._popen:
+                return
+            self._conn = None
+            conn.close()
+            for request in list(self._replies):
+                self._replies.pop(request).put(None)
+            if self._stopped:
+                return
+            self._failures += 1
+            delay = min(self._restart_delay * 2 ** (self._failures - 1), self._max_restart_delay)
+            logger.log_exception(
+                _LOGGER,
+                "Worker process %s %s, restarting in %d seconds",
+                self.name,
+                self._kill_reason or "exited with code {}".format(popen.returncode),
+                delay,
+                suppress=True,
+            )
+            self._restart_timer = threading.Timer(delay, self._restart)
+            self._restart_timer.daemon = True
+            self._restart_timer.start()
+
+    def _restart(self):
+        with self._lock:
+            if self._stopped:
+                return
+        try:
+            self.start()
+        except WorkerProcessError as e:
+            self._failures += 1
+            delay = min(self._restart_delay * 2 ** (self._failures - 1), self._max_restart_delay)
+            logger.log_exception(_LOGGER, "%s, retrying in %d seconds", e, delay, suppress=True)
+            with self._lock:
+                if not self._stopped:
+                    self._restart_timer = threading.Timer(delay, self._restart)
+                    self._restart_timer.daemon = True
+                    self._restart_timer.start()
+
+
+def _kill_group(popen):
+    try:
+        os.killpg(popen.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    popen.wait()
+
+
+def _simulation_config():
+    """Isolated workers of a simulated gateway simulate their own devices with the same settings"""
+    simulator = sys.modules.get("simulator")
+    if simulator is None or simulator.farm() is None:
+        return None
+    return simulator.farm().config
+
+
+def _capabilities(worker):
+    return {
+        "class": type(worker).__name__,
+        "methods": [method for method in WORKER_METHODS if hasattr(worker, method)],
+        "topic_prefix": getattr(worker, "topic_prefix", None),
+        "command_timeout": worker.command_timeout,
+        "declared": capabilities.of(worker),
+    }
+
+
+def _create_workers(settings):
+    import importlib
+
+    workers = {}
+    for name, worker_config in settings["workers"].items():
+        module_obj = importlib.import_module("workers.%s" % name)
+        klass = getattr(module_obj, "%sWorker" % name.title())
+        workers[name] = klass(
+            worker_config.get("command_timeout", settings["command_timeout"]),
+            settings["global_topic_prefix"],
+            **worker_config["args"]
+        )
+    return workers
+
+
+def _survey(seconds):
+    """RSSI of every device the process' adapter hears within the given seconds"""
+    from bluepy import btle
+
+    import bluepy_hooks
+
+    bluepy_hooks.install()
+    with clock.timeout(seconds + DEFAULT_HANG_GRACE, WorkerTimeoutError("Survey scan timed out")):
+        devices = btle.Scanner().scan(seconds)
+    return {device.addr.upper(): device.rssi for device in devices}
+
+
+def _device_results(sent):
+    """The DEVICE_RESULTS increments since the values in ``sent``, which are updated"""
+    increments = {}
+    for key, value in metrics.DEVICE_RESULTS.items():
+        if value != sent.get(key, 0):
+            increments[key] = value - sent.get(key, 0)
+            sent[key] = value
+    return increments
+
+
+class _Publisher:
+    """The MQTT client handed to daemon workers, publishes through the gateway"""
+
+    def __init__(self, send):
+        self._send = send
+
+    def publish(self, messages):
+        self._send(("publish", messages))
+
+
+def _child(fd):
+    conn = Connection(fd)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    sent_results = {}
+
+    def reply(request, *result):
+        increments = _device_results(sent_results)
+        if increments:
+            send(("device_results", increments))
+        send(("reply", request) + result)
+
+    _, settings = conn.recv()
+    logger.setup()
+    logger.get().setLevel(settings["log_level"])
+    if settings["log_level"] <= logging.DEBUG:
+        logger.enable_debug_formatter()
+    logger.suppress_update_failures(settings["suppress"])
+    logger.summarize_repeated_failures(settings["repeated_failures_interval"])
+
+    arbiter.setup(settings["arbitration"])
+    helper_watchdog.setup(settings["watchdog"])
+    event_loop.setup(settings["event_loop"])
+    try:
+        if settings.get("adapter") is not None:
+            import bluepy_hooks
+
+            bluepy_hooks.use_adapter(settings["adapter"])
+        if settings["simulation"] is not None:
+            import simulator
+
+            simulator.install(settings["simulation"], settings.get("simulated_workers", settings["workers"]))
+        workers = _create_workers(settings)
+    except Exception as e:
+        send(("error", "{}: {}".format(type(e).__name__, e)))
+        return
+    send(("ready", {name: _capabilities(worker) for name, worker in workers.items()}))
+
+    from workers_manager import WorkersManager
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            # The gateway is gone
+            break
+        if message[0] == "execute":
+            _, request, worker, method, args, timeout = message
+            command = WorkersManager.Command(getattr(workers[worker], method), timeout, args)
+            try:
+                result = (True, command.execute())
+            except Exception as e:
+                result = (False, (type(e).__name__, str(e), traceback.format_exc()))
+            try:
+                reply(request, *result)
+            except Exception as e:
+                reply(request, False, (type(e).__name__, str(e), traceback.format_exc()))
+        elif message[0] == "survey":
+            _, request, seconds = message
+            try:
+                reply(request, True, _survey(seconds))
+            except Exception as e:
+                reply(request, False, (type(e).__name__, str(e), traceback.format_exc()))
+        elif message[0] == "run":
+            run = workers[message[1]].run
+            if event_loop.is_async(run):
+                event_loop.spawn(message[1], run(_Publisher(send)))
+            else:
+                threading.Thread(target=run, args=[_Publisher(send)], daemon=True).start()
+    logger.stop()
+
+
+if __name__ == "__main__":
+    _child(int(sys.argv[1]))
@@ -0,0 +1,74 @@
+"""
+Concurrency limits for commands.
+
+Commands run in parallel once workers run in several processes (see ``isolation`` and
+``adapters``). Each process runs its commands one at a time, so those of one device never
+overlap, but the shards of a worker spread over adapters and the processes sharing an adapter
+do run at once. With a ``limits`` section in the manager config, ``Command.execute`` waits until
+the worker and the adapter of a command have room, so a dongle never gets more connects than it
+handles.
+"""
+import threading
+from contextlib import ExitStack, contextmanager
+
+import clock
+import logger
+import metrics
+
+_LOGGER = logger.get(__name__)
+
+WORKER = "worker"
+ADAPTER = "adapter"
+
+_limits = {}
+_semaphores = {}
+_lock = threading.Lock()
+
+
+def setup(config):
+    """Limits are numbers for every worker or adapter, or mappings of numbers by name"""
+    kinds = (WORKER + "s", ADAPTER + "s")
+    unknown = [kind for kind in config if kind not in kinds]
+    if unknown:
+        _LOGGER.warning("Ignoring unknown limits: %s", ", ".join(unknown))
+    _limits.clear()
+    _limits.update({kind: config[kind] for kind in kinds if kind in config})
+    with _lock:
+        _semaphores.clear()
+
+
+def enabled():
+    return bool(_limits)
+
+
+def limit(kind, name):
+    """The commands allowed in flight for a worker or adapter, None without a limit"""
+    value = _limits.get(kind + "s")
+    if isinstance(value, dict):
+        value = value.get(name)
+    return value
+
+
+def _semaphore(key):
+    with _lock:
+        semaphore = _semaphores.get(key)
+        if semaphore is None:
+            semaphore = _semaphores[key] = threading.BoundedSemaphore(limit(*key))
+        return semaphore
+
+
+@contextmanager
+def holding(keys):
+    """Holds a slot of every ``(kind, name)`` with a limit, waiting until all have room"""
+    # Always taken in the same order, so two commands never wait for each other
+    keys = sorted(key for key in set(keys) if limit(*key))
+    with ExitStack() as stack:
+        for key in keys:
+            semaphore = _semaphore(key)
+            if not semaphore.acquire(blocking=False):
+                started = clock.monotonic()
+                _LOGGER.debug("Waiting for a free %s slot of %s", *key)
+                semaphore.acquire()
+                metrics.LIMIT_WAIT.observe(clock.monotonic() - started, *key)
+            stack.callback(semaphore.release)
+        yield
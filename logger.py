@@ -1,15 +1,72 @@
+import atexit
 import logging
 import logging.config
+import logging.handlers
+import queue
+import threading
 import yaml
 
 APP_ROOT = "bt-mqtt-gw"
 SUPPRESSION_ENABLED = False
+DEFAULT_REPEATED_FAILURES_INTERVAL = 600  # In seconds
+
+_listener = None
+_repeated_failures_interval = DEFAULT_REPEATED_FAILURES_INTERVAL
+_repeated_failures = {}
+_repeated_failures_lock = threading.Lock()
+
+
+class _BackgroundHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only merge the arguments, formatting and tracebacks are left to the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
 
 
 def setup():
+    stop()
     with open("logger.yaml", "rt") as f:
         config = yaml.safe_load(f.read())
         logging.config.dictConfig(config)
+    _start_background()
+
+
+def _start_background():
+    """Move the root handlers behind a queue, so logging never blocks the main loop on output"""
+    global _listener
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if not handlers:
+        return
+    records = queue.Queue(-1)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(_BackgroundHandler(records))
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    """Flush and stop the background output, records logged afterwards are written directly"""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, _BackgroundHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
+
+
+atexit.register(stop)
+
+
+def output_handlers():
+    return _listener.handlers if _listener is not None else logging.getLogger().handlers
 
 
 def get(name=None):
@@ -21,7 +78,7 @@ def get(name=None):
 
 
 def enable_debug_formatter():
-    logging.getLogger().handlers[0].setFormatter(
+    output_handlers()[0].setFormatter(
         logging.getLogger("dummy_debug").handlers[0].formatter
     )
 
@@ -29,10 +86,6 @@ def enable_debug_formatter():
 def reset():
     app_level = get().getEffectiveLevel()
 
-    root = logging.getLogger()
-    map(root.removeHandler, root.handlers[:])
-    map(root.removeFilter, root.filters[:])
-
     setup()
     get().setLevel(app_level)
     if app_level <= logging.DEBUG:
@@ -44,9 +97,58 @@ def suppress_update_failures(suppress):
     SUPPRESSION_ENABLED = suppress
 
 
+def summarize_repeated_failures(interval):
+    """Log repeated identical update failures once per interval in seconds, 0 logs every one"""
+    global _repeated_failures_interval
+    _repeated_failures_interval = interval
+    with _repeated_failures_lock:
+        _repeated_failures.clear()
+
+
+def repeated_failures_interval():
+    """The seconds set by summarize_repeated_failures, to set up a worker process with"""
+    return _repeated_failures_interval
+
+
+def _repeated_failure(logger, message, args):
+    """
+    Returns the message and arguments to log for an update failure, or None while an
+    identical failure was logged less than the interval ago.
+    """
+    import clock
+
+    now = clock.monotonic()
+    key = (logger.name, message % args if args else message)
+    with _repeated_failures_lock:
+        entry = _repeated_failures.get(key)
+        if entry is not None and now - entry[0] < _repeated_failures_interval:
+            entry[1] += 1
+            return None
+        _repeated_failures[key] = [now, 0]
+    if entry is None or not entry[1]:
+        return message, args
+    # The suppressed failures plus this one, since the last one logged
+    return message + " (failed %d times in %s)", args + (entry[1] + 1, _format_duration(now - entry[0]))
+
+
+def _format_duration(seconds):
+    if seconds < 120:
+        return "{:.0f} s".format(seconds)
+    if seconds < 7200:
+        return "{:.0f} min".format(seconds / 60)
+    return "{:.1f} h".format(seconds / 3600)
+
+
 def log_exception(logger, message, *args, **kwargs):
-    if not ("suppress" in kwargs and kwargs.pop("suppress") and SUPPRESSION_ENABLED):
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.exception(message, *args, **kwargs)
-        elif logger.isEnabledFor(logging.WARNING):
-            logger.warning(message, *args, **kwargs)
+    suppress = kwargs.pop("suppress", False)
+    if suppress and SUPPRESSION_ENABLED:
+        return
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.exception(message, *args, **kwargs)
+    elif logger.isEnabledFor(logging.WARNING):
+        if suppress and _repeated_failures_interval:
+            summary = _repeated_failure(logger, message, args)
+            if summary is None:
+                return
+            message, args = summary
+        logger.warning(message, *args, **kwargs)
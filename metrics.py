@@ -0,0 +1,346 @@
+"""
+In-process metrics registry with an optional Prometheus/OpenMetrics text endpoint.
+
+Metrics are always collected (it is just a few dict updates), the HTTP endpoint
+is only started when a ``metrics`` section is present in the manager config.
+"""
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from workers_queue import _WORKERS_QUEUE
+import logger
+
+_LOGGER = logger.get(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DEFAULT_HOST = "127.0.0.1"  # Only local scrapers, the metrics name devices by MAC
+DEFAULT_PORT = 9337
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def get(self, name):
+        for metric in self._metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def expose(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type_name))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for name, value in pairs
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(
+                "Metric {} expects labels {}, got {}".format(
+                    self.name, self.labelnames, labelvalues
+                )
+            )
+        return tuple(str(value) for value in labelvalues)
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labelvalues):
+        with self._lock:
+            return self._values.get(self._key(labelvalues), 0)
+
+    def samples(self):
+        return [
+            "{}{} {}".format(self.name, _format_labels(self.labelnames, key), _format_value(value))
+            for key, value in self.items()
+        ]
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, callback=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._callback = callback
+
+    def set(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def value(self, *labelvalues):
+        if self._callback is not None:
+            return self._callback()
+        with self._lock:
+            return self._values.get(self._key(labelvalues), 0)
+
+    def samples(self):
+        if self._callback is not None:
+            return ["{} {}".format(self.name, _format_value(self._callback()))]
+        return [
+            "{}{} {}".format(self.name, _format_labels(self.labelnames, key), _format_value(value))
+            for key, value in self.items()
+        ]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labelnames=(),
+        registry=REGISTRY,
+        buckets=DEFAULT_BUCKETS,
+        window=0,
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Optionally keep the last observations for exact averages and percentiles
+        self._window = window
+        self._recent = {}
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            if self._window:
+                recent = self._recent.get(key)
+                if recent is None:
+                    recent = self._recent[key] = deque(maxlen=self._window)
+                recent.append(value)
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][index] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def recent(self):
+        """Last observations per label values, only kept when a window is set"""
+        with self._lock:
+            return {key: list(values) for key, values in self._recent.items()}
+
+    def count(self, *labelvalues):
+        with self._lock:
+            state = self._values.get(self._key(labelvalues))
+            return state["count"] if state else 0
+
+    def samples(self):
+        ret = []
+        for key, state in self.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state["buckets"]):
+                cumulative += count
+                ret.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        _format_labels(self.labelnames, key, [("le", _format_value(bound))]),
+                        cumulative,
+                    )
+                )
+            labels = _format_labels(self.labelnames, key)
+            ret.append("{}_sum{} {}".format(self.name, labels, _format_value(state["sum"])))
+            ret.append("{}_count{} {}".format(self.name, labels, state["count"]))
+        return ret
+
+
+QUEUE_DEPTH = Gauge(
+    "btmqtt_queue_depth",
+    "Number of commands waiting in the workers queue",
+    callback=_WORKERS_QUEUE.qsize,
+)
+COMMAND_QUEUE_WAIT = Histogram(
+    "btmqtt_command_queue_wait_seconds",
+    "Time a command spent in the workers queue before execution",
+    ["source"],
+)
+COMMAND_DURATION = Histogram(
+    "btmqtt_command_duration_seconds",
+    "Execution time of a worker command",
+    ["source"],
+    window=200,
+)
+COMMAND_RESULTS = Counter(
+    "btmqtt_command_results_total",
+    "Executed worker commands by result (success, partial, timeout, error)",
+    ["source", "result"],
+)
+LIMIT_WAIT = Histogram(
+    "btmqtt_limit_wait_seconds",
+    "Time commands waited for a concurrency limit of a worker or adapter",
+    ["kind", "name"],
+)
+COMMANDS_SHED = Counter(
+    "btmqtt_commands_shed_total",
+    "Queued commands dropped instead of run by reason (expired, overload)",
+    ["source", "reason"],
+)
+READ_REQUESTS = Counter(
+    "btmqtt_read_requests_total",
+    "On-demand reads over MQTT by worker and how they were answered (cache, poll, error)",
+    ["worker", "answer"],
+)
+DEVICE_RESULTS = Counter(
+    "btmqtt_device_operations_total",
+    "BLE operations per device by operation and result (success, timeout, btle_error, error)",
+    ["device", "operation", "result"],
+)
+DEVICE_RETRIES = Counter(
+    "btmqtt_device_retries_total",
+    "Device operations tried again after a transient BLE failure",
+    ["worker"],
+)
+BLE_CONNECT_DURATION = Histogram(
+    "btmqtt_ble_connect_seconds",
+    "Duration of BLE connection attempts",
+    ["device"],
+)
+BLE_SCAN_DURATION = Histogram(
+    "btmqtt_ble_scan_seconds",
+    "Duration of BLE scans",
+)
+BLE_ADAPTER_WAIT = Histogram(
+    "btmqtt_ble_adapter_wait_seconds",
+    "Time connects and scan slices waited for their adapter",
+    ["adapter", "operation"],
+)
+BLE_SCAN_PAUSES = Counter(
+    "btmqtt_ble_scan_pauses_total",
+    "Scans paused to let a connect through",
+    ["adapter"],
+)
+BLE_HELPER_KILLS = Counter(
+    "btmqtt_ble_helper_kills_total",
+    "bluepy-helper processes killed by the watchdog by reason (hung, interrupted, orphaned, reset)",
+    ["adapter", "reason"],
+)
+BLE_ADAPTER_RESETS = Counter(
+    "btmqtt_ble_adapter_resets_total",
+    "Adapters reset by the watchdog after most requests on them failed",
+    ["adapter"],
+)
+MQTT_PUBLISHED = Counter(
+    "btmqtt_mqtt_published_total",
+    "MQTT messages handed over to the broker connection",
+)
+MQTT_CONNECTS = Counter(
+    "btmqtt_mqtt_connects_total",
+    "Successful (re)connections to the MQTT broker",
+)
+MQTT_PUBLISH_FAILURES = Counter(
+    "btmqtt_mqtt_publish_failures_total",
+    "MQTT messages that could not be published",
+)
+SCHEDULER_LAG = Histogram(
+    "btmqtt_scheduler_lag_seconds",
+    "Delay between the planned and the actual run of a scheduled job",
+    ["job"],
+)
+SCHEDULER_MISSED = Counter(
+    "btmqtt_scheduler_missed_total",
+    "Scheduled jobs skipped because their run time was missed",
+    ["job"],
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _LOGGER.debug("Metrics request from %s: %s", self.address_string(), format % args)
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(config):
+    host = config.get("host", DEFAULT_HOST)
+    port = int(config.get("port", DEFAULT_PORT))
+    server = _MetricsServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    _LOGGER.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
@@ -2,6 +2,8 @@ import json
 
 import paho.mqtt.client as mqtt
 import logger
+import metrics
+import tracing
 
 LWT_ONLINE = "online"
 LWT_OFFLINE = "offline"
@@ -11,11 +13,7 @@ _LOGGER = logger.get(__name__)
 class MqttClient:
     def __init__(self, config):
         self._config = config
-        self._mqttc = mqtt.Client(
-            client_id=self.client_id,
-            clean_session=False,
-            userdata={"global_topic_prefix": self.topic_prefix},
-        )
+        self._mqttc = self._create_client()
 
         if self.username and self.password:
             self.mqttc.username_pw_set(self.username, self.password)
@@ -30,16 +28,32 @@ class MqttClient:
             _LOGGER.debug("Setting LWT to: %s" % topic)
             self.mqttc.will_set(topic, payload=LWT_OFFLINE, retain=True)
 
+    def _create_client(self):
+        return mqtt.Client(
+            client_id=self.client_id,
+            clean_session=False,
+            userdata={"global_topic_prefix": self.topic_prefix},
+        )
+
     def publish(self, messages):
         if not messages:
             return
 
-        for m in messages:
-            if m.use_global_prefix:
-                topic = self._format_topic(m.topic)
-            else:
-                topic = m.topic
-            self.mqttc.publish(topic, m.payload, retain=m.retain)
+        with tracing.span("publish", messages=len(messages)):
+            for m in messages:
+                if m.use_global_prefix:
+                    topic = self._format_topic(m.topic)
+                else:
+                    topic = m.topic
+                try:
+                    info = self.mqttc.publish(topic, m.payload, retain=m.retain)
+                except Exception:
+                    metrics.MQTT_PUBLISH_FAILURES.inc()
+                    raise
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    metrics.MQTT_PUBLISHED.inc()
+                else:
+                    metrics.MQTT_PUBLISH_FAILURES.inc()
 
     @property
     def client_id(self):
@@ -98,6 +112,8 @@ class MqttClient:
 
     # noinspection PyUnusedLocal
     def on_connect(self, client, userdata, flags, rc):
+        if rc == mqtt.CONNACK_ACCEPTED:
+            metrics.MQTT_CONNECTS.inc()
         if self.availability_topic:
             self.publish(
                 [
@@ -0,0 +1,177 @@
+"""
+Built-in profiler for worker hot paths.
+
+A profiling session covers either a time window or the next N executions of matching
+commands. Per worker it writes a cumulative CPU profile (pstats, view with ``python -m
+pstats`` or snakeviz) and a wall-time profile as collapsed stacks (flamegraph.pl,
+speedscope). Window sessions also sample every other thread of the gateway, so time
+spent in the scheduler or the MQTT network loop shows up as well.
+"""
+import cProfile
+import fnmatch
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import logger
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_OUTPUT_DIR = "profiles"
+DEFAULT_COUNT = 10
+SAMPLE_INTERVAL = 0.005  # In seconds
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+class ProfileSession:
+    def __init__(self, output_dir, duration=None, commands=None, count=None):
+        self.output_dir = output_dir
+        self.commands = commands or []
+        self.remaining = count if count is not None else (None if duration else DEFAULT_COUNT)
+        self.deadline = time.monotonic() + duration if duration else None
+        self.name = time.strftime("%Y%m%d-%H%M%S")
+        self._cpu_profiles = {}
+        self._wall_stacks = {}
+        self._active = {}  # thread id -> worker being profiled
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True, name="profiler")
+        self._sampler.start()
+
+    @property
+    def is_window(self):
+        return self.deadline is not None and not self.commands
+
+    def expired(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return True
+        return self.remaining is not None and self.remaining <= 0
+
+    def matches(self, source):
+        if not self.commands:
+            return True
+        return any(fnmatch.fnmatch(source, pattern) for pattern in self.commands)
+
+    @contextmanager
+    def profile(self, source):
+        worker = source.split(".")[0]
+        with self._lock:
+            profile = self._cpu_profiles.get(worker)
+            if profile is None:
+                profile = self._cpu_profiles[worker] = cProfile.Profile(time.process_time)
+            self._active[threading.get_ident()] = worker
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self._active.pop(threading.get_ident(), None)
+                if self.remaining is not None:
+                    self.remaining -= 1
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        while not self._finished.wait(SAMPLE_INTERVAL):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            with self._lock:
+                active = dict(self._active)
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                if ident in active:
+                    key, stack = active[ident], _collapse(frame)
+                elif self.is_window:
+                    key = "threads"
+                    stack = "{};{}".format(names.get(ident, ident), _collapse(frame))
+                else:
+                    continue
+                self._wall_stacks.setdefault(key, Counter())[stack] += 1
+
+    def finish(self):
+        # Let a command that is being profiled right now complete first, except the one finishing
+        # the session, like a profiling request replacing it
+        own_ident = threading.get_ident()
+        while True:
+            with self._lock:
+                if not set(self._active) - {own_ident}:
+                    break
+            time.sleep(SAMPLE_INTERVAL)
+        self._finished.set()
+        self._sampler.join()
+        os.makedirs(self.output_dir, exist_ok=True)
+        written = []
+        for worker, profile in self._cpu_profiles.items():
+            path = os.path.join(self.output_dir, "{}-{}.cpu.pstats".format(self.name, worker))
+            profile.dump_stats(path)
+            written.append(path)
+        for key, stacks in self._wall_stacks.items():
+            path = os.path.join(self.output_dir, "{}-{}.wall.collapsed".format(self.name, key))
+            with open(path, "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write("{} {}\n".format(stack, count))
+            written.append(path)
+        _LOGGER.info("Profiling session %s finished, wrote %s", self.name, ", ".join(written))
+        return written
+
+
+def _collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def start(output_dir=DEFAULT_OUTPUT_DIR, duration=None, commands=None, count=None):
+    """Start a profiling session, replacing any session that is still running."""
+    global _SESSION
+    with _SESSION_LOCK:
+        previous, _SESSION = _SESSION, ProfileSession(output_dir, duration, commands, count)
+    if previous is not None:
+        previous.finish()
+    if duration:
+        timer = threading.Timer(duration, _check_expired)
+        timer.daemon = True
+        timer.start()
+    _LOGGER.info(
+        "Profiling %s for %s",
+        ", ".join(_SESSION.commands) if _SESSION.commands else "all commands",
+        "{} seconds".format(duration) if duration else "{} executions".format(_SESSION.remaining),
+    )
+    return _SESSION
+
+
+def stop():
+    global _SESSION
+    with _SESSION_LOCK:
+        session, _SESSION = _SESSION, None
+    if session is not None:
+        return session.finish()
+    return []
+
+
+def _check_expired():
+    with _SESSION_LOCK:
+        session = _SESSION
+    if session is not None and session.expired():
+        stop()
+
+
+@contextmanager
+def profile(source):
+    """Profile the block for the given command source if a session asks for it."""
+    _check_expired()
+    session = _SESSION
+    if session is None or not session.matches(source):
+        yield
+        return
+    with session.profile(source):
+        yield
+    _check_expired()
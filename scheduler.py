@@ -0,0 +1,152 @@
+"""
+The scheduler of the gateway's interval jobs: worker and device polls, statistics.
+
+Jobs are kept in a heap by their next run in monotonic time of the clock, and one thread sleeps
+until the earliest is due and runs it. The jobs only queue commands, so runs are short. Under a
+VirtualClock no thread runs, the clock runs the jobs falling due while time advances.
+
+A job runs every ``interval`` seconds from ``first_run``, which sets its phase, each run delayed
+by a random part of ``jitter`` seconds that doesn't shift the runs after it. Runs missed while
+the gateway was busy or the clock jumped are coalesced into one, and a run more than
+``misfire_grace`` seconds late is skipped instead. Both count in ``btmqtt_scheduler_missed_total``.
+"""
+import heapq
+import itertools
+import random
+import threading
+
+import logger
+import metrics
+
+_LOGGER = logger.get(__name__)
+
+IDLE_WAIT = 60  # In seconds, the longest the thread sleeps without jobs
+
+
+class Job:
+    def __init__(self, job_id, func, interval, first_run, jitter=0, misfire_grace=None):
+        self.id = job_id
+        self.func = func
+        self.interval = interval  # None for a job running once
+        self.next_run = first_run  # The planned run, in monotonic seconds, the jitter comes on top
+        self.jitter = jitter
+        self.misfire_grace = misfire_grace
+        self.due = self._delayed(first_run)
+        self.removed = False
+
+    def _delayed(self, run):
+        return run + random.uniform(0, self.jitter) if self.jitter else run
+
+    def advance(self, now):
+        """Plans the run after ``now``, returns how many runs were missed on the way"""
+        missed = int((now - self.next_run) // self.interval) if now > self.next_run else 0
+        self.next_run += self.interval * (missed + 1)
+        self.due = self._delayed(self.next_run)
+        return missed
+
+    def __lt__(self, other):
+        return self.due < other.due
+
+    def __repr__(self):
+        return "<Job {} every {} s>".format(self.id, self.interval)
+
+
+class Scheduler:
+    def __init__(self, clock, threaded=True):
+        self._clock = clock
+        self._threaded = threaded
+        self._jobs = {}
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition(threading.RLock())
+        self._thread = None
+        self.running = False
+
+    def add_job(self, func, seconds, id=None, first_run=None, jitter=0, misfire_grace=None, once=False):
+        """
+        Runs ``func`` every ``seconds``, first at monotonic ``first_run``, by default in ``seconds``.
+        With ``once`` it runs only at ``first_run``.
+        """
+        if not seconds > 0 and not once:
+            raise ValueError("Interval of job {} must be positive, not {!r}".format(id, seconds))
+        if first_run is None:
+            first_run = self._clock.monotonic() + seconds
+        with self._condition:
+            job_id = id if id is not None else "job_{}".format(next(self._counter))
+            if job_id in self._jobs:
+                self.remove_job(job_id)
+            job = Job(job_id, func, None if once else seconds, first_run, jitter, misfire_grace)
+            self._jobs[job_id] = job
+            heapq.heappush(self._queue, job)
+            self._condition.notify()
+        return job
+
+    def remove_job(self, job_id):
+        with self._condition:
+            self._jobs.pop(job_id).removed = True
+
+    def get_job(self, job_id):
+        return self._jobs.get(job_id)
+
+    def get_jobs(self):
+        return list(self._jobs.values())
+
+    def start(self):
+        self.running = True
+        if self._threaded and self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="scheduler")
+            self._thread.start()
+
+    def shutdown(self, wait=True):
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+        if wait and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def next_run(self):
+        """Monotonic time the earliest job is due, None without jobs"""
+        with self._condition:
+            while self._queue and self._queue[0].removed:
+                heapq.heappop(self._queue)
+            return self._queue[0].due if self._queue else None
+
+    def run_pending(self):
+        """Runs every job that is due"""
+        while self.running:
+            with self._condition:
+                now = self._clock.monotonic()
+                due = self.next_run()
+                if due is None or due > now:
+                    return
+                job = heapq.heappop(self._queue)
+                late = now - job.due
+                if job.interval is None:
+                    missed = 0
+                    del self._jobs[job.id]
+                else:
+                    missed = job.advance(now)
+                    heapq.heappush(self._queue, job)
+            if job.misfire_grace is not None and late > job.misfire_grace:
+                missed += 1
+            else:
+                metrics.SCHEDULER_LAG.observe(late, job.id)
+                try:
+                    job.func()
+                except Exception as e:
+                    logger.log_exception(_LOGGER, "Job %s raised %s", job.id, type(e).__name__)
+            if missed:
+                metrics.SCHEDULER_MISSED.inc(job.id, amount=missed)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self.running:
+                    return
+                due = self.next_run()
+                wait = IDLE_WAIT if due is None else due - self._clock.monotonic()
+                if wait > 0:
+                    self._condition.wait(min(wait, IDLE_WAIT))
+                    continue
+            self.run_pending()
@@ -0,0 +1,99 @@
+"""
+Simulated BLE device farm for running the whole gateway without hardware.
+
+``install`` replaces ``bluepy`` with the fake backend in ``simulator.btle`` and creates a
+simulated device for every device configured on a worker, plus any extra devices from the
+``simulation`` config section. Paired with ``LocalMqttClient`` the real WorkersManager
+pipeline can be driven with hundreds of devices on a development machine.
+
+RuuvitagWorker and SmartgadgetWorker read through their own libraries rather than bluepy,
+so their devices only show up in scans.
+"""
+import queue
+import sys
+import types
+
+from exceptions import DeviceTimeoutError, WorkerTimeoutError
+from simulator import btle
+from simulator.devices import DeviceFarm
+from simulator.mqtt import LocalMqttClient
+from workers_queue import _WORKERS_QUEUE
+import clock
+import logger
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_DURATION = 24 * 60 * 60  # In seconds
+
+
+def install(config, workers_config=None):
+    farm = DeviceFarm(config)
+    if workers_config:
+        farm.add_configured(workers_config)
+    farm.add_extra(config.get("devices", []))
+    if "replay" in config:
+        farm.add_replay(config["replay"])
+
+    package = types.ModuleType("bluepy")
+    package.__path__ = []
+    package.btle = btle
+    package.SIMULATED = True
+    sys.modules["bluepy"] = package
+    sys.modules["bluepy.btle"] = btle
+    btle._FARM = farm
+
+    _LOGGER.info("Simulating %d BLE devices", len(farm.devices))
+    return farm
+
+
+def farm():
+    return btle._FARM
+
+
+def is_simulated(package):
+    return getattr(sys.modules.get(package), "SIMULATED", False)
+
+
+def run_virtual(mqtt, duration=DEFAULT_DURATION):
+    """
+    The gateway main loop on the installed VirtualClock: queued commands run as soon as
+    they are queued, and when the queue is empty time jumps to the next scheduled job.
+    Returns the number of executed commands.
+    """
+    virtual_clock = clock.get()
+    if not virtual_clock.virtual:
+        raise RuntimeError("run_virtual needs a VirtualClock installed")
+
+    end = virtual_clock.monotonic() + duration
+    executed = 0
+    while True:
+        try:
+            command = _WORKERS_QUEUE.get_nowait()
+        except queue.Empty:
+            next_run = virtual_clock.next_run()
+            if next_run is None or next_run > end:
+                break
+            virtual_clock.run_next()
+            continue
+
+        executed += 1
+        try:
+            with command.traced():
+                mqtt.publish(command.execute())
+        except (WorkerTimeoutError, DeviceTimeoutError) as e:
+            logger.log_exception(
+                _LOGGER,
+                str(e) if str(e) else "Timeout while executing worker command",
+                suppress=True,
+            )
+        except Exception as e:
+            # The gateway would exit here and be restarted, a simulation keeps going
+            logger.log_exception(
+                _LOGGER, "Error while executing worker command %s: %s", command.source, type(e).__name__
+            )
+
+    virtual_clock.run_until(end)
+    _LOGGER.info(
+        "Simulated %.0f seconds, executed %d commands", duration, executed
+    )
+    return executed
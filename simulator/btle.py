@@ -0,0 +1,485 @@
+"""
+Drop-in replacement for the parts of ``bluepy.btle`` used by the workers and the libraries
+they depend on (btlewrap, python-eq3bt). Peripherals and scanners talk to the simulated
+devices of the installed DeviceFarm instead of bluepy-helper.
+"""
+import binascii
+import struct
+import threading
+from collections import deque
+
+SIMULATED = True
+
+ADDR_TYPE_PUBLIC = "public"
+ADDR_TYPE_RANDOM = "random"
+
+_FARM = None
+
+
+class BTLEException(Exception):
+    def __init__(self, message, resp_dict=None):
+        self.message = message
+        self.estat = None
+        self.emsg = None
+        Exception.__init__(self, message)
+
+    def __str__(self):
+        return self.message
+
+
+class BTLEInternalError(BTLEException):
+    pass
+
+
+class BTLEDisconnectError(BTLEException):
+    pass
+
+
+class BTLEManagementError(BTLEException):
+    pass
+
+
+class BTLEGattError(BTLEException):
+    pass
+
+
+class UUID:
+    def __init__(self, val, commonName=None):
+        if isinstance(val, UUID):
+            val = str(val)
+        if isinstance(val, int):
+            if val < 0 or val > 0xFFFFFFFF:
+                raise ValueError("Short form UUIDs must be in range 0..0xFFFFFFFF")
+            val = "%04X" % val
+        else:
+            val = str(val)
+        val = val.lower().replace("-", "")
+        if len(val) <= 8:
+            val = ("0" * (8 - len(val))) + val + "00001000800000805f9b34fb"
+        if len(val) != 32:
+            raise ValueError("Invalid (not 16 or 128 bit) UUID: " + repr(val))
+        self.binVal = binascii.a2b_hex(val.encode("utf-8"))
+        self.commonName = commonName
+
+    def __str__(self):
+        s = binascii.b2a_hex(self.binVal).decode("utf-8")
+        return "-".join([s[0:8], s[8:12], s[12:16], s[16:20], s[20:32]])
+
+    def __eq__(self, other):
+        return self.binVal == UUID(other).binVal
+
+    def __hash__(self):
+        return hash(self.binVal)
+
+    def getCommonName(self):
+        return self.commonName or str(self)
+
+
+class DefaultDelegate:
+    def __init__(self):
+        pass
+
+    def handleNotification(self, cHandle, data):
+        pass
+
+    def handleDiscovery(self, scanEntry, isNewDev, isNewData):
+        pass
+
+
+class Service:
+    def __init__(self, peripheral, service):
+        self.peripheral = peripheral
+        self.uuid = UUID(service.uuid)
+        self.hndStart = service.characteristics[0].handle - 1 if service.characteristics else 0
+        self.hndEnd = service.characteristics[-1].handle + 1 if service.characteristics else 0
+        self.chars = [Characteristic(peripheral, char) for char in service.characteristics]
+
+    def getCharacteristics(self, forUUID=None):
+        if forUUID is None:
+            return list(self.chars)
+        return [char for char in self.chars if char.uuid == UUID(forUUID)]
+
+    def __str__(self):
+        return "Service <uuid=%s handleStart=%s handleEnd=%s>" % (self.uuid, self.hndStart, self.hndEnd)
+
+
+class Characteristic:
+    def __init__(self, peripheral, characteristic):
+        self.peripheral = peripheral
+        self.uuid = UUID(characteristic.uuid)
+        self.handle = characteristic.handle - 1
+        self.valHandle = characteristic.handle
+        self.properties = characteristic.properties
+        self.descs = [Descriptor(peripheral, characteristic.handle + 1, 0x2902)]
+
+    def read(self):
+        return self.peripheral.readCharacteristic(self.valHandle)
+
+    def write(self, val, withResponse=False):
+        return self.peripheral.writeCharacteristic(self.valHandle, val, withResponse)
+
+    def getDescriptors(self, forUUID=None, hndEnd=0xFFFF):
+        if forUUID is None:
+            return list(self.descs)
+        return [desc for desc in self.descs if desc.uuid == UUID(forUUID)]
+
+    def getHandle(self):
+        return self.valHandle
+
+    def supportsRead(self):
+        return bool(self.properties & 0x02)
+
+    def __str__(self):
+        return "Characteristic <%s>" % self.uuid
+
+
+class Descriptor:
+    def __init__(self, peripheral, handle, uuid):
+        self.peripheral = peripheral
+        self.handle = handle
+        self.uuid = UUID(uuid)
+
+    def read(self):
+        return self.peripheral.readCharacteristic(self.handle)
+
+    def write(self, val, withResponse=False):
+        return self.peripheral.writeCharacteristic(self.handle, val, withResponse)
+
+
+class _HelperProcess:
+    """Stands in for the bluepy-helper subprocess, so it can hang and be killed like one"""
+
+    def __init__(self, owner):
+        self._token = _FARM.helper_started(owner)
+        self._exited = threading.Event()
+        self.returncode = None
+
+    def hang(self):
+        """Blocks like a helper that stopped answering, until it is killed"""
+        self._exited.wait()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self._exited.wait(timeout)
+        return self.returncode
+
+    def kill(self):
+        self._exit(-9)
+
+    def _exit(self, returncode):
+        if self.returncode is None:
+            self.returncode = returncode
+            _FARM.helper_stopped(self._token)
+            self._exited.set()
+
+
+class BluepyHelper:
+    def __init__(self):
+        self._helper = None
+        self._helper_iface = None
+        self.delegate = DefaultDelegate()
+
+    def _startHelper(self, iface=None):
+        if self._helper is None:
+            self._helper = _HelperProcess(self)
+            self._helper_iface = iface
+
+    def _stopHelper(self):
+        if self._helper is not None:
+            self._helper._exit(0)
+            self._helper = None
+
+    def _request(self):
+        """A request to the helper, which may hang"""
+        if _FARM.fails(_FARM.hang_rate):
+            self._helper.hang()
+        if self._helper.poll() is not None:
+            raise BTLEInternalError("Helper exited")
+
+    def withDelegate(self, delegate_):
+        self.delegate = delegate_
+        return self
+
+
+class Peripheral(BluepyHelper):
+    def __init__(self, deviceAddr=None, addrType=ADDR_TYPE_PUBLIC, iface=None):
+        BluepyHelper.__init__(self)
+        self._device = None
+        self._services = None
+        self._notifications = deque()
+        self.addr, self.addrType, self.iface = None, None, None
+
+        if isinstance(deviceAddr, ScanEntry):
+            self._connect(deviceAddr.addr, deviceAddr.addrType, deviceAddr.iface)
+        elif deviceAddr is not None:
+            self._connect(deviceAddr, addrType, iface)
+
+    def setDelegate(self, delegate_):
+        return self.withDelegate(delegate_)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.disconnect()
+
+    def _connect(self, addr, addrType=ADDR_TYPE_PUBLIC, iface=None):
+        if len(addr.split(":")) != 6:
+            raise ValueError("Expected MAC address, got %s" % repr(addr))
+        self.addr, self.addrType, self.iface = addr, addrType, iface
+        device = _FARM.get(addr)
+        _FARM.sleep(_FARM.connect_latency.sample())
+        if device is None or not device.connectable or _FARM.fails(_FARM.connect_failure_rate):
+            raise BTLEDisconnectError(
+                "Failed to connect to peripheral %s, addr type: %s" % (addr, addrType)
+            )
+        self._startHelper(iface)
+        self._request()
+        self._device = device
+        self._notifications.clear()
+
+    def connect(self, addr, addrType=ADDR_TYPE_PUBLIC, iface=None):
+        if isinstance(addr, ScanEntry):
+            self._connect(addr.addr, addr.addrType, addr.iface)
+        elif addr is not None:
+            self._connect(addr, addrType, iface)
+
+    def disconnect(self):
+        if self._device is None:
+            return
+        self._device = None
+        self._services = None
+        self._stopHelper()
+
+    def getState(self):
+        return "conn" if self._device is not None else "disc"
+
+    def _io(self):
+        if self._device is None or self._helper is None:
+            raise BTLEInternalError("Helper not started (did you call connect()?)")
+        self._request()
+        _FARM.sleep(_FARM.io_latency.sample())
+        if _FARM.fails(_FARM.disconnect_rate):
+            self.disconnect()
+            raise BTLEDisconnectError("Device disconnected")
+        if _FARM.fails(_FARM.io_failure_rate):
+            raise BTLEGattError("Bluetooth command failed")
+        return self._device
+
+    def getServices(self):
+        device = self._io()
+        if self._services is None:
+            self._services = [Service(self, service) for service in device.gatt]
+        return list(self._services)
+
+    @property
+    def services(self):
+        return self.getServices()
+
+    def discoverServices(self):
+        return {service.uuid: service for service in self.getServices()}
+
+    def getServiceByUUID(self, uuidVal):
+        uuid = UUID(uuidVal)
+        for service in self.getServices():
+            if service.uuid == uuid:
+                return service
+        raise BTLEGattError("Service %s not found" % uuid)
+
+    def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+        chars = [
+            char
+            for service in self.getServices()
+            for char in service.getCharacteristics(uuid)
+            if startHnd <= char.valHandle <= endHnd
+        ]
+        if not chars:
+            raise BTLEGattError("Bluetooth command failed")
+        return chars
+
+    def getDescriptors(self, startHnd=1, endHnd=0xFFFF):
+        return [
+            desc
+            for char in self.getCharacteristics(startHnd, endHnd)
+            for desc in char.getDescriptors()
+        ]
+
+    def readCharacteristic(self, handle):
+        value = self._io().read(handle)
+        if value is None:
+            raise BTLEGattError("Bluetooth command failed")
+        return value
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        device = self._io()
+        self._notifications.extend(device.write(handle, bytes(val)))
+        return {"rsp": ["wr"]} if withResponse else None
+
+    def waitForNotifications(self, timeout):
+        device = self._io()
+        if not self._notifications:
+            self._notifications.extend(device.poll_notifications())
+        if not self._notifications:
+            _FARM.sleep(timeout)
+            return False
+        handle, data = self._notifications.popleft()
+        if self.delegate is not None:
+            self.delegate.handleNotification(handle, data)
+        return True
+
+    def setMTU(self, mtu):
+        return {"rsp": ["stat"]}
+
+    def __del__(self):
+        try:
+            self.disconnect()
+        except Exception:
+            pass
+
+
+class ScanEntry:
+    addrTypes = {1: ADDR_TYPE_PUBLIC, 2: ADDR_TYPE_RANDOM}
+
+    FLAGS = 0x01
+    INCOMPLETE_16B_SERVICES = 0x02
+    COMPLETE_16B_SERVICES = 0x03
+    SHORT_LOCAL_NAME = 0x08
+    COMPLETE_LOCAL_NAME = 0x09
+    TX_POWER = 0x0A
+    SERVICE_DATA_16B = 0x16
+    MANUFACTURER = 0xFF
+
+    dataTags = {
+        FLAGS: "Flags",
+        INCOMPLETE_16B_SERVICES: "Incomplete 16b Services",
+        COMPLETE_16B_SERVICES: "Complete 16b Services",
+        SHORT_LOCAL_NAME: "Short Local Name",
+        COMPLETE_LOCAL_NAME: "Complete Local Name",
+        TX_POWER: "Tx Power",
+        SERVICE_DATA_16B: "16b Service Data",
+        MANUFACTURER: "Manufacturer",
+    }
+
+    def __init__(self, addr, iface):
+        self.addr = addr
+        self.iface = iface
+        self.addrType = None
+        self.rssi = None
+        self.connectable = False
+        self.rawData = None
+        self.scanData = {}
+        self.updateCount = 0
+
+    def _update(self, resp):
+        # Takes the same scan response dict as bluepy's ScanEntry
+        self.addrType = self.addrTypes.get(resp["type"][0], None)
+        self.rssi = -resp["rssi"][0]
+        self.connectable = (resp["flag"][0] & 0x4) == 0
+        data = resp.get("d", [b""])[0]
+        self.rawData = data
+        is_new_data = False
+        while len(data) >= 2:
+            length, sdid = struct.unpack("<BB", data[:2])
+            value = data[2:length + 1]
+            if sdid not in self.scanData or value != self.scanData[sdid]:
+                is_new_data = True
+            self.scanData[sdid] = value
+            data = data[length + 1:]
+        self.updateCount += 1
+        return is_new_data
+
+    def getDescription(self, sdid):
+        return self.dataTags.get(sdid, hex(sdid))
+
+    def getValue(self, sdid):
+        val = self.scanData.get(sdid, None)
+        if val is None:
+            return None
+        if sdid in [ScanEntry.SHORT_LOCAL_NAME, ScanEntry.COMPLETE_LOCAL_NAME]:
+            return val.decode("utf-8", "replace")
+        if sdid in [ScanEntry.INCOMPLETE_16B_SERVICES, ScanEntry.COMPLETE_16B_SERVICES]:
+            return [
+                UUID("%02X%02X" % (val[i + 1], val[i])) for i in range(0, len(val) - 1, 2)
+            ]
+        return val
+
+    def getValueText(self, sdid):
+        val = self.getValue(sdid)
+        if val is None:
+            return None
+        if sdid in [ScanEntry.SHORT_LOCAL_NAME, ScanEntry.COMPLETE_LOCAL_NAME]:
+            return val
+        if isinstance(val, list):
+            return ",".join(str(v) for v in val)
+        return binascii.b2a_hex(val).decode("ascii")
+
+    def getScanData(self):
+        return [
+            (sdid, self.getDescription(sdid), self.getValueText(sdid))
+            for sdid in self.scanData.keys()
+        ]
+
+
+class Scanner(BluepyHelper):
+    def __init__(self, iface=0):
+        BluepyHelper.__init__(self)
+        self.scanned = {}
+        self.iface = iface
+        self.passive = False
+        self._failing = False
+        self._lock = threading.Lock()
+
+    def start(self, passive=False):
+        self.passive = passive
+        # Decided once per scan, so scanning in slices doesn't fail more often
+        self._failing = _FARM.fails(_FARM.scan_failure_rate)
+        self._startHelper(iface=self.iface)
+
+    def stop(self):
+        self._stopHelper()
+
+    def clear(self):
+        self.scanned = {}
+
+    def process(self, timeout=10.0):
+        if self._helper is None:
+            raise BTLEInternalError("Helper not started (did you call start()?)")
+        self._request()
+        _FARM.sleep(timeout)
+        if self._failing:
+            raise BTLEDisconnectError("Device disconnected")
+        for device, scan_data in _FARM.advertisements():
+            with self._lock:
+                entry = self.scanned.get(device.mac)
+                if entry is None:
+                    entry = self.scanned[device.mac] = ScanEntry(device.mac, self.iface)
+            is_new_data = entry._update(
+                scan_response(device.addr_type, device.sample_rssi(self._helper_iface), device.connectable, scan_data)
+            )
+            if self.delegate is not None:
+                self.delegate.handleDiscovery(entry, entry.updateCount <= 1, is_new_data)
+
+    def getDevices(self):
+        return self.scanned.values()
+
+    def scan(self, timeout=10, passive=False):
+        self.clear()
+        self.start(passive=passive)
+        self.process(timeout)
+        self.stop()
+        return self.getDevices()
+
+
+def scan_response(addr_type, rssi, connectable, scan_data):
+    """The scan response dict bluepy-helper reports for an advertisement"""
+    raw = b"".join(
+        struct.pack("<BB", len(value) + 1, sdid) + value for sdid, value in scan_data.items()
+    )
+    return {
+        "type": [2 if addr_type == ADDR_TYPE_RANDOM else 1],
+        "rssi": [-rssi],
+        "flag": [0 if connectable else 0x4],
+        "d": [raw],
+    }
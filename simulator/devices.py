@@ -0,0 +1,650 @@
+"""
+Simulated BLE devices speaking just enough of each vendor protocol for the real worker
+and library parsing code, plus the DeviceFarm holding them and the latency/failure model.
+"""
+import collections
+import itertools
+import math
+import random
+import struct
+import threading
+import zlib
+from datetime import datetime
+
+import clock
+import logger
+
+_LOGGER = logger.get(__name__)
+
+CCCD_ENABLE = b"\x01\x00"
+
+PROP_READ = 0x02
+PROP_WRITE = 0x08
+PROP_NOTIFY = 0x10
+
+
+class Distribution:
+    """
+    Random distribution from config: a plain number is a constant, a dict selects the
+    distribution, e.g. ``{distribution: lognormal, mean: 1.5, sigma: 0.5, max: 10}``.
+    """
+
+    def __init__(self, config, rng):
+        self._rng = rng
+        if config is None:
+            config = 0
+        if isinstance(config, (int, float)):
+            config = {"distribution": "constant", "mean": config}
+        self.kind = config.get("distribution", "constant")
+        self.mean = float(config.get("mean", 0))
+        self.sigma = float(config.get("sigma", 0))
+        self.minimum = float(config.get("min", 0))
+        self.maximum = float(config.get("max", float("inf")))
+
+    def sample(self):
+        if self.kind == "exponential":
+            value = self._rng.expovariate(1 / self.mean) if self.mean > 0 else 0
+        elif self.kind == "normal":
+            value = self._rng.gauss(self.mean, self.sigma)
+        elif self.kind == "lognormal":
+            # Parametrised so that the configured mean is the mean of the samples
+            mu = math.log(self.mean) - self.sigma ** 2 / 2 if self.mean > 0 else 0
+            value = self._rng.lognormvariate(mu, self.sigma)
+        elif self.kind == "uniform":
+            value = self._rng.uniform(self.minimum, self.maximum)
+        elif self.kind == "constant":
+            value = self.mean
+        else:
+            raise ValueError("Unknown distribution: {}".format(self.kind))
+        return min(max(value, self.minimum), self.maximum)
+
+
+class GattCharacteristic:
+    def __init__(self, uuid, handle, properties):
+        self.uuid = uuid
+        self.handle = handle
+        self.properties = properties
+
+
+class GattService:
+    def __init__(self, uuid, characteristics):
+        self.uuid = uuid
+        self.characteristics = characteristics
+
+
+class SimulatedDevice:
+    kind = "beacon"
+    addr_type = "public"
+    connectable = True
+    local_name = b"Simulated"
+    gatt = []
+
+    def __init__(self, mac, farm):
+        self.mac = mac.lower()
+        self.farm = farm
+        self.rng = farm.rng
+        self.rssi = -self.rng.randint(45, 90)
+        self.notifying = set()
+        self._lock = threading.Lock()
+        self._setup()
+
+    def _setup(self):
+        return
+
+    def _drift(self, value, step, minimum, maximum):
+        return min(max(value + self.rng.uniform(-step, step), minimum), maximum)
+
+    def sample_rssi(self, iface=0):
+        return int(self.rssi + self.adapter_offset(iface) + self.rng.gauss(0, 3))
+
+    def adapter_offset(self, iface):
+        """Fixed RSSI difference of other adapters than hci0, as if they sat elsewhere in the house"""
+        if not iface:
+            return 0
+        return zlib.crc32("{}/{}".format(self.mac, iface).encode()) % 41 - 20
+
+    def advertisement(self):
+        return {0x01: b"\x06", 0x09: self.local_name}
+
+    def read(self, handle):
+        return None
+
+    def write(self, handle, value):
+        """Handle a GATT write, returns the notifications it triggers as (handle, data)"""
+        if value == CCCD_ENABLE:
+            self.notifying.add(handle - 1)
+            return self.on_subscribe(handle - 1)
+        return []
+
+    def on_subscribe(self, handle):
+        return []
+
+    def poll_notifications(self):
+        """Notifications a device sends on its own while the client waits for them"""
+        return []
+
+
+class BeaconDevice(SimulatedDevice):
+    connectable = False
+    local_name = b"Beacon"
+
+
+class MifloraDevice(SimulatedDevice):
+    kind = "miflora"
+    local_name = b"Flower care"
+
+    def _setup(self):
+        self.battery = self.rng.randint(20, 100)
+        self.temperature = self.rng.uniform(15, 28)
+        self.moisture = self.rng.uniform(10, 60)
+        self.light = self.rng.uniform(50, 3000)
+        self.conductivity = self.rng.uniform(100, 1500)
+
+    def read(self, handle):
+        if handle == 0x03:
+            return self.local_name
+        if handle == 0x38:
+            return bytes([self.battery, 0x14]) + b"3.2.1"
+        if handle == 0x35:
+            self.temperature = self._drift(self.temperature, 0.3, -10, 50)
+            self.moisture = self._drift(self.moisture, 0.5, 0, 100)
+            self.light = self._drift(self.light, 100, 0, 100000)
+            self.conductivity = self._drift(self.conductivity, 10, 0, 10000)
+            # Firmware 2.6.6+ fills the trailing bytes, the library rejects them when zero
+            return struct.pack(
+                "<hxIBh6s",
+                int(self.temperature * 10),
+                int(self.light),
+                int(self.moisture),
+                int(self.conductivity),
+                b"\x02\x3c\x00\xfb\x34\x9b",
+            )
+        return None
+
+
+class MithermometerDevice(SimulatedDevice):
+    kind = "mithermometer"
+    local_name = b"MJ_HT_V1"
+
+    def _setup(self):
+        self.battery = self.rng.randint(20, 100)
+        self.temperature = self.rng.uniform(18, 26)
+        self.humidity = self.rng.uniform(30, 70)
+
+    def read(self, handle):
+        if handle == 0x03:
+            return self.local_name
+        if handle == 0x24:
+            return b"00.00.66"
+        if handle == 0x18:
+            return bytes([self.battery])
+        return None
+
+    def write(self, handle, value):
+        if handle == 0x10 and value == CCCD_ENABLE:
+            self.temperature = self._drift(self.temperature, 0.2, -20, 60)
+            self.humidity = self._drift(self.humidity, 0.5, 0, 100)
+            data = "T={:.1f} H={:.1f}".format(self.temperature, self.humidity)
+            return [(0x0E, data.encode("ascii") + b"\x00")]
+        return super().write(handle, value)
+
+
+class Lywsd02Device(SimulatedDevice):
+    kind = "lywsd02"
+    local_name = b"LYWSD02"
+    UUID_DATA = "ebe0ccc1-7a0a-4b0c-8a1a-6ff2997da3a6"
+    UUID_BATT = "ebe0ccc4-7a0a-4b0c-8a1a-6ff2997da3a6"
+    gatt = [
+        GattService(
+            "ebe0ccb0-7a0a-4b0c-8a1a-6ff2997da3a6",
+            [
+                GattCharacteristic(UUID_DATA, 0x4B, PROP_READ | PROP_NOTIFY),
+                GattCharacteristic(UUID_BATT, 0x52, PROP_READ),
+            ],
+        )
+    ]
+
+    def _setup(self):
+        self.battery = self.rng.randint(20, 100)
+        self.temperature = self.rng.uniform(18, 26)
+        self.humidity = self.rng.randint(30, 70)
+
+    def read(self, handle):
+        if handle == 0x52:
+            return bytes([self.battery])
+        return None
+
+    def on_subscribe(self, handle):
+        self.temperature = self._drift(self.temperature, 0.2, -20, 60)
+        self.humidity = int(self._drift(self.humidity, 1, 0, 100))
+        return [(0x4B, struct.pack("<HB", int(self.temperature * 100), self.humidity))]
+
+
+class Lywsd03MmcDevice(SimulatedDevice):
+    kind = "lywsd03mmc"
+    local_name = b"LYWSD03MMC"
+
+    def _setup(self):
+        self.voltage = self.rng.randint(2600, 3100)
+        self.temperature = self.rng.uniform(18, 26)
+        self.humidity = self.rng.randint(30, 70)
+
+    def poll_notifications(self):
+        self.temperature = self._drift(self.temperature, 0.2, -20, 60)
+        self.humidity = int(self._drift(self.humidity, 1, 0, 100))
+        return [
+            (0x36, struct.pack("<hBH", int(self.temperature * 100), self.humidity, self.voltage))
+        ]
+
+
+class Eq3Device(SimulatedDevice):
+    """eQ-3 radiator thermostat, answers every command on 0x411 with a status on 0x421"""
+
+    kind = "thermostat"
+    local_name = b"CC-RT-BLE"
+    MODE_AUTO = 0x00
+    MODE_MANUAL = 0x01
+    MODE_AWAY = 0x02
+    MODE_BOOST = 0x04
+    MODE_LOCKED = 0x20
+
+    def _setup(self):
+        self.mode = self.MODE_AUTO
+        self.target = 20.0
+        self.valve = self.rng.randint(0, 100)
+        self.comfort = 21.0
+        self.eco = 17.0
+        self.locked = False
+
+    def write(self, handle, value):
+        if handle != 0x411 or not value:
+            return super().write(handle, value)
+        command = value[0]
+        if command == 0x41 and len(value) > 1:
+            self.target = value[1] / 2
+            self.mode = self.MODE_MANUAL
+        elif command == 0x40 and len(value) > 1:
+            if value[1] & 0x80:
+                self.mode = self.MODE_AWAY
+                self.target = (value[1] & 0x7F) / 2
+            elif value[1] & 0x40:
+                self.mode = self.MODE_MANUAL
+                if value[1] & 0x3F:
+                    self.target = (value[1] & 0x3F) / 2
+            else:
+                self.mode = self.MODE_AUTO
+        elif command == 0x45 and len(value) > 1:
+            self.mode = self.MODE_BOOST if value[1] else self.MODE_AUTO
+        elif command == 0x43:
+            self.target = self.comfort
+        elif command == 0x44:
+            self.target = self.eco
+        elif command == 0x80 and len(value) > 1:
+            self.locked = bool(value[1])
+        self.valve = int(self._drift(self.valve, 5, 0, 100))
+        return [(0x421, self.status())]
+
+    def status(self):
+        mode = self.mode | (self.MODE_LOCKED if self.locked else 0)
+        return bytes(
+            [
+                0x02,
+                0x01,
+                mode,
+                self.valve,
+                0x04,
+                int(self.target * 2),
+                0x00,
+                0x00,
+                0x00,
+                0x00,
+                24,  # window open temperature
+                3,  # window open time
+                int(self.comfort * 2),
+                int(self.eco * 2),
+                7,  # offset 0.0
+            ]
+        )
+
+
+class SwitchbotDevice(SimulatedDevice):
+    kind = "switchbot"
+    addr_type = "random"
+    local_name = b"WoHand"
+    gatt = [
+        GattService(
+            "cba20d00-224d-11e6-9fb8-0002a5d5c51b",
+            [GattCharacteristic("cba20002-224d-11e6-9fb8-0002a5d5c51b", 0x16, PROP_WRITE)],
+        )
+    ]
+
+    def _setup(self):
+        self.state = 0x02
+
+    def write(self, handle, value):
+        if handle == 0x16 and value[:2] == b"\x57\x01":
+            self.state = value[2] if len(value) > 2 else 0
+            return []
+        return super().write(handle, value)
+
+
+class IbbqDevice(SimulatedDevice):
+    """Inkbird BBQ thermometer, streams probe temperatures once realtime data is enabled"""
+
+    kind = "ibbq"
+    local_name = b"iBBQ"
+    SETTING_RESULT = 0x25
+    REALTIME_DATA = 0x30
+    gatt = [
+        GattService(
+            "0000fff0-0000-1000-8000-00805f9b34fb",
+            [
+                GattCharacteristic("fff1", SETTING_RESULT, PROP_READ | PROP_NOTIFY),
+                GattCharacteristic("fff2", 0x28, PROP_WRITE),
+                GattCharacteristic("fff4", REALTIME_DATA, PROP_NOTIFY),
+                GattCharacteristic("fff5", 0x34, PROP_WRITE),
+            ],
+        )
+    ]
+
+    def _setup(self):
+        self.probes = [self.rng.uniform(20, 80) for _ in range(self.rng.choice((2, 4)))]
+        self.battery = self.rng.randint(20, 100)
+        self.streaming = False
+        self._sent_in_round = False
+
+    def write(self, handle, value):
+        if handle == 0x34 and value[:2] == b"\x08\x24":
+            max_voltage = 6550
+            voltage = int((self.battery / 100 * 0.55 + 0.95) / 1.5 * max_voltage)
+            return [(self.SETTING_RESULT, b"\x24" + struct.pack("<HH", voltage, max_voltage))]
+        if handle == 0x34 and value[:2] == b"\x0b\x01":
+            self.streaming = True
+            return []
+        return super().write(handle, value)
+
+    def poll_notifications(self):
+        # One frame per waiting round, the worker drains notifications until a wait times out
+        if not self.streaming or self._sent_in_round:
+            self._sent_in_round = False
+            return []
+        self._sent_in_round = True
+        self.probes = [self._drift(probe, 0.5, 0, 300) for probe in self.probes]
+        return [
+            (
+                self.REALTIME_DATA,
+                b"".join(struct.pack("<H", int(probe * 10)) for probe in self.probes),
+            )
+        ]
+
+
+class OralBDevice(SimulatedDevice):
+    kind = "toothbrush"
+    connectable = False
+    local_name = b"Oral-B Toothbrush"
+
+    def _setup(self):
+        self.state = 2
+        self.seconds = 0
+
+    def advertisement(self):
+        if self.rng.random() < 0.2:
+            self.state = 3 if self.state != 3 else 2
+        self.seconds = self.seconds + 5 if self.state == 3 else 0
+        mode = 1 if self.state == 3 else 0
+        sector = (self.seconds // 30) % 4 if self.state == 3 else 255
+        data = bytes(
+            [
+                0xDC,
+                0x00,
+                0x02,
+                0x01,
+                0x08,
+                self.state,
+                self.rng.choice((0x32, 0x72, 0x90)),
+                self.seconds // 60,
+                self.seconds % 60,
+                mode,
+                sector,
+                0x00,
+            ]
+        )
+        return {0x01: b"\x06", 0xFF: data}
+
+
+class MiScaleDevice(SimulatedDevice):
+    kind = "miscale"
+    connectable = False
+    local_name = b"MI SCALE2"
+
+    def _setup(self):
+        self.weight = self.rng.uniform(50, 95)
+
+    def advertisement(self):
+        now = datetime.fromtimestamp(clock.time())
+        data = (
+            bytes([0x1D, 0x18, 0x22])
+            + struct.pack("<H", int(self.weight * 200))
+            + struct.pack("<HBBBBB", now.year, now.month, now.day, now.hour, now.minute, now.second)
+        )
+        return {0x01: b"\x06", 0x16: data}
+
+
+class RuuviTagDevice(SimulatedDevice):
+    """RuuviTag broadcasting data format 5 (RAWv2)"""
+
+    kind = "ruuvitag"
+    connectable = False
+    local_name = b"Ruuvi"
+
+    def _setup(self):
+        self.temperature = self.rng.uniform(0, 25)
+        self.humidity = self.rng.uniform(30, 80)
+        self.sequence = 0
+
+    def advertisement(self):
+        self.temperature = self._drift(self.temperature, 0.1, -40, 85)
+        self.sequence = (self.sequence + 1) % 65535
+        mac = bytes(int(part, 16) for part in self.mac.split(":"))
+        data = struct.pack(
+            ">BBBhHHhhhHBH6s",
+            0x99,
+            0x04,
+            0x05,
+            int(self.temperature / 0.005),
+            int(self.humidity / 0.0025),
+            101325 - 50000,
+            0,
+            0,
+            1000,
+            ((2900 - 1600) << 5) | ((4 + 40) // 2),
+            0,
+            self.sequence,
+            mac,
+        )
+        return {0x01: b"\x06", 0xFF: data}
+
+
+# Device models used for the devices configured on each worker
+class ReplayDevice(SimulatedDevice):
+    """Plays back the advertisements, reads and notifications of one device from a capture, in order"""
+
+    kind = "replay"
+
+    def __init__(self, mac, farm, records):
+        import capture
+
+        self._advertisements = [record for record in records if record.kind == capture.ADVERTISEMENT]
+        self._notifications = [record for record in records if record.kind == capture.NOTIFICATION]
+        self._reads = {}
+        for record in records:
+            if record.kind == capture.READ:
+                self._reads.setdefault(record.handle, []).append(record.data)
+        super().__init__(mac, farm)
+        if self._advertisements:
+            self.addr_type = self._advertisements[0].addr_type
+            self.connectable = self._advertisements[0].connectable
+            self.rssi = self._advertisements[0].rssi
+
+    def advertisement(self):
+        if not self._advertisements:
+            return None
+        record = self._advertisements.pop(0)
+        self.rssi = record.rssi
+        return record.scan_data()
+
+    def sample_rssi(self, iface=0):
+        return self.rssi
+
+    def read(self, handle):
+        values = self._reads.get(handle)
+        if not values:
+            return None
+        # The last value is repeated once the capture runs out
+        return values.pop(0) if len(values) > 1 else values[0]
+
+    def poll_notifications(self):
+        if not self._notifications:
+            return []
+        record = self._notifications.pop(0)
+        return [(record.handle, record.data)]
+
+
+WORKER_DEVICES = {
+    "blescanmulti": BeaconDevice,
+    "ibbq": IbbqDevice,
+    "lywsd02": Lywsd02Device,
+    "lywsd03mmc": Lywsd03MmcDevice,
+    "miflora": MifloraDevice,
+    "miscale": MiScaleDevice,
+    "mithermometer": MithermometerDevice,
+    "ruuvitag": RuuviTagDevice,
+    "switchbot": SwitchbotDevice,
+    "thermostat": Eq3Device,
+    "toothbrush": OralBDevice,
+    "toothbrush_homeassistant": OralBDevice,
+}
+DEVICE_TYPES = {klass.kind: klass for klass in WORKER_DEVICES.values()}
+
+
+class DeviceFarm:
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.get("seed"))
+        self.time_scale = float(config.get("time_scale", 1.0))
+
+        latency = config.get("latency", {})
+        self.connect_latency = Distribution(
+            latency.get("connect", {"distribution": "lognormal", "mean": 1.0, "sigma": 0.5}),
+            self.rng,
+        )
+        self.io_latency = Distribution(
+            latency.get("io", {"distribution": "exponential", "mean": 0.05}), self.rng
+        )
+
+        failure_rate = config.get("failure_rate", {})
+        self.connect_failure_rate = float(failure_rate.get("connect", 0.0))
+        self.io_failure_rate = float(failure_rate.get("io", 0.0))
+        self.scan_failure_rate = float(failure_rate.get("scan", 0.0))
+        self.hang_rate = float(failure_rate.get("hang", 0.0))
+        self.disconnect_rate = float(config.get("disconnect_rate", 0.0))
+        self.advertisement_loss = float(config.get("advertisement_loss", 0.0))
+
+        self.devices = {}
+        self._helpers = {}
+        self._helper_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, device):
+        self.devices[device.mac] = device
+        return device
+
+    def get(self, mac):
+        return self.devices.get(str(mac).lower())
+
+    def sleep(self, seconds):
+        if seconds > 0 and self.time_scale > 0:
+            clock.sleep(seconds * self.time_scale)
+
+    def fails(self, rate):
+        return rate > 0 and self.rng.random() < rate
+
+    def advertisements(self):
+        for device in list(self.devices.values()):
+            if self.fails(self.advertisement_loss):
+                continue
+            scan_data = device.advertisement()
+            if scan_data:
+                yield device, scan_data
+
+    def helper_started(self, helper):
+        """Returns a token for the started helper process, it outlives a helper object that is not stopped"""
+        with self._lock:
+            token = next(self._helper_ids)
+            self._helpers[token] = type(helper).__name__
+            return token
+
+    def helper_stopped(self, token):
+        with self._lock:
+            self._helpers.pop(token, None)
+
+    @property
+    def helper_count(self):
+        """The simulated counterpart of running bluepy-helper processes"""
+        with self._lock:
+            return len(self._helpers)
+
+    def helper_owners(self):
+        """Running helpers by the bluepy class that started them"""
+        with self._lock:
+            return dict(collections.Counter(self._helpers.values()))
+
+    def add_configured(self, workers_config):
+        """Create a device for every MAC address configured on a worker with a known device model"""
+        for worker_name, worker_config in workers_config.items():
+            klass = WORKER_DEVICES.get(worker_name)
+            if klass is None:
+                _LOGGER.warning("No simulated device model for %s worker", worker_name)
+                continue
+            for mac in _configured_macs(worker_config.get("args", {})):
+                # Scanners track devices polled by other workers, keep the specific model
+                existing = self.get(mac)
+                if existing is not None and type(existing) is not BeaconDevice and klass is BeaconDevice:
+                    continue
+                self.add(klass(mac, self))
+
+    def add_extra(self, devices_config):
+        for entry in devices_config:
+            klass = DEVICE_TYPES[entry.get("type", BeaconDevice.kind)]
+            if "mac" in entry:
+                self.add(klass(entry["mac"], self))
+            for index in range(entry.get("count", 0)):
+                self.add(klass(generate_mac(entry.get("mac_prefix", "02:00:00"), index), self))
+
+
+    def add_replay(self, path):
+        import capture
+
+        records = {}
+        for record in capture.read(path):
+            records.setdefault(record.address, []).append(record)
+        for mac, device_records in records.items():
+            self.add(ReplayDevice(mac, self, device_records))
+        _LOGGER.info("Replaying %d devices from %s", len(records), path)
+
+
+def _configured_macs(args):
+    if "mac" in args:
+        yield args["mac"]
+    for value in args.get("devices", {}).values():
+        if isinstance(value, dict):
+            if "mac" in value:
+                yield value["mac"]
+        else:
+            yield value
+
+
+def generate_mac(prefix, index):
+    parts = prefix.split(":")
+    suffix = ["{:02x}".format((index >> shift) & 0xFF) for shift in (16, 8, 0)]
+    return ":".join(parts + suffix[len(parts) - 3:])
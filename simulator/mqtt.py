@@ -0,0 +1,82 @@
+"""
+In-process stand-in for the MQTT broker connection, for running the gateway without a broker.
+"""
+import threading
+from collections import deque, namedtuple
+
+from paho.mqtt.client import MQTT_ERR_SUCCESS, topic_matches_sub
+
+from mqtt import MqttClient
+import logger
+
+_LOGGER = logger.get(__name__)
+
+LocalMessageInfo = namedtuple("LocalMessageInfo", "rc mid")
+LocalMessage = namedtuple("LocalMessage", "topic payload qos retain")
+
+
+class LocalBroker:
+    """Implements the part of paho's Client API used by MqttClient"""
+
+    def __init__(self, userdata=None, keep=1000):
+        self.on_connect = None
+        self.published = deque(maxlen=keep)
+        self.published_count = 0
+        self.retained = {}
+        self._userdata = userdata
+        self._subscriptions = []
+        self._lock = threading.Lock()
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def tls_insecure_set(self, value):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+    def connect(self, host, port=1883, *args, **kwargs):
+        _LOGGER.info("Using the local MQTT stand-in instead of %s:%d", host, port)
+
+    def loop_start(self):
+        if self.on_connect is not None:
+            self.on_connect(self, self._userdata, {}, 0)
+
+    def message_callback_add(self, sub, callback):
+        with self._lock:
+            self._subscriptions.append((sub, callback))
+
+    def subscribe(self, topic, qos=0):
+        return MQTT_ERR_SUCCESS, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        message = LocalMessage(topic, payload, qos, retain)
+        with self._lock:
+            self.published.append(message)
+            self.published_count += 1
+            if retain:
+                self.retained[topic] = payload
+        return LocalMessageInfo(MQTT_ERR_SUCCESS, self.published_count)
+
+    def inject(self, topic, payload):
+        """Deliver a message to the gateway as if a client published it"""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        message = LocalMessage(topic, payload, 0, False)
+        with self._lock:
+            callbacks = [callback for sub, callback in self._subscriptions if topic_matches_sub(sub, topic)]
+        for callback in callbacks:
+            callback(self, self._userdata, message)
+
+
+class LocalMqttClient(MqttClient):
+    def _create_client(self):
+        return LocalBroker(userdata={"global_topic_prefix": self.topic_prefix})
+
+    @property
+    def hostname(self):
+        return self._config.get("host", "localhost")
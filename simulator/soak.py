@@ -0,0 +1,248 @@
+"""
+Soak test: runs the gateway for hours of virtual time against simulated devices and fails when
+memory, threads or bluepy-helper processes keep growing from one cycle to the next.
+
+    python -m simulator.soak --hours 48 --cycle 3600
+    python -m simulator.soak -c config.yaml   # the workers and simulation section of a config
+"""
+import argparse
+import gc
+import json
+import logging
+import sys
+import threading
+import tracemalloc
+
+import logger
+
+# Poll intervals are shortened to get many cycles through every code path
+DEFAULT_FLEET = {
+    "lywsd03mmc": {"count": 5, "update_interval": 120},
+    "lywsd02": {"count": 5, "update_interval": 120},
+    "ibbq": {"count": 2, "update_interval": 30},
+    "toothbrush": {"count": 2, "update_interval": 60},
+    "toothbrush_homeassistant": {"count": 2, "update_interval": 60},
+    "blescanmulti": {"count": 10, "update_interval": 60},
+}
+DEFAULT_SIMULATION = {
+    "seed": 1,
+    "failure_rate": {"connect": 0.05, "io": 0.01, "scan": 0.01},
+    "disconnect_rate": 0.01,
+    "advertisement_loss": 0.2,
+}
+
+parser = argparse.ArgumentParser(prog="python -m simulator.soak")
+parser.add_argument("-c", "--config", help="Use the workers and simulation section of this config file")
+parser.add_argument("--hours", type=float, default=24, help="Virtual hours to run (default: %(default)s)")
+parser.add_argument(
+    "--cycle", type=float, default=3600, help="Virtual seconds between samples (default: %(default)s)"
+)
+parser.add_argument(
+    "--warmup", type=int, default=2, help="Cycles ignored while caches fill up (default: %(default)s)"
+)
+parser.add_argument(
+    "--max-memory-growth",
+    type=float,
+    default=64,
+    metavar="KB",
+    help="Allowed traced memory growth per cycle (default: %(default)s)",
+)
+parser.add_argument(
+    "--max-thread-growth",
+    type=float,
+    default=0.1,
+    help="Allowed thread count growth per cycle (default: %(default)s)",
+)
+parser.add_argument(
+    "--max-helper-growth",
+    type=float,
+    default=0.1,
+    help="Allowed bluepy-helper process growth per cycle (default: %(default)s)",
+)
+parser.add_argument("--top", type=int, default=10, help="Allocation sites reported on failure")
+parser.add_argument("--report", help="Write the samples and verdict as JSON to this file")
+
+
+def fleet_config():
+    from simulator.devices import generate_mac
+
+    workers = {}
+    prefixes = {}
+    for index, (worker, options) in enumerate(DEFAULT_FLEET.items()):
+        prefixes[worker] = "02:{:02x}:00".format(index + 1)
+        devices = {
+            "{}_{}".format(worker, number): generate_mac(prefixes[worker], number).upper()
+            for number in range(options["count"])
+        }
+        workers[worker] = {
+            "args": {"devices": devices, "topic_prefix": worker},
+            "update_interval": options["update_interval"],
+        }
+    workers["toothbrush_homeassistant"]["args"]["devices"] = {
+        name: {"name": name, "mac": mac}
+        for name, mac in workers["toothbrush_homeassistant"]["args"]["devices"].items()
+    }
+    workers["toothbrush_homeassistant"]["args"]["autodiscovery_prefix"] = "homeassistant"
+    # The presence scanner tracks the polled devices as well
+    workers["blescanmulti"]["args"]["devices"].update(workers["lywsd02"]["args"]["devices"])
+    workers["blescanmulti"]["args"]["scan_timeout"] = 10
+    return {"manager": {"workers": workers, "command_timeout": 35}, "simulation": dict(DEFAULT_SIMULATION)}
+
+
+def load_config(path):
+    import yaml
+
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    config.setdefault("simulation", dict(DEFAULT_SIMULATION))
+    return config
+
+
+class Sample:
+    def __init__(self, cycle, elapsed, snapshot, threads, helpers, commands):
+        self.cycle = cycle
+        self.elapsed = elapsed
+        self.snapshot = snapshot
+        self.memory = sum(stat.size for stat in snapshot.statistics("filename"))
+        self.threads = threads
+        self.helpers = helpers
+        self.commands = commands
+
+    def as_dict(self):
+        return {
+            "cycle": self.cycle,
+            "virtual_hours": round(self.elapsed / 3600, 2),
+            "traced_kb": round(self.memory / 1024, 1),
+            "threads": self.threads,
+            "helpers": self.helpers,
+            "commands": self.commands,
+        }
+
+
+def slope(values):
+    """Least squares growth per cycle, less sensitive to a single noisy cycle than first vs last"""
+    count = len(values)
+    if count < 2:
+        return 0.0
+    mean_x = (count - 1) / 2
+    mean_y = sum(values) / count
+    numerator = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+    denominator = sum((x - mean_x) ** 2 for x in range(count))
+    return numerator / denominator
+
+
+def take_snapshot():
+    gc.collect()
+    return tracemalloc.take_snapshot().filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ]
+    )
+
+
+def main():
+    args = parser.parse_args()
+    tracemalloc.start(10)
+    logger.setup()
+    logger.get().setLevel(logging.ERROR)
+
+    import clock
+    import simulator
+
+    config = load_config(args.config) if args.config else fleet_config()
+    workers = config["manager"]["workers"]
+    virtual_clock = clock.install(clock.VirtualClock())
+    farm = simulator.install(config["simulation"], workers)
+
+    from workers_manager import WorkersManager
+
+    manager = WorkersManager(config["manager"])
+    manager.register_workers(config.get("mqtt", {}).get("topic_prefix"))
+    mqtt = simulator.LocalMqttClient(config.get("mqtt", {"host": "localhost"}))
+    manager.start(mqtt)
+
+    cycles = max(int(args.hours * 3600 / args.cycle), 1)
+    if cycles <= args.warmup + 1:
+        parser.error("--hours must cover more than {} cycles".format(args.warmup + 1))
+
+    samples = []
+    commands = 0
+    print("cycle  hours  traced KB  delta KB  threads  helpers  commands")
+    for cycle in range(1, cycles + 1):
+        commands += simulator.run_virtual(mqtt, args.cycle)
+        sample = Sample(
+            cycle, virtual_clock.monotonic(), take_snapshot(),
+            threading.active_count(), farm.helper_count, commands,
+        )
+        delta = (sample.memory - samples[-1].memory) / 1024 if samples else 0
+        samples.append(sample)
+        print(
+            "{:>5}  {:>5.1f}  {:>9.1f}  {:>+8.1f}  {:>7}  {:>7}  {:>8}{}".format(
+                cycle, sample.elapsed / 3600, sample.memory / 1024, delta,
+                sample.threads, sample.helpers, commands,
+                "  (warm up)" if cycle <= args.warmup else "",
+            )
+        )
+
+    measured = samples[args.warmup:]
+    growth = {
+        "memory_kb": slope([sample.memory / 1024 for sample in measured]),
+        "threads": slope([sample.threads for sample in measured]),
+        "helpers": slope([sample.helpers for sample in measured]),
+    }
+    limits = {
+        "memory_kb": args.max_memory_growth,
+        "threads": args.max_thread_growth,
+        "helpers": args.max_helper_growth,
+    }
+    failures = [name for name, value in growth.items() if value > limits[name]]
+
+    print()
+    for name, value in growth.items():
+        print(
+            "{:<10} {:+.2f} per cycle (limit {}){}".format(
+                name, value, limits[name], "  FAILED" if name in failures else ""
+            )
+        )
+
+    if "helpers" in failures:
+        print("\nRunning bluepy-helpers: {}".format(
+            ", ".join("{} started by {}".format(count, owner) for owner, count in sorted(farm.helper_owners().items()))
+        ))
+
+    top = []
+    if "memory_kb" in failures:
+        stats = measured[-1].snapshot.compare_to(measured[0].snapshot, "traceback")
+        print("\nLargest growth since the end of the warm up:")
+        for stat in stats[:args.top]:
+            frame = stat.traceback[0]
+            top.append({"size_diff_kb": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff,
+                        "traceback": stat.traceback.format()})
+            print("{:+10.1f} KB {:+7} blocks  {}:{}".format(
+                stat.size_diff / 1024, stat.count_diff, frame.filename, frame.lineno
+            ))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(
+                {
+                    "samples": [sample.as_dict() for sample in samples],
+                    "warmup": args.warmup,
+                    "growth_per_cycle": growth,
+                    "limits": limits,
+                    "failed": failures,
+                    "helper_owners": farm.helper_owners(),
+                    "top_allocations": top,
+                },
+                f,
+                indent=2,
+            )
+
+    manager._scheduler.shutdown(wait=False)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Periodic gateway self-statistics published over MQTT, with Home Assistant discovery.
+"""
+import os
+
+from mqtt import MqttMessage, MqttConfigMessage
+from workers_queue import _WORKERS_QUEUE
+import clock
+import logger
+import metrics
+
+_LOGGER = logger.get(__name__)
+
+DEFAULT_TOPIC = "gateway/stats"
+DEFAULT_INTERVAL = 60  # In seconds
+
+# (attribute, name suffix, unit_of_measurement, icon)
+SENSORS = [
+    ("uptime", "uptime", "s", "mdi:timer-outline"),
+    ("queue_depth", "queue_depth", None, "mdi:tray-full"),
+    ("commands_per_second", "commands_per_second", "cmd/s", "mdi:speedometer"),
+    ("devices_healthy", "devices_healthy", None, "mdi:bluetooth-connect"),
+    ("devices_failing", "devices_failing", None, "mdi:bluetooth-off"),
+    ("mqtt_reconnects", "mqtt_reconnects", None, "mdi:lan-disconnect"),
+    ("rss_mb", "rss", "MB", "mdi:memory"),
+    ("cpu_percent", "cpu", "%", "mdi:cpu-64-bit"),
+]
+
+
+class GatewayStats:
+    def __init__(self, config, global_topic_prefix, workers=None, isolation=None):
+        self.topic = config.get("topic", DEFAULT_TOPIC)
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.global_topic_prefix = global_topic_prefix
+        self._workers = workers or {}  # Worker names by class name, commands are timed by class
+        self._isolation = isolation
+        self._started = clock.monotonic()
+        self._last_report = self._started
+        self._last_cpu = _cpu_seconds()
+        self._last_commands = _total(metrics.COMMAND_RESULTS)
+        self._last_devices = _device_results()
+
+    def format_prefixed_topic(self):
+        if self.global_topic_prefix:
+            return "{}/{}".format(self.global_topic_prefix, self.topic)
+        return self.topic
+
+    @property
+    def node_id(self):
+        if self.global_topic_prefix:
+            return "bt-mqtt-gateway-{}".format(self.global_topic_prefix.replace("/", "-"))
+        return "bt-mqtt-gateway"
+
+    def config(self):
+        ret = []
+        device = {
+            "identifiers": [self.node_id],
+            "manufacturer": "bt-mqtt-gateway",
+            "model": "Gateway",
+            "name": self.node_id,
+        }
+        for attr, suffix, unit, icon in SENSORS:
+            payload = {
+                "unique_id": "{}/{}".format(self.node_id, suffix),
+                "name": "{}_{}".format(self.node_id, suffix),
+                "state_topic": self.format_prefixed_topic(),
+                "value_template": "{{{{ value_json.{} }}}}".format(attr),
+                "icon": icon,
+                "device": device,
+            }
+            if unit:
+                payload["unit_of_measurement"] = unit
+            if attr == "queue_depth":
+                payload["json_attributes_topic"] = self.format_prefixed_topic()
+                payload["json_attributes_template"] = "{{ value_json.workers | tojson }}"
+            ret.append(
+                MqttConfigMessage(
+                    MqttConfigMessage.SENSOR,
+                    "{}/{}".format(self.node_id, suffix),
+                    payload=payload,
+                )
+            )
+        return ret
+
+    def collect(self):
+        now = clock.monotonic()
+        elapsed = max(now - self._last_report, 1e-6)
+        cpu = _cpu_seconds()
+        commands = _total(metrics.COMMAND_RESULTS)
+        devices = _device_results()
+
+        healthy, failing = 0, 0
+        for device, (successes, failures) in devices.items():
+            previous_successes, previous_failures = self._last_devices.get(device, (0, 0))
+            if successes > previous_successes:
+                healthy += 1
+            elif failures > previous_failures:
+                failing += 1
+
+        lanes = self._isolation.queue_depths() if self._isolation is not None else {}
+        ret = {
+            "uptime": int(now - self._started),
+            "queue_depth": _WORKERS_QUEUE.qsize() + sum(lanes.values()),
+            "lanes": lanes,
+            "commands_per_second": round((commands - self._last_commands) / elapsed, 3),
+            "devices_healthy": healthy,
+            "devices_failing": failing,
+            "mqtt_reconnects": max(int(metrics.MQTT_CONNECTS.value()) - 1, 0),
+            "rss_mb": round(_rss_bytes() / 1024 / 1024, 1),
+            "cpu_percent": round((cpu - self._last_cpu) / elapsed * 100, 1),
+            "workers": _command_durations(self._workers),
+        }
+
+        self._last_report = now
+        self._last_cpu = cpu
+        self._last_commands = commands
+        self._last_devices = devices
+        return ret
+
+    def status_update(self):
+        return [MqttMessage(topic=self.topic, payload=self.collect(), retain=False)]
+
+
+def _total(counter):
+    return sum(value for _, value in counter.items())
+
+
+def _device_results():
+    ret = {}
+    for (device, _, result), value in metrics.DEVICE_RESULTS.items():
+        successes, failures = ret.get(device, (0, 0))
+        if result == "success":
+            successes += value
+        else:
+            failures += value
+        ret[device] = (successes, failures)
+    return ret
+
+
+def _command_durations(workers):
+    by_worker = {}
+    for (source,), durations in metrics.COMMAND_DURATION.recent().items():
+        klass = source.split(".")[0]
+        by_worker.setdefault(workers.get(klass, klass), []).extend(durations)
+    ret = {}
+    for worker, durations in by_worker.items():
+        if not durations:
+            continue
+        ordered = sorted(durations)
+        ret[worker] = {
+            "avg": round(sum(ordered) / len(ordered), 3),
+            "p95": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 3),
+            "count": len(ordered),
+        }
+    return ret
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        # Peak instead of current RSS, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,80 @@
+import json
+import sys
+import threading
+import types
+
+import pytest
+
+import clock
+import simulator
+import workers_manager
+from simulator.mqtt import LocalMqttClient
+from workers_manager import WorkersManager
+from workers_queue import _WORKERS_QUEUE
+
+
+class Client:
+    """Collects the messages published by a worker run without a broker"""
+
+    def __init__(self):
+        self.published = threading.Event()
+        self.messages = []
+
+    def publish(self, messages):
+        self.messages += messages
+        self.published.set()
+
+
+class Gateway:
+    """A manager set up by register_workers and started on the local MQTT stand-in"""
+
+    def __init__(self, config):
+        self.manager = WorkersManager(config)
+        self.manager.register_workers(None)
+        self.mqtt = LocalMqttClient({"host": "localhost"})
+        self.manager.start(self.mqtt)
+
+    def inject(self, topic, payload):
+        self.mqtt.mqttc.inject(topic, payload if isinstance(payload, (str, bytes)) else json.dumps(payload))
+
+    def published(self, topic):
+        return [json.loads(message.payload) for message in self.mqtt.mqttc.published if message.topic == topic]
+
+    def run_until(self, seconds):
+        """Runs the queue and the jobs due until ``seconds`` of virtual time"""
+        simulator.run_virtual(self.mqtt, seconds - clock.monotonic())
+        clock.get().advance(seconds - clock.monotonic())
+
+
+@pytest.fixture
+def virtual_clock(monkeypatch):
+    monkeypatch.setattr(clock, "_clock", clock.VirtualClock(start=0))
+    monkeypatch.setattr(workers_manager, "_last_values", {})
+    yield clock.get()
+    while not _WORKERS_QUEUE.empty():
+        _WORKERS_QUEUE.get_nowait()
+
+
+@pytest.fixture
+def client():
+    return Client()
+
+
+@pytest.fixture
+def gateway(monkeypatch, virtual_clock):
+    """
+    Starts a gateway from a manager config, its workers given as ``{name: (class, config)}``.
+    Each class is registered as the ``workers.<name>`` module, as register_workers imports it.
+    """
+
+    def start(workers, **config):
+        for name, (klass, _) in workers.items():
+            module = types.ModuleType("workers." + name)
+            module.REQUIREMENTS = None
+            setattr(module, "{}Worker".format(name.title()), klass)
+            monkeypatch.setattr(klass, "__module__", module.__name__)
+            monkeypatch.setitem(sys.modules, module.__name__, module)
+        config["workers"] = {name: worker_config for name, (_, worker_config) in workers.items()}
+        return Gateway(config)
+
+    return start
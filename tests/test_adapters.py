@@ -0,0 +1,63 @@
+from adapters import Sharding, assign
+
+UNITS = [("miflora", "plant_{}".format(number), "02:00:00:00:00:0{}".format(number)) for number in range(4)]
+
+
+def test_devices_go_to_the_least_loaded_adapter_that_hears_them():
+    rssi = {
+        0: {"02:00:00:00:00:00": -60, "02:00:00:00:00:01": -60, "02:00:00:00:00:02": -95},
+        1: {"02:00:00:00:00:00": -65, "02:00:00:00:00:01": -90, "02:00:00:00:00:02": -70},
+    }
+    fixed = {("miflora", "plant_3"): 0}
+
+    assignment = assign(UNITS, [0, 1], fixed, rssi)
+
+    assert assignment == {
+        ("miflora", "plant_0"): 1,
+        ("miflora", "plant_1"): 0,
+        ("miflora", "plant_2"): 1,
+        ("miflora", "plant_3"): 0,
+    }
+
+
+def test_rebalance_moves_as_few_devices_as_possible():
+    balanced = {("miflora", "plant_0"): 0, ("miflora", "plant_1"): 0, ("miflora", "plant_2"): 1, ("miflora", "plant_3"): 1}
+    crowded = dict(balanced)
+    crowded[("miflora", "plant_2")] = 0
+
+    assert assign(UNITS, [0, 1], current=balanced) == balanced
+    assert sum(assign(UNITS, [0, 1], current=crowded)[key] != crowded[key] for key in crowded) == 1
+
+
+def test_workers_are_sharded_by_device():
+    workers = {
+        "miflora": {"args": {"devices": {"a": "02:00:00:00:00:01", "b": "02:00:00:00:00:02"}}, "adapter": {"a": "hci1"}},
+        "miscale": {"args": {"mac": "02:00:00:00:00:03"}},
+    }
+
+    sharding = Sharding({"interfaces": ["hci0", "hci1"]}, workers)
+
+    assert sharding.workers(0) == {
+        "miflora": {"args": {"devices": {"b": "02:00:00:00:00:02"}}, "adapter": {"a": "hci1"}},
+        "miscale": workers["miscale"],
+    }
+    assert sharding.workers(1) == {"miflora": {"args": {"devices": {"a": "02:00:00:00:00:01"}}, "adapter": {"a": "hci1"}}}
+
+
+def test_exclusive_workers_get_adapters_of_their_own():
+    units = UNITS + [("miscale", None, "02:00:00:00:00:09")]
+
+    shared = assign(units, [0, 1, 2])
+    assignment = assign(units, [0, 1, 2], exclusive={"miscale"})
+
+    assert assignment[("miscale", None)] in (shared[unit[:2]] for unit in UNITS)
+    assert assignment[("miscale", None)] not in (assignment[unit[:2]] for unit in UNITS)
+    assert len({assignment[unit[:2]] for unit in UNITS}) == 2
+
+
+def test_exclusive_workers_share_the_last_adapter():
+    units = UNITS + [("miscale", None, "02:00:00:00:00:09")]
+
+    assignment = assign(units, [0], exclusive={"miscale"})
+
+    assert set(assignment.values()) == {0}
@@ -0,0 +1,29 @@
+from adaptive import AdaptiveIntervals
+from mqtt import MqttMessage
+
+
+def poll(moisture, temperature=20.0):
+    return [
+        MqttMessage(topic="miflora/herbs/moisture", payload=moisture),
+        MqttMessage(topic="miflora/herbs/sensor", payload={"temperature": temperature}),
+    ]
+
+
+def test_intervals_stretch_while_values_stay_within_the_deadband():
+    intervals = AdaptiveIntervals({"min_interval": 60, "max_interval": 1000, "deadband": {"moisture": 1}}, 300)
+
+    assert intervals.polled("herbs", poll(40)) is None
+    assert [intervals.polled("herbs", poll(moisture)) for moisture in (41, 40, 39.5, 40)] == [600, 1000, None, None]
+    assert intervals.polled("herbs", poll(40, temperature=20.5)) == 60
+    assert intervals.interval("herbs") == 60 and intervals.interval("basil") == 300
+
+
+def test_commands_bring_intervals_back_to_the_minimum():
+    intervals = AdaptiveIntervals({"min_interval": 60, "max_interval": 1000}, 60)
+
+    intervals.polled("herbs", poll(40))
+    assert intervals.polled("herbs", poll(40)) == 120
+    assert intervals.polled("herbs", [MqttMessage(topic="miflora/herbs/moisture", payload="off")]) == 60
+    assert intervals.touched("herbs") is None
+    intervals.polled("herbs", [MqttMessage(topic="miflora/herbs/moisture", payload="off")])
+    assert intervals.touched("herbs") == 60
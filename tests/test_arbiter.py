@@ -0,0 +1,62 @@
+import threading
+import time
+
+import arbiter
+
+
+class FakeScanner:
+    def __init__(self, events):
+        self.events = events
+
+    def start(self, passive=False):
+        self.events.append("start")
+
+    def stop(self):
+        self.events.append("stop")
+
+    def process(self, timeout):
+        time.sleep(timeout)
+
+
+def test_scan_pauses_for_a_connect(monkeypatch, tmp_path):
+    monkeypatch.setattr(arbiter, "_settings", dict(arbiter._settings))
+    arbiter.setup({"scan_slice": 0.05, "lock_dir": str(tmp_path)})
+    events = []
+    scanner = FakeScanner(events)
+    scan = threading.Thread(target=arbiter.process, args=(scanner, FakeScanner.process, 0.6, 0))
+    started = time.monotonic()
+    scan.start()
+
+    time.sleep(0.1)
+    requested = time.monotonic()
+    with arbiter.connecting(0):
+        waited = time.monotonic() - requested
+        events.append("connect")
+        time.sleep(0.1)
+    scan.join()
+
+    assert events == ["stop", "connect", "start"]
+    assert waited < 0.1
+    assert 0.6 <= time.monotonic() - started < 0.8
+
+
+def test_scan_returning_early_waits_out_its_slices(monkeypatch, tmp_path):
+    monkeypatch.setattr(arbiter, "_settings", dict(arbiter._settings))
+    arbiter.setup({"scan_slice": 0.1, "lock_dir": str(tmp_path)})
+    calls = []
+    started = time.monotonic()
+
+    arbiter.process(None, lambda scanner, timeout: calls.append(timeout), 0.3, 0)
+
+    assert len(calls) == 3
+    assert 0.3 <= time.monotonic() - started < 0.4
+
+
+def test_disabled_arbitration_scans_in_one_go(monkeypatch):
+    monkeypatch.setattr(arbiter, "_settings", dict(arbiter._settings))
+    arbiter.setup({"enabled": False})
+    calls = []
+
+    arbiter.process(None, lambda scanner, timeout: calls.append(timeout), 10, 0)
+
+    assert calls == [10]
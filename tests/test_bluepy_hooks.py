@@ -0,0 +1,44 @@
+import sys
+import types
+from contextlib import contextmanager
+
+import pytest
+
+import arbiter
+import bluepy_hooks
+import helper_watchdog
+import metrics
+from simulator import btle
+
+
+@pytest.fixture(autouse=True)
+def simulated_bluepy(monkeypatch):
+    monkeypatch.setitem(sys.modules, "bluepy", types.SimpleNamespace(btle=btle))
+    monkeypatch.setattr(arbiter, "_settings", dict(arbiter._settings, enabled=False))
+
+
+def test_other_failures_are_recorded_as_errors():
+    before = metrics.DEVICE_RESULTS.value("aa:bb:cc:dd:ee:01", "readCharacteristic", "error")
+
+    with pytest.raises(ValueError):
+        with bluepy_hooks.operation("readCharacteristic", "aa:bb:cc:dd:ee:01"):
+            raise ValueError("unexpected reply")
+
+    assert metrics.DEVICE_RESULTS.value("aa:bb:cc:dd:ee:01", "readCharacteristic", "error") == before + 1
+
+
+def test_connect_timeout_is_watched_when_passed_positionally(monkeypatch):
+    timeouts = []
+
+    @contextmanager
+    def request(helper, operation, device, iface, timeout):
+        timeouts.append(timeout)
+        yield
+
+    monkeypatch.setattr(helper_watchdog, "request", request)
+    connect = bluepy_hooks._connect_wrapper(lambda self, addr, *args, **kwargs: None)
+
+    connect(None, "aa:bb:cc:dd:ee:01", btle.ADDR_TYPE_PUBLIC, 0, 7)
+    connect(None, "aa:bb:cc:dd:ee:01", timeout=9)
+
+    assert timeouts == [7, 9]
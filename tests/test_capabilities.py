@@ -0,0 +1,47 @@
+import pytest
+
+import capabilities
+from capabilities import Command, Poll, Stream
+from workers.base import BaseWorker
+from workers_manager import WorkersManager
+from workers_queue import _WORKERS_QUEUE
+
+
+class PlantWorker(BaseWorker):
+    capabilities = [Poll(cost=5, per_device=True)]
+
+    def status_update(self, devices=None):
+        return [name for name, _ in self.poll_devices(devices)]
+
+    def __repr__(self):
+        return "plant"
+
+
+class SensorsWorker(BaseWorker):
+    def run(self, mqtt):
+        pass
+
+    def on_command(self, topic, value):
+        return []
+
+
+def test_capabilities_are_declared_or_implied_by_methods():
+    assert [type(capability) for capability in capabilities.of(SensorsWorker)] == [Command, Stream]
+    assert capabilities.find(capabilities.of(PlantWorker), Poll).per_device
+
+    class BrokenWorker(BaseWorker):
+        capabilities = [Stream()]
+
+    with pytest.raises(ValueError):
+        capabilities.of(BrokenWorker)
+
+
+def test_per_device_polls_are_queued_by_device():
+    worker = PlantWorker(10, None, devices={"fern": None, "cactus": None})
+    command = WorkersManager.Command(worker.status_update, 10, [], options={"per_device": True})
+
+    WorkersManager._queue_command(command)
+    queued = [_WORKERS_QUEUE.get_nowait() for _ in range(_WORKERS_QUEUE.qsize())]
+
+    assert [command.execute() for command in queued] == [["fern"], ["cactus"]]
+    assert [command.devices for command in queued] == [["fern"], ["cactus"]]
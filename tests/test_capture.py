@@ -0,0 +1,68 @@
+import sys
+import types
+
+import capture
+from simulator import btle
+
+
+class Collector(btle.DefaultDelegate):
+    def __init__(self):
+        btle.DefaultDelegate.__init__(self)
+        self.seen = []
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        self.seen.append((dev.addr, dev.rssi, isNewDev, isNewData, dev.getValueText(255)))
+
+    def handleNotification(self, cHandle, data):
+        self.seen.append((cHandle, data))
+
+
+def _record(path):
+    recorder = capture.Recorder(str(path))
+    recorder.record(capture.advertisement("AA:BB:CC:DD:EE:01", "public", -60, False, b"\x02\x01\x06\x04\xff\xdc\x00\x01"))
+    recorder.record(capture.gatt(capture.NOTIFICATION, "aa:bb:cc:dd:ee:02", 0x30, b"\x01\x02"))
+    recorder.record(capture.advertisement("aa:bb:cc:dd:ee:01", "public", -61, False, b"\x02\x01\x06\x04\xff\xdc\x00\x02"))
+    recorder.record(capture.gatt(capture.READ, "aa:bb:cc:dd:ee:02", 0x25, b"\x64"))
+    recorder.close()
+
+
+def test_compact_round_trip(tmp_path):
+    path = tmp_path / "capture.btcap"
+    _record(path)
+
+    records = list(capture.read(str(path)))
+    assert [record.kind for record in records] == [
+        capture.ADVERTISEMENT, capture.NOTIFICATION, capture.ADVERTISEMENT, capture.READ
+    ]
+    assert records[0].address == "aa:bb:cc:dd:ee:01"
+    assert records[0].rssi == -60
+    assert records[0].scan_data() == {0x01: b"\x06", 0xFF: b"\xdc\x00\x01"}
+    assert records[3].handle == 0x25 and records[3].data == b"\x64"
+
+
+def test_replay_is_deterministic(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "bluepy", types.SimpleNamespace(btle=btle))
+    path = tmp_path / "capture.btcap"
+    _record(path)
+
+    runs = []
+    for _ in range(2):
+        collector = Collector()
+        assert capture.replay(str(path), collector) == 3
+        runs.append(collector.seen)
+
+    assert runs[0] == runs[1]
+    assert runs[0] == [
+        ("aa:bb:cc:dd:ee:01", -60, True, True, "dc0001"),
+        (0x30, b"\x01\x02"),
+        ("aa:bb:cc:dd:ee:01", -61, False, True, "dc0002"),
+    ]
+
+
+def test_btsnoop_conversion(tmp_path):
+    source, destination = tmp_path / "capture.btcap", tmp_path / "capture.btsnoop"
+    _record(source)
+    capture.convert(str(source), str(destination))
+
+    data = destination.read_bytes()
+    assert data.startswith(b"btsnoop\x00\x00\x00\x00\x01\x00\x00\x03\xea")
@@ -0,0 +1,41 @@
+import pytest
+
+from clock import VirtualClock
+
+
+def test_interval_jobs_follow_virtual_time():
+    clock = VirtualClock(start=0)
+    scheduler = clock.scheduler()
+    runs = []
+    scheduler.add_job(lambda: runs.append(clock.monotonic()), 60, id="job")
+    scheduler.start()
+
+    clock.advance(24 * 60 * 60)
+
+    assert len(runs) == 24 * 60
+    assert runs[:2] == [60, 120]
+    assert clock.monotonic() == 24 * 60 * 60
+
+
+def test_missed_runs_are_coalesced():
+    clock = VirtualClock(start=0)
+    scheduler = clock.scheduler()
+    runs = []
+    scheduler.add_job(lambda: runs.append(clock.monotonic()), 10, id="job")
+    scheduler.start()
+
+    clock.sleep(35)
+    clock.advance(0)
+
+    assert runs == [35]
+    assert scheduler.next_run() == 40
+
+
+def test_timeout_expires_on_sleep():
+    clock = VirtualClock(start=0)
+    with pytest.raises(TimeoutError):
+        with clock.timeout(5, TimeoutError):
+            clock.sleep(3)
+            clock.sleep(3)
+
+    assert clock.monotonic() == 5
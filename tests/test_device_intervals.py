@@ -0,0 +1,44 @@
+import pytest
+
+import clock
+from capabilities import Poll
+from workers.base import BaseWorker
+
+
+class PlantWorker(BaseWorker):
+    capabilities = [Poll(per_device=True)]
+
+    def status_update(self, devices=None):
+        for name, _ in self.poll_devices(devices):
+            self.polls.append((clock.monotonic(), name))
+        return []
+
+
+def plant(polls, **config):
+    args = {"devices": {"greenhouse": None, "indoor": None}, "topic_prefix": "plant", "polls": polls}
+    return PlantWorker, dict(config, args=args, update_interval=60)
+
+
+def test_devices_are_polled_at_their_own_intervals_keeping_their_phase(gateway):
+    polls = []
+    gateway = gateway({"plant": plant(polls, device_intervals={"indoor": 300})})
+
+    gateway.run_until(400)
+    gateway.inject("plant/indoor/update_interval", "0")
+    gateway.run_until(420)
+
+    assert [time for time, name in polls if name == "greenhouse"] == [0, 60, 120, 180, 240, 300, 360, 420]
+    # Five minutes after its last poll with the others, then with them again
+    assert [time for time, name in polls if name == "indoor"] == [0, 300, 420]
+
+
+@pytest.mark.parametrize("payload", ["0", "-60"])
+def test_intervals_that_are_not_positive_are_ignored(gateway, payload):
+    polls = []
+    gateway = gateway({"plant": plant(polls)})
+
+    gateway.inject("plant/update_interval", payload)
+    gateway.inject("plant/indoor/update_interval", payload)
+    gateway.run_until(180)
+
+    assert [time for time, name in polls] == [0, 0, 60, 60, 120, 120, 180, 180]
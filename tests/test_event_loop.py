@@ -0,0 +1,107 @@
+import asyncio
+import inspect
+import threading
+import time
+
+import clock
+import event_loop
+from mqtt import MqttMessage
+from workers.base import BaseWorker
+from workers_manager import WorkersManager
+
+
+class StreamWorker(BaseWorker):
+    async def status_update(self):
+        for name, _ in self.poll_devices():
+            value = await self.blocking(time.sleep, 0.01)
+            yield [MqttMessage(topic=name, payload=value)]
+            await asyncio.sleep(self.delay)
+
+    async def on_command(self, topic, value):
+        return [MqttMessage(topic=topic, payload=value)]
+
+    async def run(self, mqtt):
+        mqtt.publish([MqttMessage(topic="stream", payload=threading.current_thread().name)])
+
+
+def test_coroutine_commands_run_on_the_event_loop(client):
+    worker = StreamWorker(1, None, devices={"bedroom": None, "kitchen": None}, delay=0)
+
+    poll = WorkersManager.Command(worker.status_update, 1).execute()
+    command = WorkersManager.Command(worker.on_command, 1, ["stream/set", "on"]).execute()
+
+    assert [message.topic for message in poll] == ["bedroom", "kitchen"]
+    assert [(message.topic, message.payload) for message in command] == [("stream/set", "on")]
+
+    event_loop.spawn(repr(worker), worker.run(client))
+    assert client.published.wait(1)
+    assert client.messages[0].payload == "event-loop"
+
+
+def test_plain_commands_run_without_async_generators(monkeypatch):
+    # As on Python 3.5
+    monkeypatch.delattr(inspect, "isasyncgenfunction")
+    worker = BaseWorker(1, None, topic_prefix="plain")
+
+    def status_update():
+        return [MqttMessage(topic=worker.format_topic("state"), payload="on")]
+
+    assert not event_loop.is_async(status_update)
+    assert [message.topic for message in WorkersManager.Command(status_update, 1).execute()] == ["plain/state"]
+
+
+def test_coroutine_timeout_keeps_partial_messages():
+    worker = StreamWorker(0.3, None, devices={"bedroom": None, "kitchen": None}, delay=1)
+
+    # The timeout stops the poll during the second device, the first one is still sent
+    assert [message.topic for message in WorkersManager.Command(worker.status_update, 0.3).execute()] == ["bedroom"]
+
+
+class DeadlineWorker(BaseWorker):
+    async def status_update(self):
+        for name, _ in self.poll_devices():
+            remaining = await self.blocking(clock.remaining)
+            yield [MqttMessage(topic=name, payload=remaining)]
+
+    async def read(self, failures):
+        if failures:
+            failures.pop()
+            raise BTLEDisconnectError()
+        return clock.remaining()
+
+
+class BTLEDisconnectError(Exception):
+    pass
+
+
+def test_coroutine_polls_keep_to_the_command_timeout():
+    worker = DeadlineWorker(2, None, devices={"bedroom": None, "kitchen": None, "garden": None})
+    worker._poll_costs["kitchen"] = 5
+
+    messages = WorkersManager.Command(worker.status_update, 2).execute()
+
+    # The kitchen doesn't fit, the blocking call sees the same deadline as the coroutine
+    assert [message.topic for message in messages] == ["bedroom", "garden"]
+    assert all(0 < message.raw_payload <= 2 for message in messages)
+
+
+def test_coroutine_retries_await_their_backoff():
+    worker = DeadlineWorker(5, None, devices={})
+
+    async def poll():
+        # Another coroutine keeps running while the read backs off
+        ticks = []
+        ticker = asyncio.ensure_future(tick(ticks))
+        remaining = await worker.retry_async("bedroom", worker.read, [None])
+        ticker.cancel()
+        return [MqttMessage(topic="bedroom", payload=remaining), MqttMessage(topic="ticks", payload=len(ticks))]
+
+    async def tick(ticks):
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0.01)
+
+    remaining, ticks = WorkersManager.Command(poll, 5).execute()
+
+    assert 0 < remaining.raw_payload <= 5
+    assert ticks.raw_payload > 5
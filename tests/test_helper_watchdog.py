@@ -0,0 +1,95 @@
+import collections
+import contextlib
+import threading
+
+import pytest
+
+from exceptions import DeviceTimeoutError
+import helper_watchdog
+
+
+class FakeHelper:
+    def __init__(self):
+        self.returncode = None
+        self.exited = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.exited.wait(timeout)
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+        self.exited.set()
+
+
+class FakePeripheral:
+    def __init__(self):
+        self._helper = FakeHelper()
+
+
+@pytest.fixture
+def watchdog(monkeypatch):
+    monkeypatch.setattr(helper_watchdog, "_settings", dict(helper_watchdog._settings))
+    monkeypatch.setattr(helper_watchdog, "_thread", object())  # Checks run by the tests
+    monkeypatch.setattr(helper_watchdog, "_results", collections.defaultdict(collections.deque))
+    monkeypatch.setattr(helper_watchdog, "_last_reset", {})
+    return helper_watchdog
+
+
+def test_hung_request_is_killed(watchdog):
+    watchdog.setup({"grace": 0, "reset": {"window": 0}})
+    peripheral = FakePeripheral()
+    helper = peripheral._helper
+    threading.Timer(0.1, watchdog._check).start()
+
+    with pytest.raises(DeviceTimeoutError):
+        with watchdog.request(peripheral, "readCharacteristic", "00:11:22:33:44:55", 0, timeout=0.05):
+            helper.wait(5)
+            raise OSError("Helper exited")
+
+    assert helper.returncode == -9
+    assert peripheral._helper is None
+
+
+def test_failing_adapter_is_reset(watchdog, monkeypatch):
+    resets = []
+    monkeypatch.setattr(watchdog, "_reset", resets.append)
+    watchdog.setup({"reset": {"window": 60, "min_failures": 3, "failure_rate": 0.8}})
+    peripheral = FakePeripheral()
+
+    def connect(failed):
+        with watchdog.request(peripheral, "connect", None, 1):
+            if failed:
+                raise OSError("Failed to connect")
+
+    for failed in (True, False, True, True):
+        with pytest.raises(OSError) if failed else contextlib.nullcontext():
+            connect(failed)
+        watchdog._check()
+    assert resets == []
+
+    with pytest.raises(OSError):
+        connect(True)
+    watchdog._check()
+
+    assert resets == [1]
+
+
+def test_adapters_are_only_reset_when_asked_for(watchdog, monkeypatch):
+    resets = []
+    monkeypatch.setattr(watchdog, "_reset", resets.append)
+    assert not watchdog.settings()["enabled"]
+    watchdog.setup({"grace": 1})
+    peripheral = FakePeripheral()
+
+    for _ in range(watchdog.DEFAULT_RESET_MIN_FAILURES + 1):
+        with pytest.raises(OSError):
+            with watchdog.request(peripheral, "connect", None, 1):
+                raise OSError("Failed to connect")
+    watchdog._check()
+
+    assert watchdog.settings()["enabled"]
+    assert resets == []
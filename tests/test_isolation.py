@@ -0,0 +1,74 @@
+import os
+import signal
+import time
+
+import pytest
+
+import isolation
+import metrics
+from exceptions import WorkerProcessError
+
+WORKERS = {
+    "lywsd02": {"args": {"devices": {"a": "02:01:00:00:00:01"}, "topic_prefix": "lywsd02"}},
+    "lywsd03mmc": {"args": {"devices": {"b": "02:02:00:00:00:01"}, "topic_prefix": "lywsd03mmc"}},
+    "mysensors": {"args": {"port": "/dev/ttyUSB0", "topic_prefix": "mysensors"}},
+}
+
+
+def test_groups_default_to_one_process_per_worker():
+    config = {"groups": {"thermo": {"workers": ["lywsd02", "lywsd03mmc"], "cpus": [1]}}, "exclude": ["mysensors"]}
+
+    assert isolation.groups(config, WORKERS) == {"thermo": {"workers": ["lywsd02", "lywsd03mmc"], "cpus": [1]}}
+    assert list(isolation.groups({}, WORKERS)) == ["lywsd02", "lywsd03mmc", "mysensors"]
+
+
+@pytest.fixture
+def process():
+    process = isolation.WorkerProcess(
+        "thermo",
+        {
+            "workers": {"lywsd02": WORKERS["lywsd02"]},
+            "command_timeout": 1,
+            "global_topic_prefix": None,
+            "simulation": {"seed": 1, "time_scale": 0},
+        },
+        hang_grace=1,
+        restart_delay=0.1,
+    )
+    process.start()
+    yield process
+    process.stop()
+
+
+def test_worker_runs_in_its_own_process(process):
+    worker = process.remote_worker("lywsd02")
+
+    messages = worker.status_update()
+
+    assert type(worker).__name__ == "Lywsd02Worker"
+    assert process.pid != os.getpid()
+    assert [message.topic for message in messages] == ["lywsd02/a"]
+
+
+def test_device_results_are_counted_in_the_gateway(process):
+    connects = metrics.DEVICE_RESULTS.value("02:01:00:00:00:01", "connect", "success")
+
+    process.remote_worker("lywsd02").status_update()
+    process.remote_worker("lywsd02").status_update()
+
+    assert metrics.DEVICE_RESULTS.value("02:01:00:00:00:01", "connect", "success") == connects + 2
+
+
+def test_hung_process_is_killed_and_restarted(process):
+    worker = process.remote_worker("lywsd02")
+    hung = process.pid
+    os.kill(hung, signal.SIGSTOP)
+
+    with pytest.raises(WorkerProcessError):
+        worker.status_update()
+
+    deadline = time.monotonic() + 10
+    while process.pid == hung and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert process.pid != hung
+    assert [message.topic for message in worker.status_update()] == ["lywsd02/a"]
@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+
+import pytest
+
+import limits
+from isolation import RemoteWorker
+from workers.base import BaseWorker
+from workers_manager import WorkersManager
+
+
+class ThermostatWorker(BaseWorker):
+    def status_update(self):
+        return []
+
+    def on_command(self, topic, value):
+        return []
+
+    def __repr__(self):
+        return "thermostat"
+
+
+class Process:
+    def __init__(self, adapter):
+        self.settings = {"adapter": adapter}
+
+
+@pytest.fixture(autouse=True)
+def reset_limits(monkeypatch):
+    monkeypatch.setattr(limits, "_limits", {})
+    monkeypatch.setattr(limits, "_semaphores", {})
+
+
+def test_adapter_limit_serializes_commands_across_processes():
+    limits.setup({"workers": {"miflora": 2}, "adapters": {"hci0": 1}})
+    running = []
+    overlaps = []
+
+    def command(keys):
+        with limits.holding(keys):
+            running.append(keys)
+            if len(running) > 1:
+                overlaps.append(list(running))
+            time.sleep(0.05)
+            running.remove(keys)
+
+    threads = [
+        threading.Thread(target=command, args=([("worker", name), ("adapter", "hci0")],))
+        for name in ("thermostat", "miflora", "lywsd03mmc")
+    ]
+    threads.append(threading.Thread(target=command, args=([("worker", "miflora"), ("adapter", "hci1")],)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlaps
+    assert all(len(overlap) == 2 for overlap in overlaps)
+    assert all(any(keys[1] == ("adapter", "hci1") for keys in overlap) for overlap in overlaps)
+
+
+def test_commands_hold_their_worker_and_adapter():
+    worker = ThermostatWorker(10, None, devices={"bedroom": "00:11:22:33:44:55", "kitchen": "00:11:22:33:44:56"})
+    capabilities = {"command_timeout": 10, "topic_prefix": "miflora", "declared": [], "methods": ["status_update"]}
+    shards = [RemoteWorker("miflora", Process(adapter), capabilities) for adapter in (1, 2)]
+
+    command = WorkersManager.Command(worker.on_command, 10, ["thermostat/kitchen/mode/set", b"auto"])
+    polls = [WorkersManager.Command(shard.status_update, 10) for shard in shards]
+
+    assert sorted(command._limit_keys()) == [("adapter", "hci0"), ("worker", "thermostat")]
+    # The shards of a worker on different adapters count for the same worker
+    assert [sorted(poll._limit_keys()) for poll in polls] == [
+        [("adapter", "hci1"), ("worker", "miflora")], [("adapter", "hci2"), ("worker", "miflora")]
+    ]
+
+
+def test_device_limits_are_ignored(caplog):
+    with caplog.at_level(logging.WARNING):
+        limits.setup({"devices": 1})
+
+    assert not limits.enabled()
+    assert "Ignoring unknown limits: devices" in caplog.text
@@ -0,0 +1,25 @@
+import logging
+
+import clock
+import logger
+
+
+def test_repeated_failures_are_summarized(monkeypatch, caplog):
+    virtual_clock = clock.VirtualClock(start=0)
+    monkeypatch.setattr(clock, "_clock", virtual_clock)
+    logger.summarize_repeated_failures(600)
+    log = logging.getLogger("bt-mqtt-gw.test")
+    log.setLevel(logging.WARNING)
+
+    with caplog.at_level(logging.WARNING, logger="bt-mqtt-gw.test"):
+        for _ in range(37):
+            logger.log_exception(log, "Failed connect to device '%s'", "a", suppress=True)
+            virtual_clock.sleep(20)
+        logger.log_exception(log, "Failed connect to device '%s'", "b", suppress=True)
+
+    assert [record.getMessage() for record in caplog.records] == [
+        "Failed connect to device 'a'",
+        "Failed connect to device 'a' (failed 30 times in 10 min)",
+        "Failed connect to device 'b'",
+    ]
+    logger.summarize_repeated_failures(logger.DEFAULT_REPEATED_FAILURES_INTERVAL)
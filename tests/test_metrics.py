@@ -0,0 +1,44 @@
+from metrics import Counter, Gauge, Histogram, Registry, start_http_server
+
+
+def test_counter_exposition():
+    registry = Registry()
+    counter = Counter("test_total", "Test counter", ["source"], registry=registry)
+    counter.inc("a")
+    counter.inc("a", amount=2)
+    counter.inc('b"c')
+
+    assert counter.value("a") == 3
+    exposition = registry.expose()
+    assert "# TYPE test_total counter" in exposition
+    assert 'test_total{source="a"} 3.0' in exposition
+    assert 'test_total{source="b\\"c"} 1.0' in exposition
+
+
+def test_gauge_callback():
+    registry = Registry()
+    Gauge("test_depth", "Test gauge", registry=registry, callback=lambda: 7)
+
+    assert "test_depth 7.0" in registry.expose()
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = Histogram("test_seconds", "Test histogram", registry=registry, buckets=(1, 5))
+    for value in (0.5, 2, 3, 10):
+        histogram.observe(value)
+
+    exposition = registry.expose()
+    assert 'test_seconds_bucket{le="1.0"} 1' in exposition
+    assert 'test_seconds_bucket{le="5.0"} 3' in exposition
+    assert 'test_seconds_bucket{le="+Inf"} 4' in exposition
+    assert "test_seconds_sum 15.5" in exposition
+    assert "test_seconds_count 4" in exposition
+
+
+def test_metrics_are_served_locally_by_default():
+    server = start_http_server({"port": 0})
+    try:
+        assert server.server_address[0] == "127.0.0.1"
+    finally:
+        server.shutdown()
@@ -0,0 +1,35 @@
+import threading
+
+import profiling
+
+
+def test_starting_a_profile_within_a_profiled_command(tmp_path):
+    first = profiling.start(str(tmp_path), duration=60)
+    started = []
+
+    def request():
+        # Profiling requests run as commands, profiled by the window session they replace
+        with profiling.profile("manager._start_profiling"):
+            started.append(profiling.start(str(tmp_path), count=1))
+
+    thread = threading.Thread(target=request, daemon=True)
+    thread.start()
+    thread.join(5)
+    try:
+        assert not thread.is_alive()
+        assert started[0] is not first
+        assert list(tmp_path.glob("*-manager.cpu.pstats"))
+    finally:
+        profiling.stop()
+
+
+def test_count_session_stops_after_its_executions(tmp_path):
+    profiling.start(str(tmp_path), commands=["miflora.*"], count=2)
+    for _ in range(3):
+        with profiling.profile("miflora.status_update"):
+            pass
+        with profiling.profile("thermostat.status_update"):
+            pass
+
+    assert profiling._SESSION is None
+    assert [path.name.split("-")[-1] for path in tmp_path.glob("*.pstats")] == ["miflora.cpu.pstats"]
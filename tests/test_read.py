@@ -0,0 +1,61 @@
+import pytest
+
+from capabilities import Poll
+from mqtt import MqttMessage
+from workers.base import BaseWorker
+
+FERN = {"args": {"devices": {"fern": None, "cactus": None}, "topic_prefix": "plant", "polls": 0}, "update_interval": 3600}
+
+
+class PlantWorker(BaseWorker):
+    def status_update(self):
+        self.polls += 1
+        return [MqttMessage(topic="plant/{}/moisture".format(name), payload=self.polls) for name in self.devices]
+
+
+def test_reads_are_answered_from_the_cache_or_by_a_poll_first_in_the_queue(gateway):
+    # Starting queues a poll of every worker, the reads' poll goes before it
+    gateway = gateway({"plant": (PlantWorker, FERN)}, read={"topic": "read"})
+    gateway.inject("read", {"worker": "plant", "device": "fern", "id": 1})
+    gateway.inject("read", {"worker": "plant", "device": "fern", "id": 2})
+    gateway.run_until(30)
+
+    gateway.inject("read", {"worker": "plant", "device": "fern", "max_age": 60, "id": 3})
+    gateway.inject("read", {"worker": "plant", "device": "rose", "id": 4})
+
+    replies = gateway.published("read/reply")
+    assert [(reply["id"], reply["result"], reply["age"]) for reply in replies] == [
+        (1, "success", 0), (2, "success", 0), (3, "success", 30), (4, "unknown", None)
+    ]
+    assert [reply["values"] for reply in replies[:3]] == [{"plant/fern/moisture": 1}] * 2 + [{"plant/fern/moisture": 2}]
+    assert gateway.published("plant/fern/moisture") == [1, 2]
+
+
+class OneByOneWorker(BaseWorker):
+    capabilities = [Poll(per_device=True)]
+
+    def status_update(self, devices=None):
+        return [MqttMessage(topic="plant/{}/moisture".format(name), payload=40) for name, _ in self.poll_devices(devices)]
+
+
+def test_reads_without_a_device_answer_for_every_device(gateway):
+    gateway = gateway({"plant": (OneByOneWorker, FERN)}, read={"topic": "read"})
+    gateway.inject("read", {"worker": "plant", "id": 1})
+    gateway.run_until(0)
+
+    replies = gateway.published("read/reply")
+    assert [(reply["device"], reply["result"], reply["values"]) for reply in replies] == [
+        ("fern", "success", {"plant/fern/moisture": 40}),
+        ("cactus", "success", {"plant/cactus/moisture": 40}),
+    ]
+
+
+@pytest.mark.parametrize("max_age", ["recent", None, True])
+def test_reads_with_an_invalid_max_age_are_answered_as_invalid(gateway, max_age):
+    gateway = gateway({"plant": (OneByOneWorker, FERN)}, read={"topic": "read"})
+    gateway.inject("read", {"worker": "plant", "device": "fern", "max_age": max_age, "id": 1})
+    gateway.run_until(0)
+
+    assert [reply["result"] for reply in gateway.published("read/reply")] == ["invalid"]
+    # Only the poll queued on start
+    assert gateway.published("plant/fern/moisture") == [40]
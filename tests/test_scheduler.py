@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+import metrics
+from clock import SystemClock, VirtualClock
+
+
+def test_jitter_delays_runs_without_shifting_the_phase():
+    clock = VirtualClock(start=0)
+    scheduler = clock.scheduler()
+    runs = []
+    scheduler.add_job(lambda: runs.append(clock.monotonic()), 60, id="jittered", first_run=15, jitter=5)
+    scheduler.start()
+
+    clock.advance(600)
+
+    assert len(runs) == 10
+    assert all(15 + 60 * index <= run <= 20 + 60 * index for index, run in enumerate(runs))
+
+
+def test_runs_later_than_the_misfire_grace_are_skipped():
+    clock = VirtualClock(start=0)
+    scheduler = clock.scheduler()
+    runs = []
+    scheduler.add_job(lambda: runs.append(clock.monotonic()), 10, id="graced", misfire_grace=2)
+    scheduler.start()
+    missed = metrics.SCHEDULER_MISSED.value("graced")
+
+    clock.sleep(35)
+    clock.advance(15)
+
+    assert runs == [40, 50]
+    assert metrics.SCHEDULER_MISSED.value("graced") == missed + 3
+
+
+def test_jobs_run_on_the_scheduler_thread():
+    scheduler = SystemClock().scheduler()
+    ran = threading.Event()
+    scheduler.add_job(ran.set, 0.05, id="threaded")
+    scheduler.start()
+
+    assert ran.wait(1)
+    scheduler.shutdown()
+
+
+def test_intervals_must_be_positive_unless_running_once():
+    clock = VirtualClock(start=0)
+    scheduler = clock.scheduler()
+    runs = []
+    for seconds in (0, -10):
+        with pytest.raises(ValueError):
+            scheduler.add_job(runs.append, seconds, id="invalid")
+    scheduler.add_job(lambda: runs.append(clock.monotonic()), 0, id="once", once=True)
+    scheduler.start()
+
+    clock.advance(60)
+
+    assert runs == [0]
+    assert scheduler.get_jobs() == []
@@ -0,0 +1,80 @@
+import pytest
+
+import clock
+import metrics
+import workers_manager
+from capabilities import Poll
+from workers.base import BaseWorker
+from workers_manager import WorkersManager
+
+
+class Worker:
+    def __init__(self):
+        self.polls = 0
+
+    def status_update(self):
+        self.polls += 1
+        return []
+
+
+@pytest.fixture(autouse=True)
+def reset_shedding(monkeypatch):
+    monkeypatch.setattr(workers_manager, "_shedding", dict(workers_manager._shedding))
+    monkeypatch.setattr(workers_manager, "_queue_waits", {})
+
+
+def run_after(command, seconds, virtual_clock):
+    queued = command.enqueued()
+    virtual_clock.advance(seconds)
+    queued.execute()
+    return queued
+
+
+def test_expired_polls_are_dropped(virtual_clock):
+    worker = Worker()
+    command = WorkersManager.Command(worker.status_update, 10, ttl=30)
+    shed = metrics.COMMANDS_SHED.value("Worker.status_update", "expired")
+
+    assert run_after(command, 20, virtual_clock).shed is None
+    assert run_after(command, 40, virtual_clock).shed == "expired"
+    assert run_after(WorkersManager.Command(worker.status_update, 10), 40, virtual_clock).shed is None
+
+    assert worker.polls == 2
+    assert metrics.COMMANDS_SHED.value("Worker.status_update", "expired") == shed + 1
+
+
+def test_polls_are_shed_while_the_queue_is_overloaded(virtual_clock, monkeypatch):
+    monkeypatch.setitem(workers_manager._shedding, "target_wait", 5)
+    worker = Worker()
+    command = WorkersManager.Command(worker.status_update, 10, ttl=600)
+
+    assert run_after(command, 8, virtual_clock).shed is None
+    for _ in range(3):
+        run_after(command, 8, virtual_clock)
+    assert run_after(command, 8, virtual_clock).shed == "overload"
+    # Fresh polls still run, and the queue recovers
+    assert run_after(command, 1, virtual_clock).shed is None
+    for _ in range(10):
+        run_after(command, 1, virtual_clock)
+    assert run_after(command, 8, virtual_clock).shed is None
+
+
+class GardenWorker(BaseWorker):
+    capabilities = [Poll(per_device=True)]
+
+    def status_update(self, devices=None):
+        for name, _ in self.poll_devices(devices):
+            clock.sleep(10)
+            self.polls.append(name)
+        return []
+
+
+def test_every_device_of_a_burst_of_polls_is_polled(gateway):
+    polls = []
+    devices = {"d{:02}".format(number): None for number in range(20)}
+    garden = {"args": {"devices": devices, "topic_prefix": "garden", "polls": polls}, "update_interval": 300}
+    gateway = gateway({"garden": (GardenWorker, garden)})
+
+    gateway.run_until(3000)
+
+    assert {name: polls.count(name) for name in devices} == {name: 11 for name in devices}
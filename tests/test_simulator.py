@@ -0,0 +1,90 @@
+import sys
+
+import pytest
+
+import clock
+import simulator
+from mqtt import MqttMessage
+from simulator import btle
+from simulator.devices import Lywsd03MmcDevice, MifloraDevice
+from simulator.mqtt import LocalMqttClient
+
+WORKERS = {
+    "miflora": {"args": {"devices": {"herbs": "c4:7c:8d:00:00:01"}, "topic_prefix": "miflora"}},
+    "lywsd03mmc": {"args": {"devices": {"bedroom": "a4:c1:38:00:00:01"}, "topic_prefix": "lywsd03mmc"}},
+}
+
+
+@pytest.fixture
+def install(monkeypatch):
+    # install replaces bluepy for the whole process, the test puts it back
+    monkeypatch.setitem(sys.modules, "bluepy", None)
+    monkeypatch.setitem(sys.modules, "bluepy.btle", None)
+    monkeypatch.setattr(btle, "_FARM", None)
+    return lambda workers, **config: simulator.install(dict({"seed": 1, "time_scale": 0}, **config), workers)
+
+
+def test_configured_devices_are_simulated_reproducibly(install):
+    readings = []
+    for _ in range(2):
+        farm = install(WORKERS)
+        plant = farm.get("C4:7C:8D:00:00:01")
+        readings.append([plant.read(0x35) for _ in range(3)])
+
+    assert isinstance(plant, MifloraDevice)
+    assert isinstance(farm.get("a4:c1:38:00:00:01"), Lywsd03MmcDevice)
+    assert readings[0] == readings[1]
+
+
+def test_devices_scan_and_connect(install):
+    farm = install(WORKERS)
+
+    entries = btle.Scanner().scan(1)
+    peripheral = btle.Peripheral("c4:7c:8d:00:00:01")
+    battery = peripheral.readCharacteristic(0x38)[0]
+    peripheral.disconnect()
+
+    assert sorted(entry.addr for entry in entries) == ["a4:c1:38:00:00:01", "c4:7c:8d:00:00:01"]
+    assert battery == farm.get("c4:7c:8d:00:00:01").battery
+    assert farm.helper_count == 0
+    with pytest.raises(btle.BTLEDisconnectError):
+        btle.Peripheral("02:00:00:00:00:99")
+
+
+def test_failure_rates_make_connects_fail(install):
+    install(WORKERS, failure_rate={"connect": 1.0})
+
+    with pytest.raises(btle.BTLEDisconnectError):
+        btle.Peripheral("c4:7c:8d:00:00:01")
+
+
+def test_local_broker_publishes_and_delivers():
+    mqtt = LocalMqttClient({"host": "localhost", "topic_prefix": "home"})
+    received = []
+    mqtt.callbacks_subscription([("miflora/update_interval", lambda client, userdata, c: received.append(c.payload))])
+
+    mqtt.publish([MqttMessage(topic="miflora/herbs", payload={"moisture": 40})])
+    mqtt.mqttc.inject("home/miflora/update_interval", "60")
+
+    assert [(message.topic, message.payload) for message in mqtt.mqttc.published] == [
+        ("home/miflora/herbs", '{"moisture": 40}')
+    ]
+    assert received == [b"60"]
+
+
+def test_gateway_polls_simulated_devices_in_virtual_time(install, monkeypatch):
+    from workers_manager import WorkersManager
+
+    monkeypatch.setattr(clock, "_clock", clock.VirtualClock(start=0))
+    workers = {"lywsd03mmc": dict(WORKERS["lywsd03mmc"], update_interval=60)}
+    install(workers)
+    manager = WorkersManager({"workers": workers, "arbitration": {"enabled": False}})
+    manager.register_workers(None)
+    mqtt = LocalMqttClient({"host": "localhost"})
+    mqtt.callbacks_subscription([])
+    manager.start(mqtt)
+
+    simulator.run_virtual(mqtt, 600)
+
+    states = [message for message in mqtt.mqttc.published if message.topic == "lywsd03mmc/bedroom"]
+    assert len(states) == 11
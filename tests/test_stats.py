@@ -0,0 +1,35 @@
+import isolation
+import metrics
+from stats import GatewayStats
+from workers_queue import _WORKERS_QUEUE
+
+WORKERS = {
+    "lywsd02": {"args": {"devices": {"a": "02:01:00:00:00:01"}, "topic_prefix": "lywsd02"}},
+    "lywsd03mmc": {"args": {"devices": {"b": "02:02:00:00:00:01"}, "topic_prefix": "lywsd03mmc"}},
+}
+
+
+def test_command_durations_are_grouped_by_worker():
+    metrics.COMMAND_DURATION.observe(1.0, "StatsPlantWorker.status_update")
+    metrics.COMMAND_DURATION.observe(3.0, "StatsPlantWorker.on_command")
+    stats = GatewayStats({}, None, workers={"StatsPlantWorker": "plant"})
+
+    durations = stats.collect()["workers"]
+
+    assert durations["plant"] == {"avg": 2.0, "p95": 3.0, "count": 2}
+    assert "StatsPlantWorker.status_update" not in durations
+
+
+def test_queue_depth_includes_the_worker_processes():
+    # The processes aren't started, their commands stay queued in the gateway
+    supervisor = isolation.Supervisor({}, WORKERS, 1, None)
+    supervisor._processes["lywsd02"].submit(lambda: None)
+    supervisor._processes["lywsd02"].submit(lambda: None)
+    supervisor._processes["lywsd03mmc"].submit(lambda: None)
+    stats = GatewayStats({}, None, isolation=supervisor)
+
+    collected = stats.collect()
+
+    assert collected["lanes"] == {"lywsd02": 2, "lywsd03mmc": 1}
+    assert collected["queue_depth"] == _WORKERS_QUEUE.qsize() + 3
+    assert GatewayStats({}, None).collect()["lanes"] == {}
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import clock
+import tracing
+from workers_manager import WorkersManager
+
+
+@pytest.fixture
+def traces(monkeypatch, tmp_path):
+    monkeypatch.setattr(clock, "_clock", clock.VirtualClock(start=0))
+    monkeypatch.setattr(tracing, "_TRACER", None)
+    path = tmp_path / "traces.jsonl"
+    tracing.setup({"file": str(path)})
+    yield lambda: [json.loads(line) for line in path.read_text().splitlines()]
+    tracing._TRACER.close()
+
+
+def status_update():
+    clock.sleep(1)
+    with tracing.span("connect", device="aa:bb:cc:dd:ee:01"):
+        clock.sleep(2)
+    return []
+
+
+def test_spans_nest_within_the_command(traces):
+    command = WorkersManager.Command(status_update, 10).enqueued()
+    clock.sleep(5)
+    with command.traced():
+        command.execute()
+        with tracing.span("publish", messages=0):
+            clock.sleep(0.5)
+
+    [trace] = traces()
+    spans = {span["name"]: span for span in trace["spans"]}
+    assert [span["name"] for span in trace["spans"]] == ["enqueue", "dequeue", "connect", "execute", "publish"]
+    assert spans["dequeue"]["start"] == 5
+    assert (spans["connect"]["start"], spans["connect"]["duration"]) == (6, 2)
+    assert (spans["execute"]["start"], spans["execute"]["duration"]) == (5, 3)
+    assert spans["connect"]["device"] == "aa:bb:cc:dd:ee:01"
+    assert trace["source"].endswith("test_tracing.status_update")
+    assert (trace["duration"], trace["error"]) == (8.5, None)
+
+
+def test_failed_commands_are_exported_with_their_error(traces):
+    def failing():
+        with tracing.span("connect"):
+            raise RuntimeError("unreachable")
+
+    command = WorkersManager.Command(failing, 10).enqueued()
+    with pytest.raises(RuntimeError):
+        with command.traced():
+            command.execute()
+
+    [trace] = traces()
+    assert trace["error"] == "RuntimeError"
+    assert trace["spans"][2] == {"name": "connect", "start": 0, "duration": 0, "error": "RuntimeError"}
+    assert trace["spans"][3]["result"] == "error"
@@ -0,0 +1,28 @@
+from mqtt import MqttMessage
+from workers.base import BaseWorker
+
+
+class PlantWorker(BaseWorker):
+    def status_update(self):
+        self.polls += 1
+        return [MqttMessage(topic="plant/moisture", payload=self.polls)]
+
+
+def test_update_all_republishes_fresh_values_and_polls_stale_ones(gateway):
+    plant = {"args": {"topic_prefix": "plant", "polls": 0}, "update_interval": 3600}
+    update_all = {"topic": "homeassistant/status", "payload": "online", "max_age": 300}
+    gateway = gateway({"plant": (PlantWorker, plant)}, topic_subscription={"update_all": update_all})
+
+    # Started without cached values, the first update_all polls
+    gateway.run_until(100)
+    # Home Assistant restarted, the values are still fresh
+    gateway.inject("homeassistant/status", "online")
+    gateway.run_until(100)
+    assert gateway.published("plant/moisture") == [1, 1]
+
+    gateway.run_until(500)
+    gateway.inject("homeassistant/status", "online")
+    # Its next birth message while it boots doesn't queue the poll again
+    gateway.inject("homeassistant/status", "online")
+    gateway.run_until(500)
+    assert gateway.published("plant/moisture") == [1, 1, 2]
@@ -0,0 +1,82 @@
+import pytest
+
+import clock
+from exceptions import WorkerTimeoutError
+from workers.base import BaseWorker
+
+
+class SlowWorker(BaseWorker):
+    def status_update(self):
+        for name, seconds in self.poll_devices():
+            clock.sleep(seconds)
+            yield [name]
+
+
+def update(worker, timeout):
+    polled = []
+    try:
+        with clock.timeout(timeout, WorkerTimeoutError):
+            for messages in worker.status_update():
+                polled += messages
+    except WorkerTimeoutError:
+        pass
+    return polled
+
+
+@pytest.fixture
+def virtual_clock(monkeypatch):
+    monkeypatch.setattr(clock, "_clock", clock.VirtualClock(start=0))
+
+
+def test_updates_resume_after_the_last_device(virtual_clock):
+    worker = SlowWorker(10, None, devices={"a": 4, "b": 4, "c": 4, "d": 4})
+
+    assert update(worker, 10) == ["a", "b"]
+    assert update(worker, 10) == ["d", "a"]
+    assert update(worker, 10) == ["b", "c"]
+
+
+def test_devices_too_slow_for_the_time_left_are_skipped(virtual_clock):
+    worker = SlowWorker(10, None, devices={"a": 3, "slow": 6, "b": 3})
+    assert update(worker, 20) == ["a", "slow", "b"]
+
+    assert update(worker, 8) == ["a", "b"]
+    assert update(worker, 8) == ["slow"]
+
+
+class BTLEDisconnectError(Exception):
+    pass
+
+
+class BTLEGattError(Exception):
+    pass
+
+
+def flaky(failures):
+    def operation():
+        if failures:
+            raise failures.pop(0)
+        return "reading"
+
+    return operation
+
+
+def test_transient_failures_are_retried(virtual_clock):
+    worker = SlowWorker(10, None, devices={})
+
+    assert worker.retry("a", flaky([BTLEDisconnectError(), BTLEDisconnectError()])) == "reading"
+    with pytest.raises(BTLEGattError):
+        worker.retry("a", flaky([BTLEGattError()]))
+    with pytest.raises(BTLEDisconnectError):
+        worker.retry("a", flaky([BTLEDisconnectError()] * 3))
+
+
+def test_retries_stop_at_the_deadline(virtual_clock):
+    worker = SlowWorker(10, None, devices={}, retries=5)
+    failures = [BTLEDisconnectError()] * 5
+
+    with pytest.raises(BTLEDisconnectError):
+        with clock.timeout(0.6, WorkerTimeoutError):
+            worker.retry("a", flaky(failures))
+
+    assert len(failures) == 3
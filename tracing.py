@@ -0,0 +1,142 @@
+"""
+Opt-in per-command tracing written as JSONL, one line per traced command.
+
+A trace is started when a command is queued (subject to sampling) and collects spans
+for queueing, execution, BLE connects and I/O and the MQTT publish of the results. Times
+come from the installed clock, like the command's own, so spans line up under a VirtualClock.
+"""
+import json
+import random
+import threading
+import uuid
+from contextlib import contextmanager
+
+import clock
+import logger
+
+_LOGGER = logger.get(__name__)
+
+_TRACER = None
+_CURRENT = threading.local()
+
+
+class Tracer:
+    def __init__(self, path, sample_rate=1.0):
+        self.path = path
+        self.sample_rate = float(sample_rate)
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def start(self, source):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        return Trace(self, source)
+
+    def write(self, trace):
+        line = json.dumps(trace.as_dict, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Trace:
+    def __init__(self, tracer, source):
+        self._tracer = tracer
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.source = source
+        self.timestamp = clock.time()
+        self.started = clock.monotonic()
+        self.spans = []
+        self.error = None
+
+    def add_span(self, name, started, ended, **attributes):
+        span = {
+            "name": name,
+            "start": round(started - self.started, 6),
+            "duration": round(ended - started, 6),
+        }
+        span.update(attributes)
+        self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        started = clock.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            self.add_span(name, started, clock.monotonic(), **attributes)
+
+    def event(self, name, **attributes):
+        now = clock.monotonic()
+        self.add_span(name, now, now, **attributes)
+
+    def finish(self):
+        self._tracer.write(self)
+
+    @property
+    def as_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "source": self.source,
+            "timestamp": self.timestamp,
+            "duration": round(clock.monotonic() - self.started, 6),
+            "error": self.error,
+            "spans": self.spans,
+        }
+
+
+def setup(config):
+    global _TRACER
+    if _TRACER is not None:
+        _TRACER.close()
+    _TRACER = Tracer(config.get("file", "traces.jsonl"), config.get("sample_rate", 1.0))
+    _LOGGER.info(
+        "Tracing %d%% of commands to %s", _TRACER.sample_rate * 100, _TRACER.path
+    )
+
+
+def start(source):
+    """Start a trace for a command, returns None when tracing is off or not sampled."""
+    if _TRACER is None:
+        return None
+    return _TRACER.start(source)
+
+
+def current():
+    return getattr(_CURRENT, "trace", None)
+
+
+@contextmanager
+def activate(trace):
+    """Make the trace current for this thread and write it out once done."""
+    if trace is None:
+        yield
+        return
+
+    previous = current()
+    _CURRENT.trace = trace
+    try:
+        yield
+    except BaseException as e:
+        trace.error = type(e).__name__
+        raise
+    finally:
+        _CURRENT.trace = previous
+        trace.finish()
+
+
+@contextmanager
+def span(name, **attributes):
+    """Record a span on the current trace, a no-op outside of traced commands."""
+    trace = current()
+    if trace is None:
+        yield
+        return
+    with trace.span(name, **attributes):
+        yield
@@ -1,9 +1,46 @@
+import asyncio
+import random
+
+from exceptions import DeviceTimeoutError, WorkerTimeoutError
+import bluepy_hooks
+import capabilities
+import clock
+import event_loop
 import logger
+import metrics
+import tracing
+
+_LOGGER = logger.get(__name__)
+
+POLL_COST_WEIGHT = 0.3  # Of the latest poll in a device's expected poll duration
+RETRY_BACKOFF = 0.5  # In seconds, doubles on every retry
+MAX_RETRY_BACKOFF = 5  # In seconds
+# Failures of the connection rather than of the request, by bluepy exception class
+RETRYABLE_ERRORS = ("BTLEDisconnectError", "BTLEInternalError")
+
+
+def retryable(exception):
+    """Whether a failed device operation may succeed when it is tried again"""
+    while exception is not None:
+        if isinstance(exception, (DeviceTimeoutError, WorkerTimeoutError)):
+            return False
+        if any(klass.__name__ in RETRYABLE_ERRORS for klass in type(exception).__mro__):
+            return True
+        # Libraries like btlewrap wrap the bluepy exception
+        exception = exception.__cause__
+    return False
+
 
 class BaseWorker:
+    retries = 2  # Extra attempts of a failed device operation, the ``retries`` arg overrides it
+    capabilities = None  # See capabilities, None for the ones the worker's methods imply
+
     def __init__(self, command_timeout, global_topic_prefix, **kwargs):
+        bluepy_hooks.install()
         self.command_timeout = command_timeout
         self.global_topic_prefix = global_topic_prefix
+        self._poll_offset = 0
+        self._poll_costs = {}
         for arg, value in kwargs.items():
             setattr(self, arg, value)
         self._setup()
@@ -11,6 +48,91 @@ class BaseWorker:
     def _setup(self):
         return
 
+    def poll_devices(self, devices=None):
+        """
+        The (name, device) items of ``devices``, by default ``self.devices``, or of the devices
+        named in ``devices``, in the order to poll them. Every update starts after the device the
+        previous one got to, so when updates run out of time the devices at the end still get
+        their turn. Devices expected to take longer than the command has left are skipped, the
+        next update starts with them.
+        """
+        if devices is None:
+            devices = self.devices
+        elif not isinstance(devices, dict):
+            devices = {name: self.devices[name] for name in devices if name in self.devices}
+        poll = capabilities.find(capabilities.of(self), capabilities.Poll)
+        default_cost = poll.cost if poll is not None and poll.cost is not None else 0
+        names = list(devices)
+        if not names:
+            return
+        start = self._poll_offset % len(names)
+        resume = None
+        for index in range(start, start + len(names)):
+            name = names[index % len(names)]
+            remaining = clock.remaining()
+            if index > start and remaining is not None and self._poll_costs.get(name, default_cost) > remaining:
+                _LOGGER.debug("Skipping %s device '%s', %.1f s left", repr(self), name, remaining)
+                if resume is None:
+                    resume = self._poll_offset = index % len(names)
+                continue
+            if resume is None:
+                self._poll_offset = (index + 1) % len(names)
+            started = clock.monotonic()
+            try:
+                yield name, devices[name]
+            finally:
+                cost = clock.monotonic() - started
+                previous = self._poll_costs.get(name, cost)
+                self._poll_costs[name] = previous + POLL_COST_WEIGHT * (cost - previous)
+
+    def retry(self, dev_name, operation, *args, **kwargs):
+        """
+        Returns ``operation(*args, **kwargs)``, trying it up to ``retries`` more times after a
+        retryable failure with a jittered, doubling backoff. A retry is only made when the time
+        left of the device and command timeouts fits the backoff and another attempt as long as
+        the failed one, otherwise the failure is raised.
+        """
+        attempt = 0
+        while True:
+            started = clock.monotonic()
+            try:
+                return operation(*args, **kwargs)
+            except Exception as e:
+                backoff = self._backoff(dev_name, e, attempt, started)
+                attempt += 1
+                clock.sleep(backoff)
+
+    async def retry_async(self, dev_name, operation, *args, **kwargs):
+        """``retry`` for coroutine workers, awaiting ``operation`` and the backoff"""
+        attempt = 0
+        while True:
+            started = clock.monotonic()
+            try:
+                return await operation(*args, **kwargs)
+            except Exception as e:
+                backoff = self._backoff(dev_name, e, attempt, started)
+                attempt += 1
+                await asyncio.sleep(backoff)
+
+    def _backoff(self, dev_name, exception, attempt, started):
+        """The backoff before retrying a failed attempt, raises the failure when it isn't retried"""
+        if attempt >= self.retries or not retryable(exception):
+            raise exception
+        backoff = min(RETRY_BACKOFF * 2 ** attempt, MAX_RETRY_BACKOFF) * random.uniform(0.5, 1)
+        remaining = clock.remaining()
+        if remaining is not None and backoff + clock.monotonic() - started > remaining:
+            raise exception
+        _LOGGER.debug(
+            "Retrying %s device '%s' in %.1f s after %s", repr(self), dev_name, backoff, type(exception).__name__
+        )
+        metrics.DEVICE_RETRIES.inc(repr(self))
+        return backoff
+
+    @staticmethod
+    def blocking(func, *args, **kwargs):
+        """For coroutine workers, awaits a blocking call like bluepy's in a thread, see event_loop"""
+        return event_loop.blocking(func, *args, **kwargs)
+
     def format_discovery_topic(self, mac, *sensor_args):
         node_id = mac.replace(":", "-")
         object_id = "_".join([repr(self), *sensor_args])
@@ -36,6 +158,10 @@ class BaseWorker:
     def __repr__(self):
         return self.__module__.split(".")[-1]
 
+    def trace_span(self, name, **attributes):
+        """Record a custom span on the trace of the command being executed, if any"""
+        return tracing.span(name, worker=repr(self), **attributes)
+
     @staticmethod
     def true_false_to_ha_on_off(true_false):
         if true_false:
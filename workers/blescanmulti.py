@@ -1,9 +1,9 @@
-import time
-
 from mqtt import MqttMessage
 
+from capabilities import Advertisements, Poll
 from workers.base import BaseWorker
 from utils import booleanize
+import clock
 import logger
 
 REQUIREMENTS = ["bluepy"]
@@ -21,7 +21,7 @@ class BleDeviceStatus:
         message_sent: bool = True,
     ):
         if last_status_time is None:
-            last_status_time = time.time()
+            last_status_time = clock.time()
 
         self.worker = worker  # type: BlescanmultiWorker
         self.mac = mac.lower()
@@ -33,7 +33,7 @@ class BleDeviceStatus:
     def set_status(self, available):
         if available != self.available:
             self.available = available
-            self.last_status_time = time.time()
+            self.last_status_time = clock.time()
             self.message_sent = False
 
     def _timeout(self):
@@ -43,7 +43,7 @@ class BleDeviceStatus:
             return self.worker.unavailable_timeout
 
     def has_time_elapsed(self):
-        elapsed = time.time() - self.last_status_time
+        elapsed = clock.time() - self.last_status_time
         return elapsed > self._timeout()
 
     def payload(self):
@@ -75,6 +75,7 @@ class BleDeviceStatus:
 
 
 class BlescanmultiWorker(BaseWorker):
+    capabilities = [Poll(), Advertisements()]
     # Default values
     devices = {}
     # Payload that should be send when device is available
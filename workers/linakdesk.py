@@ -1,4 +1,4 @@
-from interruptingcow import timeout
+from clock import timeout
 
 import logger
 from exceptions import DeviceTimeoutError
@@ -40,7 +40,7 @@ class LinakdeskWorker(BaseWorker):
             ),
         ):
             try:
-                self.desk.read_dpg_data()
+                self.retry(self.mac, self.desk.read_dpg_data)
                 return self.desk.current_height_with_offset.cm
             except btle.BTLEException as e:
                 logger.log_exception(
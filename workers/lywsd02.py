@@ -22,9 +22,9 @@ class Lywsd02Worker(BaseWorker):
     def status_update(self):
         from bluepy import btle
 
-        for name, lywsd02 in self.devices.items():
+        for name, lywsd02 in self.poll_devices():
             try:
-                ret = lywsd02.readAll()
+                ret = self.retry(name, lywsd02.readAll)
             except btle.BTLEDisconnectError as e:
                 self.log_connect_exception(_LOGGER, name, e)
             except btle.BTLEException as e:
@@ -21,9 +21,9 @@ class Lywsd03MmcWorker(BaseWorker):
     def status_update(self):
         from bluepy import btle
 
-        for name, lywsd03mmc in self.devices.items():
+        for name, lywsd03mmc in self.poll_devices():
             try:
-                ret = lywsd03mmc.readAll()
+                ret = self.retry(name, lywsd03mmc.readAll)
             except btle.BTLEDisconnectError as e:
                 self.log_connect_exception(_LOGGER, name, e)
             except btle.BTLEException as e:
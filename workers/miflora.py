@@ -2,7 +2,8 @@ from const import DEFAULT_PER_DEVICE_TIMEOUT
 from exceptions import DeviceTimeoutError
 from mqtt import MqttMessage, MqttConfigMessage
 
-from interruptingcow import timeout
+from capabilities import Config, Poll
+from clock import timeout
 from workers.base import BaseWorker
 import logger
 
@@ -22,6 +23,7 @@ _LOGGER = logger.get(__name__)
 
 
 class MifloraWorker(BaseWorker):
+    capabilities = [Poll(cost=5, per_device=True), Config()]
     per_device_timeout = DEFAULT_PER_DEVICE_TIMEOUT  # type: int
 
     def _setup(self):
@@ -102,16 +104,17 @@ class MifloraWorker(BaseWorker):
 
         return ret
 
-    def status_update(self):
-        _LOGGER.info("Updating %d %s devices", len(self.devices), repr(self))
+    def status_update(self, devices=None):
+        if devices is None:
+            _LOGGER.info("Updating %d %s devices", len(self.devices), repr(self))
 
-        for name, data in self.devices.items():
+        for name, data in self.poll_devices(devices):
             _LOGGER.debug("Updating %s device '%s' (%s)", repr(self), name, data["mac"])
             from btlewrap import BluetoothBackendException
 
             try:
                 with timeout(self.per_device_timeout, exception=DeviceTimeoutError):
-                    yield self.update_device_state(name, data["poller"])
+                    yield self.retry(name, self.update_device_state, name, data["poller"])
             except BluetoothBackendException as e:
                 logger.log_exception(
                     _LOGGER,
@@ -1,8 +1,9 @@
 from math import floor
 
 from datetime import datetime
-import time
-from interruptingcow import timeout
+from capabilities import Advertisements, Poll
+from clock import timeout
+import clock
 
 from exceptions import DeviceTimeoutError
 from mqtt import MqttMessage
@@ -19,6 +20,7 @@ male = "male"
 
 
 class MiscaleWorker(BaseWorker):
+    capabilities = [Poll(cost=5), Advertisements()]
 
     SCAN_TIMEOUT = 5
 
@@ -112,7 +114,7 @@ class MiscaleWorker(BaseWorker):
             ),
         ):
             while not scan_processor.ready:
-                time.sleep(1)
+                clock.sleep(1)
             return scan_processor.results
 
 
@@ -1,5 +1,6 @@
 from mqtt import MqttMessage
 
+from capabilities import Stream
 from workers.base import BaseWorker
 import logger
 
@@ -8,6 +9,8 @@ _LOGGER = logger.get(__name__)
 
 
 class MysensorsWorker(BaseWorker):
+    capabilities = [Stream()]
+
     def run(self, mqtt):
         import serial
 
@@ -118,7 +118,7 @@ class RuuvitagWorker(BaseWorker):
         for name, device in self.devices.items():
             _LOGGER.debug("Updating %s device '%s' (%s)", repr(self), name, device.mac)
             try:
-                ret.extend(self.update_device_state(name, device))
+                ret.extend(self.retry(name, self.update_device_state, name, device))
             except btle.BTLEException as e:
                 logger.log_exception(
                     _LOGGER,
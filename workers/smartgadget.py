@@ -61,10 +61,10 @@ class SmartgadgetWorker(BaseWorker):
         from bluepy import btle
 
         _LOGGER.info("Updating %d %s devices", len(self.devices), repr(self))
-        for name, device in self.devices.items():
+        for name, device in self.poll_devices():
             _LOGGER.debug("Updating %s device '%s' (%s)", repr(self), name, device.mac)
             try:
-                yield self.update_device_state(name, device)
+                yield self.retry(name, self.update_device_state, name, device)
             except btle.BTLEException as e:
                 logger.log_exception(
                     _LOGGER,
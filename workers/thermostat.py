@@ -1,5 +1,6 @@
 from mqtt import MqttMessage, MqttConfigMessage
 
+from capabilities import Command, Config, Poll
 from workers.base import BaseWorker
 import logger
 
@@ -33,6 +34,8 @@ monitoredAttrs = [
 
 
 class ThermostatWorker(BaseWorker):
+    capabilities = [Poll(cost=3, per_device=True), Command(), Config()]
+
     def _setup(self):
         from eq3bt import Thermostat
 
@@ -184,15 +187,16 @@ class ThermostatWorker(BaseWorker):
 
         return ret
 
-    def status_update(self):
+    def status_update(self, devices=None):
         from bluepy import btle
 
-        _LOGGER.info("Updating %d %s devices", len(self.devices), repr(self))
-        for name, data in self.devices.items():
+        if devices is None:
+            _LOGGER.info("Updating %d %s devices", len(self.devices), repr(self))
+        for name, data in self.poll_devices(devices):
             _LOGGER.debug("Updating %s device '%s' (%s)", repr(self), name, data["mac"])
             thermostat = data["thermostat"]
             try:
-                thermostat.update()
+                self.retry(name, thermostat.update)
             except btle.BTLEException as e:
                 logger.log_exception(
                     _LOGGER,
@@ -266,13 +270,14 @@ class ThermostatWorker(BaseWorker):
             data["mac"],
         )
         try:
-            if method == "preset":
-                if value == HOLD_COMFORT:
-                    thermostat.activate_comfort()
+            with self.trace_span("set", device=device_name, method=method):
+                if method == "preset":
+                    if value == HOLD_COMFORT:
+                        thermostat.activate_comfort()
+                    else:
+                        thermostat.activate_eco()
                 else:
-                    thermostat.activate_eco()
-            else:
-                setattr(thermostat, method, value)
+                    setattr(thermostat, method, value)
         except btle.BTLEException as e:
             logger.log_exception(
                 _LOGGER,
@@ -1,17 +1,32 @@
+import copy
 import importlib
+import json
+import numbers
+import sys
 import inspect
 import threading
 from functools import partial
 from distutils.version import LooseVersion
 
-from apscheduler.schedulers.background import BackgroundScheduler
-from interruptingcow import timeout
-from pytz import utc
-
 from const import DEFAULT_COMMAND_TIMEOUT
+from adaptive import AdaptiveIntervals
 from exceptions import WorkerTimeoutError
+from mqtt import MqttMessage
+from stats import GatewayStats
+from workers.base import BaseWorker
 from workers_queue import _WORKERS_QUEUE
+import arbiter
+import capabilities
+import capture
+import clock
+import event_loop
+import helper_watchdog
+import isolation
+import limits
 import logger
+import metrics
+import profiling
+import tracing
 
 from pip import __version__ as pip_version
 
@@ -25,14 +40,33 @@ else:
 
 _LOGGER = logger.get(__name__)
 
+DEFAULT_TTL_INTERVALS = 1  # Polls expire after this many update intervals in the queue
+DEFAULT_TARGET_WAIT = 0  # In seconds, 0 never sheds for overload
+QUEUE_WAIT_WEIGHT = 0.2  # Of the latest command in the average queue wait
+DEFAULT_MAX_AGE = 300  # In seconds, cached values update_all republishes instead of polling
+DEFAULT_DEBOUNCE = 60  # In seconds, update_all polls a device at most once in this window
+DEFAULT_READ_TOPIC = "read"
+DEFAULT_READ_MAX_AGE = 60  # In seconds
+READ_PRIORITY = 1  # Polls for reads go before everything else in the queue
+
+_shedding = {"ttl_intervals": DEFAULT_TTL_INTERVALS, "target_wait": DEFAULT_TARGET_WAIT}
+_queue_waits = {}  # Average queue wait by lane, None for the gateway queue
+_last_values = {}  # (monotonic time, messages) of the latest successful poll by Command.cache_key
+
 
 class WorkersManager:
     class Command:
-        def __init__(self, callback, timeout, args=(), options=dict()):
+        def __init__(self, callback, timeout, args=(), options=dict(), ttl=None, priority=0):
             self._callback = callback
             self._timeout = timeout
             self._args = args
             self._options = options
+            self.ttl = ttl  # Seconds in the queue after which the command is dropped, None keeps it
+            self.shed = None
+            self.priority = priority  # Commands with a higher priority are taken from the queue first
+            self.reply = None  # Called with the command, its messages and the result once it ran
+            self._enqueued_at = None
+            self._trace = None
             self._source = "{}.{}".format(
                 callback.__self__.__class__.__name__
                 if hasattr(callback, "__self__")
@@ -40,31 +74,144 @@ class WorkersManager:
                 callback.__name__,
             )
 
+        def enqueued(self):
+            # Commands are reused by the scheduler, every queued run gets its own copy
+            command = copy.copy(self)
+            command._enqueued_at = clock.monotonic()
+            command._trace = tracing.start(self._source)
+            if command._trace is not None:
+                command._trace.event("enqueue", queue_depth=_WORKERS_QUEUE.qsize())
+            return command
+
+        @property
+        def callback(self):
+            return self._callback
+
+        @property
+        def source(self):
+            return self._source
+
+        @property
+        def lane(self):
+            """The worker process running the command, None when it runs in the gateway"""
+            return getattr(self._callback, "lane", None)
+
+        @property
+        def devices(self):
+            """The names of the devices a per-device poll polls, None for every device of the worker"""
+            if self._options.get("per_device") and self._args:
+                return list(self._args[0])
+            return None
+
+        @property
+        def trace(self):
+            return self._trace
+
+        @property
+        def cache_key(self):
+            """The worker and devices a poll's messages are the latest values of"""
+            return getattr(self._callback, "__self__", self._callback), tuple(self.devices or ())
+
+        def per_device(self):
+            """A command for every device of a per-device poll, see capabilities.Poll"""
+            devices = getattr(self._callback.__self__, "devices", None) if self._options.get("per_device") else None
+            if not devices:
+                return [self]
+            commands = []
+            for name in devices:
+                command = copy.copy(self)
+                command._args = [[name]]
+                commands.append(command)
+            return commands
+
+        def traced(self):
+            return tracing.activate(self._trace)
+
+        def _timeout_error(self):
+            return WorkerTimeoutError(
+                "Execution of command {} timed out after {} seconds".format(self._source, self._timeout)
+            )
+
+        def _limit_keys(self):
+            """The worker and adapter the command holds, see limits"""
+            worker = getattr(self._callback, "__self__", None)
+            if not isinstance(worker, (BaseWorker, isolation.RemoteWorker)):
+                return []
+            lane = self.lane
+            adapter = lane.settings.get("adapter") if lane is not None else None
+            return [(limits.WORKER, repr(worker)), (limits.ADAPTER, "hci{}".format(adapter or 0))]
+
+        def _shed_reason(self, waited):
+            """Why the command is dropped instead of run after waiting in the queue, None runs it"""
+            lane = self.lane
+            average = _queue_waits.get(lane, 0.0)
+            average += QUEUE_WAIT_WEIGHT * (waited - average)
+            _queue_waits[lane] = average
+            if self.ttl is None:
+                return None
+            if self.ttl and waited > self.ttl:
+                return "expired"
+            # Polls that waited long in a queue that keeps waiting long make way for fresh ones
+            target = _shedding["target_wait"]
+            if target and average > target and waited > target:
+                return "overload"
+            return None
+
         def execute(self):
             messages = []
+            result = "success"
+            started = clock.monotonic()
+            if self._enqueued_at is not None:
+                metrics.COMMAND_QUEUE_WAIT.observe(started - self._enqueued_at, self._source)
+                self.shed = self._shed_reason(started - self._enqueued_at)
+            if self._trace is not None:
+                self._trace.add_span("dequeue", started, started)
+            if self.shed is not None:
+                _LOGGER.debug(
+                    "Dropped %s command %s after %.1f s in the queue", self.shed, self._source, started - self._enqueued_at
+                )
+                metrics.COMMANDS_SHED.inc(self._source, self.shed)
+                return messages
 
             try:
-                with timeout(
-                        self._timeout,
-                        exception=WorkerTimeoutError(
-                            "Execution of command {} timed out after {} seconds".format(
-                                self._source, self._timeout
-                            )
-                        ),
-                ):
-                    if inspect.isgeneratorfunction(self._callback):
-                        for message in self._callback(*self._args):
-                            messages += message
+                with limits.holding(self._limit_keys() if limits.enabled() else ()):
+                    if self.lane is not None:
+                        # The worker process enforces the timeout itself
+                        messages = self.lane.execute(self._callback, self._args, self._timeout)
+                    elif event_loop.is_async(self._callback):
+                        messages = event_loop.execute(
+                            self._callback, self._args, self._timeout, messages, self._timeout_error()
+                        )
                     else:
-                        messages = self._callback(*self._args)
+                        with clock.timeout(self._timeout, exception=self._timeout_error()):
+                            if inspect.isgeneratorfunction(self._callback):
+                                for message in self._callback(*self._args):
+                                    messages += message
+                            else:
+                                messages = self._callback(*self._args)
             except WorkerTimeoutError as e:
                 if messages:
+                    result = "partial"
                     logger.log_exception(
                         _LOGGER, "%s, sending only partial update", e, suppress=True
                     )
                 else:
+                    result = "timeout"
                     raise e
+            except Exception:
+                result = "error"
+                raise
+            finally:
+                ended = clock.monotonic()
+                metrics.COMMAND_DURATION.observe(ended - started, self._source)
+                metrics.COMMAND_RESULTS.inc(self._source, result)
+                if self._trace is not None:
+                    self._trace.add_span("execute", started, ended, result=result)
+                if self.reply is not None:
+                    self.reply(self, messages or [], result)
 
+            if result == "success" and messages and self._callback.__name__ == "status_update":
+                _last_values[self.cache_key] = (ended, messages)
             _LOGGER.debug("Execution result of command %s: %s", self._source, messages)
             return messages
 
@@ -72,72 +219,179 @@ class WorkersManager:
         self._mqtt_callbacks = []
         self._config_commands = []
         self._update_commands = []
-        self._scheduler = BackgroundScheduler(timezone=utc)
+        self._scheduler = clock.get().scheduler()
+        self._jitter = config.get("scheduler", {}).get("jitter", 0)
+        self._misfire_grace = config.get("scheduler", {}).get("misfire_grace")
         self._daemons = []
+        self._stats = None
+        self._isolation = None
         self._config = config
         self._command_timeout = config.get("command_timeout", DEFAULT_COMMAND_TIMEOUT)
+        refresh = config.get("topic_subscription", {}).get("update_all", {})
+        self._max_age = refresh.get("max_age", DEFAULT_MAX_AGE)
+        self._debounce = refresh.get("debounce", DEFAULT_DEBOUNCE)
+        self._refreshed = {}
+        self._workers = {}
+        self._polls = {}
+        self._reads = {}  # Requests waiting for a poll by Command.cache_key
+        self._reads_lock = threading.Lock()
+        self._mqtt = None
+        self._excluded = {}  # Devices polled by jobs of their own by worker
+        self._adaptive = {}  # AdaptiveIntervals by worker
+        arbiter.setup(config.get("arbitration", {}))
+        if "watchdog" in config:
+            helper_watchdog.setup(config["watchdog"])
+        limits.setup(config.get("limits", {}))
+        event_loop.setup(config.get("event_loop", {}))
+        _shedding.update(
+            ttl_intervals=config.get("shedding", {}).get("ttl_intervals", DEFAULT_TTL_INTERVALS),
+            target_wait=config.get("shedding", {}).get("target_wait", DEFAULT_TARGET_WAIT),
+        )
+        if "tracing" in config:
+            tracing.setup(config["tracing"])
+        if "capture" in config:
+            capture.setup(config["capture"])
 
     def register_workers(self, global_topic_prefix):
-        for (worker_name, worker_config) in self._config["workers"].items():
+        classes = {}
+        for worker_name in self._config["workers"]:
             module_obj = importlib.import_module("workers.%s" % worker_name)
-            klass = getattr(module_obj, "%sWorker" % worker_name.title())
+            classes[worker_name] = getattr(module_obj, "%sWorker" % worker_name.title())
 
             if module_obj.REQUIREMENTS is not None:
                 self._pip_install_helper(module_obj.REQUIREMENTS)
 
+        if "isolation" in self._config or "adapters" in self._config:
+            if clock.get().virtual:
+                _LOGGER.warning("Worker processes can't follow a virtual clock, running all workers in the gateway")
+            else:
+                self._isolation = isolation.Supervisor(
+                    self._config.get("isolation", {}),
+                    self._config["workers"],
+                    self._command_timeout,
+                    global_topic_prefix,
+                    self._config.get("adapters"),
+                    {name: capabilities.of(klass) for name, klass in classes.items()},
+                )
+
+        for (worker_name, worker_config) in self._config["workers"].items():
+            klass = classes[worker_name]
             command_timeout = worker_config.get(
                 "command_timeout", self._command_timeout
             )
-            worker_obj = klass(
-                command_timeout, global_topic_prefix, **worker_config["args"]
-            )
+            if self._isolation is not None and self._isolation.isolates(worker_name):
+                # One stand-in per process, several when its devices are sharded over adapters
+                worker_objs = self._isolation.workers(worker_name)
+            else:
+                worker_objs = [
+                    klass(command_timeout, global_topic_prefix, **worker_config["args"])
+                ]
+            worker_obj = worker_objs[0]
+            declared = capabilities.of(worker_obj)
+            poll = capabilities.find(declared, capabilities.Poll)
 
-            if "sensor_config" in self._config and hasattr(worker_obj, "config"):
+            if "sensor_config" in self._config and capabilities.find(declared, capabilities.Config):
                 _LOGGER.debug(
                     "Added %s config with a %d seconds timeout", repr(worker_obj), 2
                 )
-                command = self.Command(worker_obj.config, 2, [])
-                self._config_commands.append(command)
+                for shard in worker_objs:
+                    self._config_commands.append(self.Command(shard.config, 2, []))
 
-            if hasattr(worker_obj, "status_update"):
+            if poll is not None:
                 _LOGGER.debug(
                     "Added %s worker with %d seconds interval and a %d seconds timeout",
                     repr(worker_obj),
                     worker_config["update_interval"],
                     worker_obj.command_timeout,
                 )
-                command = self.Command(
-                    worker_obj.status_update, worker_obj.command_timeout, []
-                )
-                self._update_commands.append(command)
+                commands = [
+                    self.Command(
+                        shard.status_update,
+                        shard.command_timeout,
+                        [],
+                        options={"per_device": poll.per_device},
+                        ttl=self._poll_ttl(worker_config.get("update_interval")),
+                    )
+                    for shard in worker_objs
+                ]
+                self._update_commands.extend(commands)
+                self._workers[worker_name] = worker_objs
+                self._polls[worker_name] = commands
 
                 if "update_interval" in worker_config:
                     job_id = "{}_interval_job".format(worker_name)
-                    self._scheduler.add_job(
-                        partial(self._queue_command, command),
-                        "interval",
-                        seconds=worker_config["update_interval"],
-                        id=job_id,
+                    # Devices with an interval of their own are polled by their own jobs
+                    excluded = self._excluded[worker_name] = set()
+                    self._schedule(
+                        job_id,
+                        partial(self._queue_commands, commands, excluded=excluded),
+                        worker_config["update_interval"],
                     )
                     self._mqtt_callbacks.append(
                         (
                             worker_obj.format_topic("update_interval"),
-                            partial(self._update_interval_wrapper, command, job_id),
+                            partial(self._update_interval_wrapper, commands, job_id),
                         )
                     )
-            elif hasattr(worker_obj, "run"):
+                    if poll.per_device:
+                        for device, interval in worker_config.get("device_intervals", {}).items():
+                            self._set_device_interval(worker_name, device, interval)
+                        if "adaptive" in worker_config:
+                            self._adaptive[worker_name] = AdaptiveIntervals(
+                                worker_config["adaptive"], worker_config["update_interval"]
+                            )
+                            for command in commands:
+                                command.reply = partial(self._on_adaptive_poll, worker_name)
+                        self._mqtt_callbacks.append(
+                            (
+                                worker_obj.format_topic("+", "update_interval"),
+                                partial(self._device_interval_wrapper, worker_name),
+                            )
+                        )
+                    elif "device_intervals" in worker_config or "adaptive" in worker_config:
+                        _LOGGER.warning(
+                            "%s polls all devices at once, ignoring its device_intervals and adaptive config",
+                            repr(worker_obj),
+                        )
+            elif capabilities.find(declared, capabilities.Stream):
                 _LOGGER.debug("Registered %s as daemon", repr(worker_obj))
-                self._daemons.append(worker_obj)
+                self._daemons.extend(worker_objs)
             else:
                 raise "%s cannot be initialized, it has to define run or status_update method" % worker_name
 
             if "topic_subscription" in worker_config:
-                self._mqtt_callbacks.append(
-                    (
-                        worker_config["topic_subscription"],
-                        partial(self._on_command_wrapper, worker_obj),
+                if capabilities.find(declared, capabilities.Command):
+                    self._mqtt_callbacks.append(
+                        (
+                            worker_config["topic_subscription"],
+                            partial(self._on_command_wrapper, worker_objs),
+                        )
                     )
+                else:
+                    _LOGGER.warning("%s takes no commands, ignoring its topic_subscription", repr(worker_obj))
+
+        if "stats" in self._config:
+            self._stats = GatewayStats(
+                self._config["stats"],
+                global_topic_prefix,
+                workers={klass.__name__: worker_name for worker_name, klass in classes.items()},
+                isolation=self._isolation,
+            )
+            if "sensor_config" in self._config:
+                self._config_commands.append(self.Command(self._stats.config, 2, []))
+
+        if "profiling" in self._config:
+            self._mqtt_callbacks.append(
+                (
+                    self._config["profiling"].get("topic", "profile"),
+                    self._on_profile_request,
                 )
+            )
+
+        if "read" in self._config:
+            self._mqtt_callbacks.append(
+                (self._config["read"].get("topic", DEFAULT_READ_TOPIC), self._on_read_request)
+            )
 
         if "topic_subscription" in self._config:
             for (callback_name, options) in self._config["topic_subscription"].items():
@@ -155,54 +409,171 @@ class WorkersManager:
                 )
 
     def start(self, mqtt):
+        if "metrics" in self._config:
+            metrics.start_http_server(self._config["metrics"])
+
+        self._mqtt = mqtt
         mqtt.callbacks_subscription(self._mqtt_callbacks)
 
         if "sensor_config" in self._config:
             self._publish_config(mqtt)
 
+        if self._stats is not None:
+            # Published straight from the scheduler, so the stats keep flowing when the queue is stuck
+            self._scheduler.add_job(
+                lambda: mqtt.publish(self._stats.status_update()), self._stats.interval, id="gateway_stats_job"
+            )
+
+        if self._isolation is not None:
+            self._isolation.start(mqtt)
+
         self._scheduler.start()
         self.update_all()
         for daemon in self._daemons:
-            threading.Thread(target=daemon.run, args=[mqtt], daemon=True).start()
+            if event_loop.is_async(daemon.run):
+                event_loop.spawn(repr(daemon), daemon.run(mqtt))
+            else:
+                threading.Thread(target=daemon.run, args=[mqtt], daemon=True).start()
 
     def _queue_if_matching_payload(self, command, payload, expected_payload):
         if payload.decode("utf-8") == expected_payload:
             self._queue_command(command)
 
     def update_all(self):
+        """
+        Returns the latest values of the devices polled within ``max_age`` seconds and queues
+        polls of the others, unless update_all queued them less than ``debounce`` seconds ago
+        """
         _LOGGER.debug("Updating all workers")
+        now = clock.monotonic()
+        messages = []
+        polls = 0
         for command in self._update_commands:
-            self._queue_command(command)
+            for command in command.per_device():
+                key = command.cache_key
+                polled, values = _last_values.get(key, (None, None))
+                if polled is not None and now - polled <= self._max_age:
+                    messages += values
+                elif key not in self._refreshed or now - self._refreshed[key] >= self._debounce:
+                    self._refreshed[key] = now
+                    self._queue(command)
+                    polls += 1
+        _LOGGER.debug("Republishing %d cached values and queued %d polls", len(messages), polls)
+        return messages
+
+    @classmethod
+    def _queue_commands(cls, commands, devices=None, excluded=frozenset(), ttl=None):
+        """Queues polls, of the ``devices`` only when given and never of ``excluded`` devices"""
+        for command in commands:
+            for command in command.per_device():
+                names = set(command.devices or ())
+                if devices is not None and not names & devices or names and names <= excluded:
+                    continue
+                if ttl is not None:
+                    command = copy.copy(command)
+                    command.ttl = ttl
+                cls._queue(command)
+
+    @classmethod
+    def _queue_command(cls, command):
+        for command in command.per_device():
+            cls._queue(command)
+
+    @staticmethod
+    def _queue(command):
+        if command.lane is not None:
+            command.lane.submit(command.enqueued())
+        else:
+            _WORKERS_QUEUE.put(command.enqueued())
 
     @staticmethod
-    def _queue_command(command):
-        _WORKERS_QUEUE.put(command)
+    def _poll_ttl(update_interval):
+        """Polls of workers without an interval only run on demand and are never dropped"""
+        if not update_interval:
+            return None
+        return update_interval * _shedding["ttl_intervals"]
 
     @staticmethod
     def _pip_install_helper(package_names):
         for package in package_names:
+            if getattr(sys.modules.get(package), "SIMULATED", False):
+                continue
             pip_main(["install", "-q", package])
         logger.reset()
 
-    def _update_interval_wrapper(self, command, job_id, client, userdata, c):
+    def _schedule(self, job_id, func, seconds, phase_of=None):
+        """
+        Runs ``func`` every ``seconds``. A job that is rescheduled, or takes over from the job
+        ``phase_of``, next runs one new interval after that job last ran, or right away when that
+        time passed already, so its devices keep their phase.
+        """
+        job = self._scheduler.get_job(job_id)
+        previous = job if job is not None else self._scheduler.get_job(phase_of) if phase_of else None
+        first_run = None
+        if previous is not None:
+            first_run = max(previous.next_run - previous.interval + seconds, clock.monotonic())
+        self._scheduler.add_job(
+            func, seconds, id=job_id, first_run=first_run, jitter=self._jitter, misfire_grace=self._misfire_grace
+        )
+
+    def _set_device_interval(self, worker_name, device, seconds):
+        """Polls a device every ``seconds``, with the other devices of its worker again for 0"""
+        job_id = "{}_{}_interval_job".format(worker_name, device)
+        if seconds < 0:
+            raise ValueError("Interval of {} device '{}' can't be negative: {}".format(worker_name, device, seconds))
+        if not seconds:
+            self._excluded[worker_name].discard(device)
+            if self._scheduler.get_job(job_id) is not None:
+                self._scheduler.remove_job(job_id)
+            return
+        self._schedule(
+            job_id,
+            partial(self._queue_commands, self._polls[worker_name], {device}, ttl=self._poll_ttl(seconds)),
+            seconds,
+            phase_of="{}_interval_job".format(worker_name),
+        )
+        self._excluded[worker_name].add(device)
+
+    def _update_interval_wrapper(self, commands, job_id, client, userdata, c):
         _LOGGER.info("Recieved updated interval for %s with: %s", c.topic, c.payload)
+        job = self._scheduler.get_job(job_id)
+        if job is None:
+            _LOGGER.error("Ignoring new interval for %s without an interval job", c.topic)
+            return
         try:
             new_interval = int(c.payload)
-            self._scheduler.remove_job(job_id)
-            self._scheduler.add_job(
-                partial(self._queue_command, command),
-                "interval",
-                seconds=new_interval,
-                id=job_id,
-            )
+            if new_interval <= 0:
+                raise ValueError("Interval must be positive: {}".format(new_interval))
+            for command in commands:
+                command.ttl = self._poll_ttl(new_interval)
+            self._schedule(job_id, job.func, new_interval)
         except ValueError:
             logger.log_exception(
                 _LOGGER, "Ignoring invalid new interval: %s", c.payload
             )
 
-    def _on_command_wrapper(self, worker_obj, client, userdata, c):
+    def _on_adaptive_poll(self, worker_name, command, messages, result):
+        if command.devices is None or len(command.devices) != 1:
+            return
+        device = command.devices[0]
+        interval = self._adaptive[worker_name].polled(device, messages)
+        if interval is not None:
+            self._set_device_interval(worker_name, device, interval)
+
+    def _device_interval_wrapper(self, worker_name, client, userdata, c):
+        _LOGGER.info("Recieved updated interval for %s with: %s", c.topic, c.payload)
+        device = c.topic.split("/")[-2]
+        if device not in (self._config["workers"][worker_name]["args"].get("devices") or {}):
+            _LOGGER.warning("Ignoring interval of unknown %s device '%s'", worker_name, device)
+            return
+        try:
+            self._set_device_interval(worker_name, device, int(c.payload))
+        except ValueError:
+            logger.log_exception(_LOGGER, "Ignoring invalid new interval: %s", c.payload)
+
+    def _on_command_wrapper(self, worker_objs, client, userdata, c):
         _LOGGER.debug(
-            "Received command for %s on %s: %s", repr(worker_obj), c.topic, c.payload
+            "Received command for %s on %s: %s", repr(worker_objs[0]), c.topic, c.payload
         )
         global_topic_prefix = userdata["global_topic_prefix"]
         topic = (
@@ -210,11 +581,156 @@ class WorkersManager:
             if global_topic_prefix is not None
             else c.topic
         )
+        worker_obj = self._command_target(worker_objs, topic)
         self._queue_command(
             self.Command(
                 worker_obj.on_command, worker_obj.command_timeout, [topic, c.payload]
             )
         )
+        adaptive = self._adaptive.get(repr(worker_obj))
+        if adaptive is not None:
+            levels = topic.split("/")
+            for device in worker_obj.devices or []:
+                if device in levels and adaptive.touched(device) is not None:
+                    self._set_device_interval(repr(worker_obj), device, adaptive.interval(device))
+
+    @staticmethod
+    def _command_target(worker_objs, topic):
+        """The shard polling the device named in a command topic, see adapters"""
+        if len(worker_objs) > 1:
+            levels = topic.split("/")
+            for worker_obj in worker_objs:
+                if any(device in levels for device in worker_obj.devices or []):
+                    return worker_obj
+        return worker_objs[0]
+
+    def _on_read_request(self, client, userdata, c):
+        """
+        Answers a read of a device, ``{"worker": ..., "device": ..., "max_age": ..., "id": ...}``,
+        on the read topic's ``reply`` subtopic. Values polled within ``max_age`` seconds are sent
+        right away, otherwise a poll of the device goes first in the queue and its values are sent
+        once it ran. Requests for a device that is being polled for a read wait for that poll.
+        Without a device, every device of a worker polling them one by one gets a reply of its own.
+        """
+        try:
+            request = json.loads(c.payload.decode("utf-8"))
+            if not isinstance(request, dict) or "worker" not in request:
+                raise ValueError(request)
+        except ValueError:
+            logger.log_exception(_LOGGER, "Ignoring invalid read request: %s", c.payload)
+            return
+        _LOGGER.debug("Received read request: %s", request)
+        worker, device = request["worker"], request.get("device")
+        max_age = request.get("max_age", self._config["read"].get("max_age", DEFAULT_READ_MAX_AGE))
+        if isinstance(max_age, bool) or not isinstance(max_age, numbers.Number):
+            _LOGGER.warning("Ignoring read request with an invalid max_age: %s", request)
+            metrics.READ_REQUESTS.inc(worker, "error")
+            self._reply(request, [], "invalid", None)
+            return
+        commands = self._polls.get(worker, [])
+        if device is not None:
+            shard = self._command_target(self._workers.get(worker, []), device) if commands else None
+            if shard is None or device not in (shard.devices or []):
+                commands = []
+            else:
+                commands = [command for command in commands if command.callback.__self__ is shard]
+        commands = [
+            command for poll in commands for command in poll.per_device()
+            if device is None or command.devices is None or device in command.devices
+        ]
+        if not commands:
+            metrics.READ_REQUESTS.inc(worker, "error")
+            self._reply(request, [], "unknown", None)
+            return
+        for command in commands:
+            if device is None and command.devices is not None and len(commands) > 1:
+                self._read(dict(request, device=command.devices[0]), command, max_age)
+            else:
+                self._read(request, command, max_age)
+
+    def _read(self, request, command, max_age):
+        worker = request["worker"]
+        key = command.cache_key
+        polled, values = _last_values.get(key, (None, None))
+        if polled is not None and clock.monotonic() - polled <= max_age:
+            metrics.READ_REQUESTS.inc(worker, "cache")
+            self._reply(request, values, "success", polled)
+            return
+
+        metrics.READ_REQUESTS.inc(worker, "poll")
+        with self._reads_lock:
+            if key in self._reads:
+                self._reads[key].append(request)
+                return
+            self._reads[key] = [request]
+        read = copy.copy(command)
+        read.ttl = None
+        read.priority = READ_PRIORITY
+        read.reply = partial(self._on_read_polled, key, command.reply)
+        self._queue(read)
+
+    def _on_read_polled(self, key, reply, command, messages, result):
+        if reply is not None:
+            reply(command, messages, result)
+        with self._reads_lock:
+            requests = self._reads.pop(key, [])
+        for request in requests:
+            self._reply(request, messages, result, clock.monotonic())
+
+    def _reply(self, request, messages, result, polled):
+        device = request.get("device")
+        values = {
+            message.topic: message.raw_payload
+            for message in messages
+            if device is None or device in message.topic.split("/")
+        }
+        payload = {
+            "id": request.get("id"),
+            "worker": request["worker"],
+            "device": device,
+            "result": result,
+            "age": round(clock.monotonic() - polled, 3) if polled is not None else None,
+            "values": values,
+        }
+        self._mqtt.publish(
+            [
+                MqttMessage(
+                    topic="{}/reply".format(self._config["read"].get("topic", DEFAULT_READ_TOPIC)),
+                    payload=payload,
+                    retain=False,
+                )
+            ]
+        )
+
+    def _on_profile_request(self, client, userdata, c):
+        _LOGGER.info("Received profiling request on %s: %s", c.topic, c.payload)
+        try:
+            request = json.loads(c.payload.decode("utf-8")) if c.payload else {}
+            if not isinstance(request, dict):
+                raise ValueError(request)
+        except ValueError:
+            logger.log_exception(_LOGGER, "Ignoring invalid profiling request: %s", c.payload)
+            return
+        commands = request.get("commands")
+        if isinstance(commands, str):
+            commands = [commands]
+        # Started from the main loop, a previous session may have to finish a command first
+        self._queue_command(
+            self.Command(
+                self._start_profiling,
+                self._command_timeout,
+                [request.get("duration"), commands, request.get("count")],
+            )
+        )
+
+    def _start_profiling(self, duration, commands, count):
+        profiling.start(
+            self._config["profiling"].get("output_dir", profiling.DEFAULT_OUTPUT_DIR),
+            duration=duration,
+            commands=commands,
+            count=count,
+        )
+        return []
 
     def _publish_config(self, mqtt):
         for command in self._config_commands:
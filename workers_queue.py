@@ -1,3 +1,23 @@
+import heapq
+import itertools
 from queue import Queue
 
-_WORKERS_QUEUE = Queue()
+
+class CommandQueue(Queue):
+    """A FIFO queue in which commands with a higher ``priority`` go first"""
+
+    def _init(self, maxsize):
+        self.queue = []
+        self._counter = itertools.count()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        heapq.heappush(self.queue, (-getattr(item, "priority", 0), next(self._counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+
+_WORKERS_QUEUE = CommandQueue()